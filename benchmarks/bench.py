@@ -0,0 +1,357 @@
+"""
+Benchmarks gpuview against a simulated gpu cluster.
+
+For every combination of cluster size and history length, runs the
+aggregator against fake nodes and measures:
+
+    cycle           time of one collector cycle polling all nodes
+    all_gpustat     latency of `/all_gpustat`, plain, gzip-compressed, as
+                    a delta, filtered to free gpus and read from the database
+    find_process    latency of `/find_process`
+    db              database size and growth per collector cycle
+    memory          size of the snapshot, of the recent store, and the
+                    peak resident memory of the benchmark
+
+Results are saved as json; `--compare` checks them against a previous
+run and exits with 1 if a latency regressed beyond `--threshold`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench --nodes 10,100 --history 0,10000
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+from gpuview import __version__
+from gpuview import app
+from gpuview import core
+from gpuview import rollup
+from gpuview.cache import SnapshotCache
+from gpuview.memgap import MemGapTracker
+from gpuview.poller import HostPoller
+from gpuview.push import IngestStore
+from gpuview.recent import RecentStore
+from gpuview.registry import HostRegistry
+
+from .cluster import FakeCluster
+
+# what a scheduler looking for idle gpus asks for
+FREE_QUERY = '/all_gpustat?free=1&fields=memory.used,memory.total&processes=0'
+# latencies compared by `--compare`, as (section, statistic)
+COMPARED = [
+    ('cycle', 'p50'), ('cycle', 'p95'),
+    ('all_gpustat', 'p50'), ('all_gpustat_gzip', 'p50'),
+    ('all_gpustat_delta', 'p50'), ('all_gpustat_free', 'p50'),
+    ('all_gpustat_db', 'p50'),
+    ('find_process', 'p50'),
+]
+
+
+def summarize(durations):
+    """
+    Returns:
+        dict: mean, p50, p95 and max of durations, in milliseconds
+    """
+
+    durations = sorted(durations)
+    if not durations:
+        return {}
+
+    def percentile(p):
+        return durations[min(len(durations) - 1,
+                             int(round(p / 100.0 * (len(durations) - 1))))]
+
+    return dict((name, round(value * 1000, 3)) for name, value in [
+        ('mean', sum(durations) / len(durations)),
+        ('p50', percentile(50)), ('p95', percentile(95)),
+        ('max', durations[-1])])
+
+
+def db_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal')
+               if os.path.exists(path + suffix))
+
+
+def max_rss():
+    """
+    Returns:
+        int: peak resident memory of this process in bytes, if known
+    """
+
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def reset_app(workdir, args):
+    """
+    Points gpuview at a fresh database, hosts included, with a fake local
+    gpustat backend, as `gpuview run` would set it up.
+    """
+
+    app.HOSTS_DB = os.path.join(workdir, 'gpuview.db')
+    app.DB_TYPE = 'sqlite'
+    app.STORAGE = args.storage
+    app.WRITER = None
+    app.EXPORTER = None
+    app.PERSIST_INTERVAL = args.persist_interval
+    app.LAST_PERSISTED = {}
+    app.SNAPSHOT_CACHE = SnapshotCache()
+    app.MEMGAP_TRACKER = MemGapTracker()
+    app.ROLLUPS = rollup.RollupEngine()
+    app.RECENT = RecentStore(window=args.recent_window)
+    app.INGEST = IngestStore()
+    app.POLLER = HostPoller(connect_timeout=args.connect_timeout,
+                            read_timeout=args.read_timeout,
+                            deadline=args.poll_deadline,
+                            max_workers=args.poll_workers)
+    core.set_registry(HostRegistry(app.get_db_connection))
+    core.set_sampler('fake', gpus=args.gpus, processes=args.processes,
+                     hostname='aggregator', seed=0)
+    app.init_db()
+
+
+def prefill_history(gpustats, snapshots, interval):
+    """
+    Writes `snapshots` past copies of the aggregated gpustats, one per
+    collector interval, ending now.
+    """
+
+    conn = app.get_db_connection()
+    cursor = conn.cursor()
+    now = time.time()
+    for i in range(snapshots):
+        app.insert_raw_snapshot(cursor, 'allgpustats', gpustats,
+                                now - (snapshots - i) * interval)
+        if i % 1000 == 999:
+            conn.commit()
+    conn.commit()
+    conn.close()
+
+
+def time_requests(client, path, count, headers=None):
+    durations = []
+    for _ in range(count):
+        started = time.time()
+        resp = client.get(path, headers=headers or {})
+        resp.get_data()
+        durations.append(time.time() - started)
+        if resp.status_code != 200:
+            raise IOError('HTTP %s from %s' % (resp.status_code, path))
+    return summarize(durations)
+
+
+def run_scenario(nodes, history, args):
+    workdir = tempfile.mkdtemp(prefix='gpuview-bench-')
+    try:
+        reset_app(workdir, args)
+        with FakeCluster(nodes, gpus=args.gpus, processes=args.processes,
+                         latency=args.latency,
+                         failure_rate=args.failure_rate) as cluster:
+            core.save_hosts(cluster.hosts)
+            app.publish_snapshot('gpustat', core.my_gpustat())
+
+            # the first cycle opens the connections to all nodes
+            started = time.time()
+            app.collect_all_gpustat()
+            first_cycle = time.time() - started
+
+            prefill_history(app.SNAPSHOT_CACHE.get('all_gpustat')
+                            .data['gpustats'], history,
+                            app.REPORT_INTERVAL)
+            db_before = db_size(app.HOSTS_DB)
+
+            durations = []
+            stale = 0
+            for _ in range(args.cycles):
+                started = time.time()
+                _, cycle_stale, _, _ = app.collect_all_gpustat()
+                durations.append(time.time() - started)
+                stale += cycle_stale
+            db_after = db_size(app.HOSTS_DB)
+            requests = sum(node.requests for node in cluster.nodes)
+
+        snapshot = app.SNAPSHOT_CACHE.get('all_gpustat')
+        previous = app.SNAPSHOT_CACHE.find('all_gpustat', snapshot.etag)
+        client = app.app.test_client()
+        result = {
+            'nodes': nodes,
+            'history': history,
+            'first_cycle_ms': round(first_cycle * 1000, 3),
+            'cycle': summarize(durations),
+            'stale_per_cycle': round(float(stale) / max(1, args.cycles), 2),
+            'node_requests': requests,
+            'all_gpustat': time_requests(client, '/all_gpustat',
+                                         args.requests),
+            'all_gpustat_gzip': time_requests(
+                client, '/all_gpustat', args.requests,
+                {'Accept-Encoding': 'gzip'}),
+            'all_gpustat_delta': time_requests(
+                client, '/all_gpustat?since=%s' %
+                (previous.etag if previous is not None else ''),
+                args.requests, {'Accept-Encoding': 'gzip'}),
+            'all_gpustat_free': time_requests(client, FREE_QUERY,
+                                              args.requests),
+            'find_process': time_requests(
+                client, '/find_process?hostname=node0000&gpuid=0',
+                args.requests),
+            'db': {
+                'bytes': db_after,
+                'bytes_per_cycle': int((db_after - db_before) /
+                                       max(1, args.cycles)),
+            },
+            'memory': {
+                'snapshot_bytes': len(snapshot.body),
+                'snapshot_gzip_bytes': len(snapshot.gzipped()),
+                'free_query_bytes': len(client.get(FREE_QUERY).get_data()),
+                'recent_bytes': app.RECENT.memory_bytes(),
+                'max_rss_bytes': max_rss(),
+            },
+        }
+        # without the snapshot cache, requests fall back to the database
+        app.SNAPSHOT_CACHE = SnapshotCache()
+        result['all_gpustat_db'] = time_requests(client, '/all_gpustat',
+                                                 args.requests)
+        return result
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the latencies of `results` relative to `baseline`.
+
+    Returns:
+        list: descriptions of the latencies that regressed by more than
+            `threshold`
+    """
+
+    previous = dict(((s['nodes'], s['history']), s)
+                    for s in baseline['scenarios'])
+    regressions = []
+    for scenario in results['scenarios']:
+        before = previous.get((scenario['nodes'], scenario['history']))
+        if before is None:
+            continue
+        for section, stat in COMPARED:
+            old = before.get(section, {}).get(stat)
+            new = scenario.get(section, {}).get(stat)
+            if not old or new is None:
+                continue
+            ratio = new / old
+            line = '%5d nodes %7d rows  %-18s %-4s %9.3fms -> %9.3fms ' \
+                '(%+.0f%%)' % (scenario['nodes'], scenario['history'],
+                               section, stat, old, new, (ratio - 1) * 100)
+            if ratio > 1 + threshold:
+                regressions.append(line)
+                line += '  REGRESSION'
+            print(line)
+    return regressions
+
+
+def parse_list(value):
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks gpuview against a simulated gpu cluster.')
+    parser.add_argument('--nodes', type=parse_list, default=[10, 50],
+                        help='Comma-separated cluster sizes (default: 10,50)')
+    parser.add_argument('--history', type=parse_list, default=[0, 10000],
+                        help='Comma-separated numbers of past snapshots in '
+                        'the database (default: 0,10000)')
+    parser.add_argument('--gpus', type=int, default=8,
+                        help='GPUs per node (default: 8)')
+    parser.add_argument('--processes', type=int, default=4,
+                        help='Maximum processes per GPU (default: 4)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds each node takes to answer '
+                        '(default: 0.005)')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Share of node requests that fail (default: 0)')
+    parser.add_argument('--cycles', type=int, default=10,
+                        help='Collector cycles measured (default: 10)')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='Requests per measured route (default: 50)')
+    parser.add_argument('--storage', default='blob',
+                        choices=['blob', 'normalized'],
+                        help='Snapshot storage layout (default: blob)')
+    parser.add_argument('--persist-interval', type=float, default=0,
+                        help='Seconds between raw snapshots written, 0 '
+                        'writes every cycle (default: 0)')
+    parser.add_argument('--recent-window', type=int, default=3600,
+                        help='Seconds kept in memory (default: 3600)')
+    parser.add_argument('--connect-timeout', type=float, default=1.0)
+    parser.add_argument('--read-timeout', type=float, default=2.0)
+    parser.add_argument('--poll-deadline', type=float, default=2.5)
+    parser.add_argument('--poll-workers', type=int, default=32)
+    parser.add_argument('--output', default=None,
+                        help='Where to save the results (default: '
+                        'benchmarks/results/<time>.json)')
+    parser.add_argument('--compare', default=None,
+                        help='Results of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Slowdown reported as a regression '
+                        '(default: 0.2)')
+    args = parser.parse_args(argv)
+
+    results = {
+        'gpuview': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'hostname': socket.gethostname(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': dict((k, v) for k, v in vars(args).items()
+                       if k not in ('output', 'compare', 'threshold')),
+        'scenarios': [],
+    }
+    for nodes in args.nodes:
+        for history in args.history:
+            scenario = run_scenario(nodes, history, args)
+            results['scenarios'].append(scenario)
+            print('%5d nodes %7d rows  cycle p50 %8.2fms  all_gpustat p50 '
+                  '%7.2fms  find_process p50 %7.2fms  %6d KB/cycle' % (
+                      nodes, history, scenario['cycle']['p50'],
+                      scenario['all_gpustat']['p50'],
+                      scenario['find_process']['p50'],
+                      scenario['db']['bytes_per_cycle'] // 1024))
+
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'results',
+        time.strftime('%Y%m%d-%H%M%S.json'))
+    if not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        os.makedirs(os.path.dirname(os.path.abspath(output)))
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print('%d latencies regressed by more than %d%%' %
+                  (len(regressions), args.threshold * 100))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
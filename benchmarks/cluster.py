@@ -0,0 +1,130 @@
+"""
+Simulated gpu cluster for the gpuview benchmarks.
+
+Every fake node is a small HTTP server answering `/gpustat` with the
+stats of its own `FakeSampler`, after a configurable latency and failing
+a configurable share of the requests.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from gpuview.sampler import FakeSampler
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class FakeNode(object):
+    """
+    A fake gpuview node.
+
+    Args:
+        latency (float): seconds to wait before answering
+        failure_rate (float): share of requests answered with HTTP 500
+    """
+
+    def __init__(self, hostname, gpus=8, processes=4, latency=0.0,
+                 failure_rate=0.0, seed=None):
+        self.hostname = hostname
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sampler = FakeSampler(gpus=gpus, processes=processes,
+                                   hostname=hostname, seed=seed)
+        self.requests = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), self._handler())
+        self.url = '127.0.0.1:%d' % self._server.server_address[1]
+
+    def _handler(self):
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, body = node.respond(self.path)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, path):
+        """
+        Returns:
+            tuple: (HTTP status, body)
+        """
+
+        with self._lock:
+            self.requests += 1
+            failed = self._random.random() < self.failure_rate
+            gpustat = None if failed else self.sampler.sample()
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            return 500, b'{}'
+        if path.split('?')[0] != '/gpustat':
+            return 404, b'{}'
+        return 200, json.dumps(gpustat, default=str).encode('utf-8')
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeCluster(object):
+    """
+    N fake nodes, registered as {url: hostname} like `load_hosts`.
+    """
+
+    def __init__(self, nodes, gpus=8, processes=4, latency=0.0,
+                 failure_rate=0.0, seed=0):
+        self.nodes = [FakeNode('node%04d' % i, gpus, processes, latency,
+                               failure_rate, seed=seed + i)
+                      for i in range(nodes)]
+
+    @property
+    def hosts(self):
+        return dict((node.url, node.hostname) for node in self.nodes)
+
+    def start(self):
+        for node in self.nodes:
+            node.start()
+        return self
+
+    def stop(self):
+        for node in self.nodes:
+            node.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
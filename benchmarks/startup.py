@@ -0,0 +1,126 @@
+"""
+Benchmarks the startup time of the gpuview command line.
+
+Runs every host-management command in a fresh interpreter, as a script
+registering hundreds of nodes would, and reports the median wall time
+and whether it imported any of the modules only `gpuview run` needs.
+
+Run from the repository root:
+
+    python -m benchmarks.startup --runs 20
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# imported by `gpuview run` only
+SERVER_MODULES = ('flask', 'mysql', 'gpustat', 'pynvml', 'werkzeug',
+                  'gpuview.app', 'gpuview.poller')
+
+PROBE = '''
+import json, sys
+from gpuview.cli import main
+try:
+    main(sys.argv[1:])
+finally:
+    loaded = sorted(set(name for name in sys.modules
+                        if name in %r or name.split('.')[0] in %r))
+    sys.stderr.write('\\nLOADED ' + json.dumps(loaded) + '\\n')
+''' % (SERVER_MODULES, SERVER_MODULES)
+
+
+def run(argv):
+    """
+    Returns:
+        tuple: (seconds, server modules loaded)
+    """
+
+    started = time.time()
+    proc = subprocess.run([sys.executable, '-c', PROBE] + argv,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = time.time() - started
+    loaded = []
+    for line in proc.stderr.splitlines():
+        if line.startswith('LOADED '):
+            loaded = json.loads(line[len('LOADED '):])
+    if proc.returncode != 0:
+        raise RuntimeError('gpuview %s failed: %s' % (' '.join(argv),
+                                                      proc.stderr))
+    return elapsed, loaded
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the startup time of the gpuview CLI.')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Runs of every command (default: 10)')
+    parser.add_argument('--output', default=None,
+                        help='Where to save the results as json')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='gpuview-startup-')
+    db = ['--db-path', os.path.join(workdir, 'gpuview.db')]
+    commands = [
+        ('hosts', lambda i: ['hosts'] + db),
+        ('add', lambda i: ['add', '--url', '10.0.%d.%d:9988' %
+                           (i // 250, i % 250), '--label', 'rack=r1'] + db),
+        ('remove', lambda i: ['remove', '--url', '10.0.%d.%d:9988' %
+                              (i // 250, i % 250)] + db),
+    ]
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'runs': args.runs,
+        'commands': {},
+    }
+    try:
+        for name, command in commands:
+            durations = []
+            loaded = set()
+            for i in range(args.runs):
+                elapsed, modules = run(command(i))
+                durations.append(elapsed)
+                loaded.update(modules)
+            results['commands'][name] = {
+                'median_ms': round(median(durations) * 1000, 1),
+                'max_ms': round(max(durations) * 1000, 1),
+                'server_modules': sorted(loaded),
+            }
+            print('gpuview %-7s median %7.1fms  max %7.1fms  %s' % (
+                name, median(durations) * 1000, max(durations) * 1000,
+                'loads ' + ', '.join(sorted(loaded)) if loaded
+                else 'no server modules'))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to %s' % args.output)
+    loaded = [name for name, result in results['commands'].items()
+              if result['server_modules']]
+    return 1 if loaded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
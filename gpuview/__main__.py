@@ -4,5 +4,5 @@
 
 
 if __name__ == '__main__':
-    from .app import main
+    from .cli import main
     main()
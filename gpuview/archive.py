@@ -0,0 +1,450 @@
+"""
+Long-term archive of the gpu history of gpuview.
+
+Before raw snapshots expire from the database, the cleanup pass exports
+the gpu samples of every aggregated snapshot into append-only segment
+files, one per day and host:
+
+    <archive dir>/<YYYY-MM-DD>/<host>-<hash>.gpa
+
+where the host is made safe for a file name and the hash, of the real
+hostname, keeps hosts like `a/b` and `a_b` apart. A segment file starts
+with a small header naming its host, followed by blocks appended by
+successive exports. Every block holds the samples of one export, stored
+column by column and zlib-compressed, behind a fixed header with the
+number of rows, the time range it covers and the id of the last snapshot
+it holds:
+
+    header  'GPA1', hostname length (uint16), hostname
+    block   'BLK2', rows (uint32), compressed bytes (uint32),
+            first and last sample time (float64), last snapshot id
+            (uint64), compressed columns
+
+Snapshots are exported in id order, and the samples of snapshots at or
+below the last id of a segment are not appended again, so an export
+repeated because its watermark was not committed adds nothing. Readers
+map the files in memory and only decompress the blocks that overlap the
+requested range; a block cut short by a crash is ignored.
+Process lists are not archived, the user rollups and the usage ledger
+keep the usage per user.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import array
+import calendar
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime
+
+from . import normalized
+
+# (column, array typecode, gpustat key); None is stored as -1
+COLUMNS = [
+    ('time', 'd', None),
+    ('gpu', 'h', 'index'),
+    ('utilization', 'h', 'utilization.gpu'),
+    ('memory_used', 'i', 'memory.used'),
+    ('memory_total', 'i', 'memory.total'),
+    ('temperature', 'h', 'temperature.gpu'),
+    ('power', 'i', 'power.draw'),
+    ('processes', 'h', 'processes'),
+]
+MAGIC = b'GPA1'
+BLOCK = struct.Struct('<4sIIddQ')
+BLOCK_MAGIC = b'BLK2'
+SUFFIX = '.gpa'
+COMPRESS_LEVEL = 6
+EXPORT_BATCH = 500  # snapshots exported per transaction
+MAX_ROWS = 100000  # rows returned by one query
+WATERMARK = 'archive'  # key of the export watermark in rollup_state
+
+
+def _filename(hostname):
+    digest = hashlib.sha1(hostname.encode('utf-8')).hexdigest()[:8]
+    return '%s-%s%s' % (re.sub(r'[^A-Za-z0-9._-]', '_', hostname), digest,
+                        SUFFIX)
+
+
+def _day(timestamp):
+    return time.strftime('%Y-%m-%d', time.gmtime(timestamp))
+
+
+def _value(gpu, key, position):
+    if key == 'index':
+        value = gpu.get('index', position)
+    elif key == 'processes':
+        value = gpu.get('processes')
+        if isinstance(value, list):
+            value = len(value)
+        elif value is None and gpu.get('user_processes'):
+            # outside the safe zone the processes are left out and
+            # `user_processes` reads `users/processes`
+            value = gpu['user_processes'].rpartition('/')[2]
+    else:
+        value = gpu.get(key)
+    try:
+        return -1 if value is None else int(round(float(value)))
+    except (TypeError, ValueError):
+        return -1
+
+
+def sample_rows(hoststats, sample_time, snapshot_id=0):
+    """
+    Returns:
+        dict: {hostname: [(snapshot_id, row), ...]} of the gpus of the
+            fresh hosts of an aggregated snapshot, rows in the order of
+            `COLUMNS`
+    """
+
+    hosts = {}
+    for hostinfo in hoststats or []:
+        if not hostinfo or 'hostname' not in hostinfo or \
+                hostinfo.get('stale'):
+            continue
+        rows = hosts.setdefault(hostinfo['hostname'], [])
+        for position, gpu in enumerate(hostinfo.get('gpus') or []):
+            rows.append((snapshot_id, (sample_time,) + tuple(
+                _value(gpu, key, position) for _, _, key in COLUMNS[1:])))
+    return hosts
+
+
+def encode_block(rows, last_id=0):
+    """
+    Returns:
+        bytes: a block of the rows, sorted by time
+    """
+
+    rows = sorted(rows)
+    columns = []
+    for i, (_, typecode, _) in enumerate(COLUMNS):
+        column = array.array(typecode, (row[i] for row in rows))
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column.tobytes())
+    payload = zlib.compress(b''.join(columns), COMPRESS_LEVEL)
+    return BLOCK.pack(BLOCK_MAGIC, len(rows), len(payload), rows[0][0],
+                      rows[-1][0], last_id) + payload
+
+
+def decode_block(payload, count):
+    """
+    Returns:
+        list: the columns of a block, as arrays
+    """
+
+    data = zlib.decompress(payload)
+    columns = []
+    offset = 0
+    for _, typecode, _ in COLUMNS:
+        column = array.array(typecode)
+        size = column.itemsize * count
+        column.frombytes(data[offset:offset + size])
+        if sys.byteorder == 'big':
+            column.byteswap()
+        columns.append(column)
+        offset += size
+    return columns
+
+
+def _walk(data, size):
+    """
+    Reads the header and the block headers of a segment file.
+
+    Returns:
+        tuple: (hostname, [(offset, rows, compressed bytes, first, last,
+            last snapshot id)], end of the last complete block), hostname
+            None if the file is not a segment
+    """
+
+    if size < len(MAGIC) + 2 or data[:len(MAGIC)] != MAGIC:
+        return None, [], 0
+    length, = struct.unpack_from('<H', data, len(MAGIC))
+    offset = len(MAGIC) + 2 + length
+    hostname = data[len(MAGIC) + 2:offset].decode('utf-8')
+    blocks = []
+    while offset + BLOCK.size <= size:
+        magic, count, compressed, first, last, last_id = \
+            BLOCK.unpack_from(data, offset)
+        begin = offset + BLOCK.size
+        if magic != BLOCK_MAGIC or begin + compressed > size:
+            break  # cut short while it was appended
+        blocks.append((begin, count, compressed, first, last, last_id))
+        offset = begin + compressed
+    return hostname, blocks, offset
+
+
+class Archive(object):
+    """
+    The segment files under a directory.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.snapshots = 0  # exported by `export`
+        self.rows = 0
+        self.blocks = 0
+        self.failed = 0
+        self.skipped = 0  # rows of snapshots the segments already held
+        self.last_export = None
+
+    def append(self, samples):
+        """
+        Appends a block to the segment of every day and host sampled,
+        leaving out the rows of snapshots the segment already holds.
+
+        Args:
+            samples (dict): {hostname: [(snapshot_id, row), ...]} as
+                `sample_rows` returns them
+
+        Returns:
+            int: number of rows appended
+        """
+
+        appended = 0
+        for hostname, rows in samples.items():
+            days = {}
+            for snapshot_id, row in rows:
+                days.setdefault(_day(row[0]), []).append((snapshot_id, row))
+            for day, day_rows in days.items():
+                directory = os.path.join(self.root, day)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                path = os.path.join(directory, _filename(hostname))
+                with open(path, 'ab') as f:
+                    size = f.tell()
+                    end, last_id = self._end(path, size) if size else (0, 0)
+                    if end < size:
+                        # drop the block an interrupted append left
+                        f.truncate(end)
+                        f.seek(end)
+                    new_rows = [row for snapshot_id, row in day_rows
+                                if snapshot_id > last_id or not snapshot_id]
+                    self.skipped += len(day_rows) - len(new_rows)
+                    if not new_rows:
+                        continue
+                    if not f.tell():
+                        name = hostname.encode('utf-8')
+                        f.write(MAGIC + struct.pack('<H', len(name)) + name)
+                    f.write(encode_block(new_rows, max(
+                        snapshot_id for snapshot_id, _ in day_rows)))
+                    f.flush()
+                    os.fsync(f.fileno())
+                appended += len(new_rows)
+                self.blocks += 1
+        self.rows += appended
+        return appended
+
+    def _end(self, path, size):
+        """
+        Returns:
+            tuple: (end of the last complete block, highest snapshot id of
+                the segment)
+        """
+
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hostname, blocks, end = _walk(mm, size)
+        finally:
+            mm.close()
+        if hostname is None:
+            return 0, 0
+        return end, max([block[5] for block in blocks] or [0])
+
+    def _segments(self, start, end, host=None):
+        if not os.path.isdir(self.root):
+            return
+        first, last = _day(start), _day(end)
+        for day in sorted(os.listdir(self.root)):
+            if not first <= day <= last:
+                continue
+            directory = os.path.join(self.root, day)
+            if not os.path.isdir(directory):
+                continue
+            names = [_filename(host)] if host is not None else \
+                sorted(os.listdir(directory))
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.endswith(SUFFIX) and os.path.isfile(path):
+                    yield path
+
+    def _scan(self, path, start, end):
+        """
+        Returns:
+            tuple: (hostname, [columns of every block overlapping the
+                range])
+        """
+
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return None, []
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hostname, blocks, _ = _walk(mm, size)
+            return hostname, [
+                decode_block(mm[begin:begin + compressed], count)
+                for begin, count, compressed, first, last, _ in blocks
+                if last >= start and first < end]
+        finally:
+            mm.close()
+
+    def query(self, start, end, host=None, gpu=None, limit=MAX_ROWS):
+        """
+        Reads the samples from `start` (included) to `end` (excluded).
+
+        Args:
+            limit (int): maximum rows returned, None for all
+
+        Returns:
+            tuple: ([[time, host, gpu, utilization, ...], ...] sorted by
+                time and host, whether `limit` cut them short)
+        """
+
+        rows = []
+        for path in self._segments(start, end, host):
+            hostname, blocks = self._scan(path, start, end)
+            if host is not None and hostname != host:
+                continue
+            for columns in blocks:
+                for values in zip(*columns):
+                    if not start <= values[0] < end or \
+                            gpu is not None and values[1] != gpu:
+                        continue
+                    rows.append([values[0], hostname, values[1]] + [
+                        None if v == -1 else v for v in values[2:]])
+        rows.sort(key=lambda r: (r[0], r[1], r[2]))
+        if limit is None:
+            return rows, False
+        return rows[:limit], len(rows) > limit
+
+    def stats(self):
+        """
+        Returns:
+            dict: what this process exported so far
+        """
+
+        return {'dir': self.root, 'snapshots': self.snapshots,
+                'rows': self.rows, 'blocks': self.blocks,
+                'skipped': self.skipped, 'failed': self.failed,
+                'last_export': self.last_export}
+
+    def disk_usage(self):
+        """
+        Returns:
+            dict: days, segment files and bytes of the archive
+        """
+
+        days = files = size = 0
+        if os.path.isdir(self.root):
+            for day in os.listdir(self.root):
+                directory = os.path.join(self.root, day)
+                if not os.path.isdir(directory):
+                    continue
+                days += 1
+                for name in os.listdir(directory):
+                    if name.endswith(SUFFIX):
+                        files += 1
+                        size += os.path.getsize(os.path.join(directory,
+                                                             name))
+        return {'dir': self.root, 'days': days, 'files': files,
+                'bytes': size}
+
+
+def _timestamp(value):
+    if isinstance(value, datetime):
+        # MySQL DATETIME, in local time as written
+        return time.mktime(value.timetuple())
+    # SQLite datetime('now'), in UTC
+    return calendar.timegm(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+
+
+def export(archive, cursor, db_type, storage, cutoff, batch=EXPORT_BATCH):
+    """
+    Appends at most `batch` aggregated snapshots older than `cutoff` to
+    the archive and advances the export watermark, before they expire.
+
+    Args:
+        cutoff: as compared to `created_at` of `allgpustats`, or a unix
+            timestamp with normalized storage
+
+    Returns:
+        int: number of snapshots exported
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    cursor.execute('SELECT watermark FROM rollup_state WHERE tier = %s'
+                   % placeholder, (WATERMARK,))
+    row = cursor.fetchone()
+    watermark = row[0] if row else 0
+
+    snapshots = []
+    if storage == 'normalized':
+        cursor.execute(
+            'SELECT id, sample_time FROM snapshots WHERE kind = {0} AND '
+            'id > {0} AND sample_time < {0} ORDER BY id LIMIT {1}'.format(
+                placeholder, int(batch)),
+            ('allgpustats', watermark, cutoff))
+        for snapshot_id, sample_time in cursor.fetchall():
+            snapshots.append((snapshot_id, sample_time, normalized
+                              .load_snapshot(cursor, db_type, snapshot_id)))
+    else:
+        cursor.execute(
+            'SELECT id, data, created_at FROM allgpustats WHERE id > {0} '
+            'AND created_at < {0} ORDER BY id LIMIT {1}'.format(
+                placeholder, int(batch)), (watermark, cutoff))
+        for snapshot_id, data, created_at in cursor.fetchall():
+            snapshots.append((snapshot_id, _timestamp(created_at),
+                              json.loads(data) if data else []))
+    if not snapshots:
+        return 0
+
+    samples = {}
+    for snapshot_id, sample_time, hoststats in snapshots:
+        for hostname, rows in sample_rows(hoststats, sample_time,
+                                          snapshot_id).items():
+            samples.setdefault(hostname, []).extend(rows)
+    archive.append(samples)
+    archive.snapshots += len(snapshots)
+    archive.last_export = time.time()
+
+    if row:
+        cursor.execute('UPDATE rollup_state SET watermark = %s WHERE tier = '
+                       '%s' % (placeholder, placeholder),
+                       (snapshots[-1][0], WATERMARK))
+    else:
+        cursor.execute('INSERT INTO rollup_state (tier, watermark) VALUES '
+                       '(%s, %s)' % (placeholder, placeholder),
+                       (WATERMARK, snapshots[-1][0]))
+    return len(snapshots)
+
+
+def parse_time(value):
+    """
+    Parses a unix timestamp or a `YYYY-MM-DD[THH:MM[:SS]]` UTC time.
+
+    Returns:
+        float: unix timestamp
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return float(calendar.timegm(time.strptime(value, fmt)))
+        except ValueError:
+            continue
+    raise ValueError('%r is neither a unix timestamp nor YYYY-MM-DD[THH:MM]'
+                     % value)
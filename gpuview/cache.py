@@ -0,0 +1,184 @@
+"""
+In-memory cache of the latest gpuview snapshots.
+
+The collectors publish every new snapshot here; it is serialized once per
+cycle and served to the dashboard and to peers straight from memory.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import gzip
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from . import delta
+
+
+COMPRESS_LEVEL = 5
+HISTORY = 30  # snapshots kept per key to compute deltas from
+MAX_VIEWS = 32  # filtered bodies cached per snapshot
+
+
+class Snapshot(object):
+    """
+    A published snapshot with its pre-serialized json body.
+    """
+
+    __slots__ = ('data', 'body', 'etag', 'version', 'created', '_gzipped',
+                 '_envelopes', '_views')
+
+    def __init__(self, data, version, token):
+        self.data = data
+        self.body = json.dumps(data, default=str).encode('utf-8')
+        self.version = version
+        self.etag = '%s-%d' % (token, version)
+        self.created = time.time()
+        self._gzipped = None
+        self._envelopes = {}  # base version: [body, gzipped body]
+        self._views = {}  # query key: [body, gzipped body]
+
+    def gzipped(self):
+        """
+        Returns the gzip-compressed body, compressing it on first use.
+        """
+
+        if self._gzipped is None:
+            self._gzipped = gzip.compress(self.body,
+                                          compresslevel=COMPRESS_LEVEL)
+        return self._gzipped
+
+    def envelope(self, base=None, compressed=False):
+        """
+        Returns the versioned body of the snapshot for a client that holds
+        `base`: `{"version": etag, "base": etag, "patch": patch}`, or
+        `{"version": etag, "full": data}` without a base.
+        """
+
+        version = base.version if base is not None else None
+        envelope = self._envelopes.get(version)
+        if envelope is None:
+            if base is None:
+                body = b'{"version": "%s", "full": %s}' % (
+                    self.etag.encode(), self.body)
+            else:
+                body = json.dumps({
+                    'version': self.etag, 'base': base.etag,
+                    'patch': delta.diff(base.data, self.data) or {}
+                }, default=str).encode('utf-8')
+            envelope = self._envelopes.setdefault(version, [body, None])
+        if not compressed:
+            return envelope[0]
+        if envelope[1] is None:
+            envelope[1] = gzip.compress(envelope[0],
+                                        compresslevel=COMPRESS_LEVEL)
+        return envelope[1]
+
+    def view(self, key, build, compressed=False):
+        """
+        Returns the body of a filtered view of the snapshot, `build(data)`
+        serialized on first use and cached under `key` for the first
+        `MAX_VIEWS` keys.
+        """
+
+        view = self._views.get(key)
+        if view is None:
+            view = [json.dumps(build(self.data), default=str)
+                    .encode('utf-8'), None]
+            if len(self._views) < MAX_VIEWS:
+                view = self._views.setdefault(key, view)
+        if not compressed:
+            return view[0]
+        if view[1] is None:
+            view[1] = gzip.compress(view[0], compresslevel=COMPRESS_LEVEL)
+        return view[1]
+
+
+class SnapshotCache(object):
+    """
+    Thread-safe store of the latest snapshot per key, eg. 'gpustat' and
+    'all_gpustat'.
+    """
+
+    def __init__(self):
+        # distinguishes the etags of different processes and restarts
+        self.token = '%x%x' % (os.getpid(), int(time.time()))
+        self._snapshots = {}
+        self._history = {}  # key: deque of recent snapshots
+        self._version = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def publish(self, key, data, version=None):
+        """
+        Serializes and publishes a new snapshot, with the next version or
+        the version it had in another process.
+
+        Returns:
+            Snapshot: the published snapshot
+        """
+
+        with self._lock:
+            if version is None:
+                self._version += 1
+                version = self._version
+            else:
+                self._version = max(self._version, version)
+        snapshot = Snapshot(data, version, self.token)
+        with self._changed:
+            self._snapshots[key] = snapshot
+            self._history.setdefault(key, deque(maxlen=HISTORY)).append(
+                snapshot)
+            self._changed.notify_all()
+        return snapshot
+
+    def snapshots(self):
+        """
+        Returns:
+            dict: {key: latest Snapshot}
+        """
+
+        return dict(self._snapshots)
+
+    def get(self, key):
+        """
+        Returns:
+            Snapshot: the latest snapshot of the key, or None
+        """
+
+        return self._snapshots.get(key)
+
+    def find(self, key, etag):
+        """
+        Returns:
+            Snapshot: the recent snapshot of the key with the etag, or None
+                if it is too old or unknown
+        """
+
+        with self._lock:
+            history = list(self._history.get(key, ()))
+        for snapshot in reversed(history):
+            if snapshot.etag == etag:
+                return snapshot
+        return None
+
+    def wait(self, key, version=0, timeout=None):
+        """
+        Blocks until a snapshot of the key newer than `version` is
+        published, or the timeout expires.
+
+        Returns:
+            Snapshot: the newer snapshot, or None on timeout
+        """
+
+        def newer():
+            snapshot = self._snapshots.get(key)
+            return snapshot is not None and snapshot.version > version
+
+        with self._changed:
+            if self._changed.wait_for(newer, timeout):
+                return self._snapshots[key]
+        return None
@@ -6,17 +6,20 @@ Core functions of gpuview.
 """
 
 import os
-import json
 import subprocess
-try:
-    from urllib.request import urlopen
-except ImportError:
-    from urllib2 import urlopen
+
+from .registry import HostRegistry
+from .sampler import SampleBuffer, get_sampler, summarize
 
 
 ABS_PATH = os.path.dirname(os.path.realpath(__file__))
-HOSTS_DB = os.path.join(ABS_PATH, 'gpuhosts.db')
+HOSTS_DB = os.path.join(ABS_PATH, 'gpuhosts.db')  # hosts file of older versions
+REGISTRY_DB = os.path.join(ABS_PATH, 'mygpustat.db')
+REGISTRY = None  # HostRegistry, see `host_registry`
 SAFE_ZONE = False  # Safe to report all details.
+SAMPLER = get_sampler('gpustat')
+SAMPLES = None  # SampleBuffer filled by `sample`, if sampling between reports
+LAST_REPORT = 0  # time of the window summarized by the last `my_gpustat`
 
 
 def safe_zone(safe=False):
@@ -24,11 +27,63 @@ def safe_zone(safe=False):
     SAFE_ZONE = safe
 
 
+def set_sampler(name, **kwargs):
+    """
+    Selects how this host samples its gpus, see `sampler.SAMPLERS`.
+    """
+
+    global SAMPLER
+    SAMPLER.close()
+    SAMPLER = get_sampler(name, **kwargs)
+
+
+def buffer_samples(capacity):
+    """
+    Keeps the last `capacity` samples taken by `sample`, which are then
+    summarized per gpu by `my_gpustat`.
+    """
+
+    global SAMPLES
+    SAMPLES = SampleBuffer(capacity)
+
+
+def sample():
+    """
+    Samples the gpus of this host into the sample buffer.
+    """
+
+    SAMPLES.append(SAMPLER.sample())
+
+
+def _latest_sample():
+    """
+    Returns the latest buffered sample with per-gpu summaries of the samples
+    since the last report, or a new sample if none was buffered since.
+    """
+
+    global LAST_REPORT
+    samples = SAMPLES.since(LAST_REPORT) if SAMPLES is not None else []
+    if not samples:
+        return SAMPLER.sample()
+    LAST_REPORT = samples[-1][0]
+    latest = samples[-1][1]
+    summaries = summarize(samples)
+    stat = dict(latest, gpus=[])
+    for position, gpu in enumerate(latest['gpus']):
+        gpu = dict(gpu)
+        summary = summaries.get(gpu.get('index', position))
+        if summary is not None:
+            gpu['summary'] = summary
+        stat['gpus'].append(gpu)
+    return stat
+
+
 def my_gpustat():
     """
     Returns a [safe] version of gpustat for this host.
         # See `--safe-zone` option of `gpuview start`.
         # Omit sensitive details, eg. uuid, username, and processes.
+        # Summarize the samples buffered since the last call, if any.
         # Set color flag based on gpu temperature:
             # bg-warning, bg-danger, bg-success, bg-primary
 
@@ -37,15 +92,18 @@ def my_gpustat():
     """
 
     try:
-        from gpustat import GPUStatCollection
-        stat = GPUStatCollection.new_query().jsonify()
+        stat = _latest_sample()
         delete_list = []
         for gpu_id, gpu in enumerate(stat['gpus']):
             if type(gpu['processes']) is str:
                 delete_list.append(gpu_id)
                 continue
-            gpu['memory'] = round(float(gpu['memory.used']) /
-                                  float(gpu['memory.total']) * 100)
+            # fields a sampler couldn't read are None
+            if gpu.get('memory.used') is not None and gpu.get('memory.total'):
+                gpu['memory'] = round(float(gpu['memory.used']) /
+                                      float(gpu['memory.total']) * 100)
+            else:
+                gpu['memory'] = None
             if SAFE_ZONE:
                 gpu['users'] = len(set([p['username']
                                         for p in gpu['processes']]))
@@ -63,17 +121,22 @@ def my_gpustat():
                 gpu.pop('processes', None)
                 gpu.pop("uuid", None)
                 gpu.pop("query_time", None)
+                if 'summary' in gpu:
+                    gpu['summary'] = dict(gpu['summary'], processes=len(
+                        gpu['summary']['processes']))
 
             gpu['flag'] = 'bg-primary'
-            if gpu['temperature.gpu'] > 75:
-                gpu['flag'] = 'bg-danger'
-            elif gpu['temperature.gpu'] > 50:
-                gpu['flag'] = 'bg-warning'
-            elif gpu['temperature.gpu'] > 25:
-                gpu['flag'] = 'bg-success'
+            temperature = gpu.get('temperature.gpu')
+            if temperature is not None:
+                if temperature > 75:
+                    gpu['flag'] = 'bg-danger'
+                elif temperature > 50:
+                    gpu['flag'] = 'bg-warning'
+                elif temperature > 25:
+                    gpu['flag'] = 'bg-success'
 
         if delete_list:
-            for gpu_id in delete_list:
+            for gpu_id in reversed(delete_list):
                 stat['gpus'].pop(gpu_id)
 
         return stat
@@ -94,20 +157,12 @@ def all_gpustats():
     if 'gpus' in mystat:
         gpustats.append(mystat)
 
+    from .poller import HostPoller
+
     hosts = load_hosts()
-    for url in hosts:
-        try:
-            raw_resp = urlopen(url + '/gpustat')
-            gpustat = json.loads(raw_resp.read())
-            raw_resp.close()
-            if not gpustat or 'gpus' not in gpustat:
-                continue
-            if hosts[url] != url:
-                gpustat['hostname'] = hosts[url]
-            gpustats.append(gpustat)
-        except Exception as e:
-            print('Error: %s getting gpustat from %s' %
-                  (getattr(e, 'message', str(e)), url))
+    with HostPoller() as poller:
+        hoststats, _ = poller.poll(hosts)
+    gpustats.extend(g for g in hoststats if not g.get('stale'))
 
     try:
         sorted_gpustats = sorted(gpustats, key=lambda g: g['hostname'])
@@ -118,61 +173,85 @@ def all_gpustats():
     return gpustats
 
 
-def load_hosts():
+def set_registry(registry):
+    """
+    Selects where the registered hosts are stored, eg. the stats database
+    of the running server.
+    """
+
+    global REGISTRY
+    REGISTRY = registry
+
+
+def host_registry():
+    """
+    Returns:
+        HostRegistry: the registry set with `set_registry`, by default in
+            the default stats database
+    """
+
+    global REGISTRY
+    if REGISTRY is None:
+        REGISTRY = HostRegistry.sqlite(REGISTRY_DB)
+    return REGISTRY
+
+
+def load_hosts(kind='node'):
     """
-    Loads the list of registered gpu nodes from file.
+    Loads the list of registered gpu nodes, or of aggregators whose
+    `/all_gpustat` is pulled as a sub-tree.
+
+    Args:
+        kind (str): 'node', 'aggregator', or None for both
 
     Returns:
         dict: {url: name, ... }
     """
 
-    hosts = {}
-    if not os.path.exists(HOSTS_DB):
-        print("There are no registered hosts! Use `gpuview add` first.")
-        return hosts
+    return host_registry().hosts(kind)
 
-    for line in open(HOSTS_DB, 'r'):
-        try:
-            name, url = line.strip().split('\t')
-            hosts[url] = name
-        except Exception as e:
-            print('Error: %s loading host: %s!' %
-                  (getattr(e, 'message', str(e)), line))
-    return hosts
 
+def save_hosts(hosts, kind='node'):
+    """
+    Saves the registered hosts of a kind, keeping those of the other kind.
+    """
 
-def save_hosts(hosts):
-    with open(HOSTS_DB, 'w') as f:
-        for url in hosts:
-            f.write('%s\t%s\n' % (hosts[url], url))
+    host_registry().replace(hosts, kind)
 
 
-def add_host(url, name=None):
-    url = url.strip().strip('/')
-    if name is None:
-        name = url
-    hosts = load_hosts()
-    hosts[url] = name
-    save_hosts(hosts)
-    print('Successfully added host!')
+def add_host(url, name=None, kind='node', labels=None, interval=None,
+             timeout=None):
+    try:
+        host_registry().add(url, name, kind, labels, interval, timeout)
+    except ValueError as e:
+        print('Error: %s!' % e)
+        return
+    print('Successfully added %s!' % ('aggregator' if kind == 'aggregator'
+                                     else 'host'))
 
 
 def remove_host(url):
-    hosts = load_hosts()
-    if hosts.pop(url, None):
-        save_hosts(hosts)
+    if host_registry().remove(url.strip().strip('/')):
         print("Removed host: %s!" % url)
     else:
         print("Couldn't find host: %s!" % url)
 
 
 def print_hosts():
-    hosts = load_hosts()
-    if len(hosts):
-        hosts = sorted(hosts.items(), key=lambda g: g[1])
-        print('#   Name\tURL')
-        for idx, host in enumerate(hosts):
-            print('%02d. %s\t%s' % (idx+1, host[1], host[0]))
+    hosts = host_registry().entries()
+    if not hosts:
+        print("There are no registered hosts! Use `gpuview add` first.")
+        return
+    print('#   Name\tURL\tLabels\tInterval\tTimeout')
+    for idx, host in enumerate(hosts):
+        name = host['name']
+        if host['kind'] == 'aggregator':
+            name += ' (aggregator)'
+        print('%02d. %s\t%s\t%s\t%s\t%s' % (
+            idx+1, name, host['url'],
+            ','.join('%s=%s' % label for label in sorted(
+                host['labels'].items())) or '-',
+            host['interval'] or '-', host['timeout'] or '-'))
 
 
 def install_service(host=None, port=None,
@@ -0,0 +1,126 @@
+"""
+Delta encoding of gpuview snapshots.
+
+A patch turns an older snapshot into a newer one:
+
+    dicts        {'set': {key: value}, 'unset': [key], 'sub': {key: patch}}
+    keyed lists  {'key': 'hostname', 'order': [key, ...],
+                  'set': {str(key): item}, 'sub': {str(key): patch}}
+
+Lists of dicts with unique `hostname` or `index` fields (hosts and gpus)
+are keyed lists, so only the changed hosts and gpus are shipped; any
+other changed value, eg. a process list, is replaced as a whole. The
+same format is applied by `views/index.html`.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+LIST_KEYS = ('hostname', 'index')
+_UNCHANGED = object()
+
+
+def _list_key(items):
+    if not items or not all(isinstance(item, dict) for item in items):
+        return None
+    for key in LIST_KEYS:
+        if all(key in item for item in items):
+            values = [str(item[key]) for item in items]
+            if len(set(values)) == len(values):
+                return key
+    return None
+
+
+def diff(old, new):
+    """
+    Computes the patch from `old` to `new`.
+
+    Returns:
+        dict: the patch, or None if nothing changed
+    """
+
+    patch = _diff(old, new)
+    if patch is _UNCHANGED:
+        return None
+    return patch
+
+
+def _diff(old, new):
+    if isinstance(old, dict) and isinstance(new, dict):
+        patch = {}
+        for name, value in new.items():
+            if name not in old:
+                patch.setdefault('set', {})[name] = value
+                continue
+            sub = _diff(old[name], value)
+            if sub is _UNCHANGED:
+                continue
+            if sub is value:
+                patch.setdefault('set', {})[name] = value
+            else:
+                patch.setdefault('sub', {})[name] = sub
+        unset = [name for name in old if name not in new]
+        if unset:
+            patch['unset'] = unset
+        return patch or _UNCHANGED
+
+    if isinstance(old, list) and isinstance(new, list):
+        key = _list_key(new)
+        if key is not None and key == _list_key(old):
+            olds = {str(item[key]): item for item in old}
+            patch = {'key': key, 'order': [item[key] for item in new]}
+            for item in new:
+                name = str(item[key])
+                if name not in olds:
+                    patch.setdefault('set', {})[name] = item
+                    continue
+                sub = _diff(olds[name], item)
+                if sub is item:
+                    patch.setdefault('set', {})[name] = item
+                elif sub is not _UNCHANGED:
+                    patch.setdefault('sub', {})[name] = sub
+            if ('set' not in patch and 'sub' not in patch and
+                    [str(item[key]) for item in old] ==
+                    [str(item[key]) for item in new]):
+                return _UNCHANGED
+            return patch
+
+    if old == new and type(old) is type(new):
+        return _UNCHANGED
+    # replaced as a whole
+    return new
+
+
+def apply(old, patch):
+    """
+    Applies a patch computed by `diff`.
+
+    Unchanged parts of `old` are shared with the result, not copied.
+
+    Returns:
+        the new value
+    """
+
+    if not patch:
+        return old
+    if 'key' in patch and 'order' in patch:
+        key = patch['key']
+        olds = {str(item[key]): item for item in old or []}
+        new = []
+        for value in patch['order']:
+            name = str(value)
+            if name in patch.get('set', {}):
+                new.append(patch['set'][name])
+            elif name in patch.get('sub', {}):
+                new.append(apply(olds[name], patch['sub'][name]))
+            else:
+                new.append(olds[name])
+        return new
+
+    new = dict(old or {})
+    for name in patch.get('unset', []):
+        new.pop(name, None)
+    new.update(patch.get('set', {}))
+    for name, sub in patch.get('sub', {}).items():
+        new[name] = apply(new.get(name), sub)
+    return new
@@ -0,0 +1,189 @@
+"""
+Hierarchical aggregation of gpuview dashboards.
+
+An aggregator can register other aggregators and pull their
+`/all_gpustat` as sub-trees. Every host entry records how fresh it is at
+each level:
+
+    updated_at  when the aggregator polling the node last got its gpustat
+    via         the aggregators it was pulled through, innermost first:
+                [{'aggregator': id, 'url': url, 'fetched_at': time}, ...]
+
+Entries that passed through this aggregator already are dropped, so two
+aggregators registering each other don't echo their hosts forever, and
+hosts reported by several sub-trees are deduplicated by hostname.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import socket
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+AGGREGATOR_ID = '%s-%s' % (socket.gethostname(), uuid.uuid4().hex[:8])
+
+
+def stamp(gpustats, fetched_at):
+    """
+    Marks the gpustats polled directly from nodes with their fetch time,
+    unless they carry the time of an earlier poll.
+
+    Returns:
+        list: the stamped gpustats
+    """
+
+    stamped = []
+    for gpustat in gpustats:
+        if not gpustat:
+            continue
+        if gpustat.get('stale'):
+            gpustat = dict(gpustat, updated_at=gpustat.get('last_seen'))
+        elif 'updated_at' not in gpustat:
+            gpustat = dict(gpustat, updated_at=fetched_at)
+        stamped.append(gpustat)
+    return stamped
+
+
+def _freshness(gpustat):
+    return (not gpustat.get('stale'), gpustat.get('updated_at') or 0,
+            -len(gpustat.get('via') or []))
+
+
+def dedup(gpustats):
+    """
+    Keeps one entry per hostname: a live one over a stale one, then the
+    most recently updated, then the one reached through fewer levels.
+
+    Returns:
+        list: the deduplicated gpustats, in their first-seen order
+    """
+
+    best = {}
+    order = []
+    for gpustat in gpustats:
+        if not gpustat:
+            continue
+        hostname = gpustat.get('hostname')
+        if hostname not in best:
+            order.append(hostname)
+            best[hostname] = gpustat
+        elif _freshness(gpustat) > _freshness(best[hostname]):
+            best[hostname] = gpustat
+    return [best[hostname] for hostname in order]
+
+
+class SubtreePoller(object):
+    """
+    Pulls the `/all_gpustat` of registered aggregators.
+
+    Args:
+        poller (HostPoller): poller dedicated to aggregators
+        aggregator_id (str): id of this aggregator, for loop detection
+    """
+
+    def __init__(self, poller, aggregator_id=AGGREGATOR_ID):
+        self.poller = poller
+        self.aggregator_id = aggregator_id
+        self._last = {}  # url: (entries, fetched_at)
+        self._status = {}  # url: {'hosts', 'fetched_at', 'error', 'loops'}
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, aggregators):
+        """
+        Polls the aggregators in the background.
+
+        Returns:
+            Future: of the result of `poll`
+        """
+
+        return self._executor.submit(self.poll, aggregators)
+
+    def poll(self, aggregators):
+        """
+        Polls all aggregators once.
+
+        Args:
+            aggregators (dict): {url: name, ... }
+
+        Returns:
+            tuple: (list of host entries of all sub-trees, list of stale
+                aggregator urls). The last known entries of a stale
+                aggregator are included with `stale: True`.
+        """
+
+        entries = []
+        stale = []
+        now = time.time()
+        results = self.poller.gather(
+            aggregators,
+            lambda url: self.poller.fetch_versioned(url, '/all_gpustat'))
+        for url, (payload, error) in results.items():
+            if error is None and not isinstance(payload, dict):
+                error = 'unexpected response'
+            if error is None:
+                subtree, loops = self._subtree(url, payload, now)
+                self._last[url] = (subtree, now)
+                self._status[url] = {'hosts': len(subtree), 'fetched_at': now,
+                                     'error': None, 'loops': loops}
+                entries.extend(subtree)
+                continue
+
+            print('Error: %s getting all_gpustat from aggregator %s' %
+                  (error, url))
+            stale.append(url)
+            subtree, fetched_at = self._last.get(url, ([], None))
+            for entry in subtree:
+                if entry.get('stale'):
+                    entries.append(entry)
+                else:
+                    entries.append(dict(entry, stale=True,
+                                        error='aggregator %s: %s' %
+                                        (aggregators[url], error),
+                                        last_seen=fetched_at))
+            self._status.setdefault(url, {'hosts': 0, 'fetched_at': None,
+                                          'loops': []})['error'] = error
+
+        for url in list(self._last):
+            if url not in aggregators:
+                del self._last[url]
+        for url in list(self._status):
+            if url not in aggregators:
+                del self._status[url]
+        return entries, stale
+
+    def _subtree(self, url, payload, fetched_at):
+        """
+        Returns:
+            tuple: (host entries pulled through this level, hostnames
+                dropped because they came from this aggregator)
+        """
+
+        subtree_id = payload.get('aggregator')
+        loops = []
+        subtree = []
+        for entry in payload.get('gpustats') or []:
+            if not isinstance(entry, dict):
+                continue
+            via = list(entry.get('via') or [])
+            ids = [level.get('aggregator') for level in via] + [subtree_id]
+            if self.aggregator_id in ids:
+                loops.append(entry.get('hostname'))
+                continue
+            via.append({'aggregator': subtree_id, 'url': url,
+                        'fetched_at': fetched_at})
+            subtree.append(dict(entry, via=via))
+        if loops:
+            print('Error: aggregator %s reports %d hosts polled through '
+                  'this one, ignoring them' % (url, len(loops)))
+        return subtree, loops
+
+    def stats(self):
+        """
+        Returns:
+            dict: {url: {'hosts', 'fetched_at', 'error', 'loops'}}
+        """
+
+        return dict((url, dict(status))
+                    for url, status in self._status.items())
@@ -0,0 +1,92 @@
+"""
+Memory-gap change points of gpuview.
+
+A GPU has a "memory gap" when its used memory differs from the sum of the
+memory of its visible processes, typically because a killed process left
+its memory behind. The collector feeds every aggregated snapshot through
+a `MemGapTracker`, which remembers the previous state of each
+(hostname, gpu index) pair and emits an event whenever the gap opens or
+closes. `/find_process` then only has to look up the latest event.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+GAP_THRESHOLD = 400  # MiB
+
+
+def process_memory(processes):
+    return sum(p.get('gpu_memory_usage', 0) or 0 for p in processes)
+
+
+def gpu_gap(gpu):
+    """
+    Returns the absolute difference between the used memory of a gpu and
+    the memory of its processes.
+    """
+
+    processes = gpu.get('processes', [])
+    if not isinstance(processes, list):
+        processes = []
+    return abs((gpu.get('memory.used', 0) or 0) - process_memory(processes))
+
+
+class MemGapTracker(object):
+    """
+    Tracks the memory gap of every (hostname, gpu index) pair across
+    successive snapshots.
+    """
+
+    def __init__(self, threshold=GAP_THRESHOLD):
+        self.threshold = threshold
+        self._last = {}  # (hostname, index): (gap, processes, row_id)
+
+    def observe(self, hoststats, row_id):
+        """
+        Compares a snapshot with the previous one.
+
+        Args:
+            hoststats (list): gpustat of every host, as saved in allgpustats
+            row_id (int): id of the saved snapshot
+
+        Returns:
+            list: events as dicts with hostname, gpu_index, event ('open' or
+                'close'), row_id, last_row_id and the released processes
+        """
+
+        events = []
+        for hostinfo in hoststats or []:
+            if not hostinfo or 'hostname' not in hostinfo:
+                continue
+            hostname = hostinfo['hostname']
+            for position, gpu in enumerate(hostinfo.get('gpus', [])):
+                index = gpu.get('index', position)
+                processes = gpu.get('processes', [])
+                if not isinstance(processes, list):
+                    processes = []
+                gap = gpu_gap(gpu)
+                key = (hostname, index)
+                last = self._last.get(key)
+                self._last[key] = (gap, processes, row_id)
+                if last is None:
+                    continue
+                last_gap, last_processes, last_row_id = last
+                if last_gap < self.threshold and gap > self.threshold:
+                    current_users = {p.get('username') for p in processes}
+                    released_users = {p.get('username')
+                                      for p in last_processes} - current_users
+                    released = [{
+                        'user': p.get('username', '-'),
+                        'process': p.get('command', '-'),
+                        'gpu_memory_usage': p.get('gpu_memory_usage', 0)
+                    } for p in last_processes
+                        if p.get('username') in released_users]
+                    events.append({'hostname': hostname, 'gpu_index': index,
+                                   'event': 'open', 'row_id': last_row_id,
+                                   'last_row_id': row_id,
+                                   'processes': released})
+                elif last_gap > self.threshold and gap < self.threshold:
+                    events.append({'hostname': hostname, 'gpu_index': index,
+                                   'event': 'close', 'row_id': last_row_id,
+                                   'last_row_id': row_id, 'processes': []})
+        return events
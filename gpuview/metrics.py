@@ -0,0 +1,317 @@
+"""
+Prometheus metrics of gpuview.
+
+A small, dependency-free implementation of counters and histograms in the
+Prometheus text format. The hot paths of gpuview observe the metrics
+declared here; `/metrics` renders them with the gpu data of the latest
+snapshot.
+
+Every metric belongs to the process that observes it: 'collector'
+metrics (polling, sampling, database writes) or 'server' metrics
+(requests, database reads). In production mode the collector process
+publishes its rendered metrics for the server workers to serve, and the
+server metrics of the worker answering a scrape carry a `worker` label,
+so that the series of different workers are not mistaken for resets.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value))
+                             for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), side='collector'):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.side = side
+        self._values = {}  # label values: value
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def header(self):
+        return '# HELP %s %s\n# TYPE %s %s\n' % (
+            self.name, self.documentation, self.name, self.kind)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self, extra=()):
+        with self._lock:
+            values = sorted(self._values.items())
+        return self.header() + ''.join(
+            '%s%s %s\n' % (self.name, _labels(self.labelnames, key, extra),
+                           _number(value)) for key, value in values)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), side='collector',
+                 buckets=BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames, side)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # a count per bucket, then the sum
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def render(self, extra=()):
+        extra = list(extra)
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+        lines = [self.header()]
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d\n' % (
+                    self.name, _labels(self.labelnames, key,
+                                       extra + [('le', _number(bound))]),
+                    cumulative))
+            labels = _labels(self.labelnames, key, extra)
+            lines.append('%s_sum%s %s\n' % (self.name, labels,
+                                            _number(counts[-1])))
+            lines.append('%s_count%s %d\n' % (self.name, labels, cumulative))
+        return ''.join(lines)
+
+
+def family(name, documentation, samples, kind='gauge'):
+    """
+    Renders a metric computed at scrape time.
+
+    Args:
+        samples (list): [(labels dict, value), ...], None values are skipped
+    """
+
+    lines = ['# HELP %s %s\n# TYPE %s %s\n' % (name, documentation, name,
+                                                 kind)]
+    for labels, value in samples:
+        if value is None:
+            continue
+        lines.append('%s%s %s\n' % (name, _labels(
+            list(labels), list(labels.values())), _number(value)))
+    return ''.join(lines)
+
+
+def render(side=None, worker=None):
+    """
+    Args:
+        worker: labels every sample with `worker`, eg. the pid of a server
+            worker
+
+    Returns:
+        str: the metrics of one side, or of both
+    """
+
+    extra = [('worker', worker)] if worker is not None else []
+    return ''.join(metric.render(extra) for metric in METRICS
+                   if side is None or metric.side == side)
+
+
+POLL_DURATION = Histogram(
+    'gpuview_poll_duration_seconds',
+    'Time to fetch a route of a polled host or aggregator', ['host'])
+POLL_ERRORS = Counter(
+    'gpuview_poll_errors_total', 'Failed polls of a host or aggregator',
+    ['host'])
+SAMPLE_DURATION = Histogram(
+    'gpuview_sample_duration_seconds', 'Time to sample the gpus of this host')
+COLLECT_DURATION = Histogram(
+    'gpuview_collect_duration_seconds',
+    'Time of one cycle aggregating all hosts')
+DB_WRITE_DURATION = Histogram(
+    'gpuview_db_write_duration_seconds',
+    'Time to write and commit a batch of snapshots')
+DB_READ_DURATION = Histogram(
+    'gpuview_db_read_duration_seconds', 'Time of database reads by query',
+    ['query'], side='server')
+REQUEST_DURATION = Histogram(
+    'gpuview_request_duration_seconds', 'Time to handle a request by route',
+    ['route', 'method', 'status'], side='server')
+
+
+GPU_METRICS = [
+    ('utilization.gpu', 'gpuview_gpu_utilization_percent',
+     'GPU utilization'),
+    ('memory.used', 'gpuview_gpu_memory_used_mebibytes', 'GPU memory used'),
+    ('memory.total', 'gpuview_gpu_memory_total_mebibytes',
+     'GPU memory total'),
+    ('temperature.gpu', 'gpuview_gpu_temperature_celsius',
+     'GPU temperature'),
+    ('power.draw', 'gpuview_gpu_power_draw_watts', 'GPU power draw'),
+]
+
+
+def render_gpustats(gpustats):
+    """
+    Renders the gpu data of an aggregated snapshot.
+    """
+
+    gpus = {}
+    users = []
+    hosts = []
+    for hostinfo in gpustats or []:
+        if not hostinfo or 'hostname' not in hostinfo:
+            continue
+        host = hostinfo['hostname']
+        hosts.append(hostinfo)
+        memory = {}
+        for position, gpu in enumerate(hostinfo.get('gpus') or []):
+            labels = {'host': host, 'gpu': gpu.get('index', position),
+                      'name': gpu.get('name', '')}
+            for key, name, _ in GPU_METRICS:
+                gpus.setdefault(name, []).append((labels, gpu.get(key)))
+            processes = gpu.get('processes')
+            if isinstance(processes, list):
+                for p in processes:
+                    user = p.get('username') or 'Unknown'
+                    memory[user] = memory.get(user, 0) + \
+                        (p.get('gpu_memory_usage') or 0)
+        users.extend(({'host': host, 'user': user}, value)
+                     for user, value in sorted(memory.items()))
+
+    parts = [family(name, documentation, gpus.get(name, []))
+             for _, name, documentation in GPU_METRICS]
+    parts.append(family(
+        'gpuview_user_memory_mebibytes',
+        'GPU memory used by the processes of a user on a host', users))
+    parts.append(family(
+        'gpuview_host_up', 'Whether the last stats of a host are fresh',
+        [({'host': h['hostname']}, 0 if h.get('stale') else 1)
+         for h in hosts]))
+    parts.append(family(
+        'gpuview_host_updated_timestamp_seconds',
+        'When the stats of a host were last fetched',
+        [({'host': h['hostname']}, h.get('updated_at')) for h in hosts]))
+    return ''.join(parts)
+
+
+def render_status(status, snapshots):
+    """
+    Renders the queue depths and sizes of the collector status.
+
+    Args:
+        status (dict): as returned by `app.collector_status`
+        snapshots (dict): {key: Snapshot} of the snapshot cache
+    """
+
+    writer = status.get('writer') or {}
+    # the server pools and streams of a production worker, see `render`
+    worker = {'worker': status['worker']} if status.get('worker') else {}
+    pools = [(side, status.get(key), labels) for side, key, labels in (
+        ('collector', 'storage', {}), ('server', 'server_storage', worker))
+        if status.get(key)]
+    recent = status.get('recent') or {}
+    archived = status.get('archive') or {}
+    ingest = status.get('ingest') or {}
+    push = status.get('push') or {}
+    streams = status.get('streams') or {}
+    published = status.get('snapshot') or {}
+    return ''.join([
+        family('gpuview_snapshot_bytes', 'Size of the serialized snapshots',
+               [({'key': key}, len(snapshot.body))
+                for key, snapshot in sorted(snapshots.items())]),
+        family('gpuview_snapshot_age_seconds',
+               'Time since the collector last published the aggregated '
+               'snapshot', [(worker, published.get('age'))]),
+        family('gpuview_writer_queue_depth',
+               'Snapshots waiting to be written', [({}, writer.get(
+                   'queue_depth'))]),
+        family('gpuview_writer_snapshots_total',
+               'Snapshots by outcome of the write',
+               [({'outcome': outcome}, writer.get(outcome))
+                for outcome in ('written', 'dropped', 'failed')],
+               kind='counter'),
+        family('gpuview_db_pool_connections',
+               'Open database connections by state',
+               [(dict(labels, process=side, state=state), pool.get(state))
+                for side, pool, labels in pools
+                for state in ('in_use', 'idle')]),
+        family('gpuview_db_pool_events_total',
+               'Database connections created, waited for, timed out and '
+               'replaced after a failed health check',
+               [(dict(labels, process=side, event=event), pool.get(event))
+                for side, pool, labels in pools for event in (
+                    'created', 'waits', 'timeouts', 'reconnects')],
+               kind='counter'),
+        family('gpuview_archive_rows_total',
+               'GPU samples exported to the archive before they expired',
+               [({}, archived.get('rows'))], kind='counter'),
+        family('gpuview_recent_memory_bytes',
+               'Memory held by the in-memory recent history',
+               [({}, recent.get('memory_bytes'))]),
+        family('gpuview_sse_streams', 'Dashboards streamed over SSE',
+               [(worker, streams.get('active'))]),
+        family('gpuview_sse_streams_rejected_total',
+               'SSE streams refused because every stream slot was taken',
+               [(worker, streams.get('rejected'))], kind='counter'),
+        family('gpuview_ingest_hosts', 'Hosts pushing their stats',
+               [({}, ingest.get('hosts'))]),
+        family('gpuview_push_snapshots_total',
+               'Snapshots pushed to the aggregator by outcome',
+               [({'outcome': 'pushed'}, push.get('pushed')),
+                ({'outcome': 'failed'}, push.get('failed'))],
+               kind='counter'),
+    ])
@@ -0,0 +1,324 @@
+"""
+Normalized storage of gpuview snapshots.
+
+Instead of one JSON blob per snapshot, every snapshot is split into a
+`snapshots` row and one row per host, gpu and process with numeric
+columns, keyed by (snapshot_id, hostname, gpu_index) and carrying the
+sample time and the position of the host, gpu or process in its list.
+Fields without a dedicated column are kept in a small JSON `extra`
+column, along with the names of the columns that were null and the
+process lists that were empty, so that the `/gpustat` and `/all_gpustat`
+payloads are rebuilt as they were saved, in the same order.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import json
+
+# (payload key, column, type)
+HOST_COLUMNS = [
+    ('driver_version', 'driver_version', 'VARCHAR(32)'),
+    ('query_time', 'query_time', 'VARCHAR(64)'),
+]
+GPU_COLUMNS = [
+    ('uuid', 'uuid', 'VARCHAR(64)'),
+    ('name', 'name', 'VARCHAR(128)'),
+    ('temperature.gpu', 'temperature', 'INT'),
+    ('fan.speed', 'fan_speed', 'INT'),
+    ('utilization.gpu', 'utilization', 'INT'),
+    ('utilization.enc', 'utilization_enc', 'INT'),
+    ('utilization.dec', 'utilization_dec', 'INT'),
+    ('power.draw', 'power_draw', 'INT'),
+    ('enforced.power.limit', 'power_limit', 'INT'),
+    ('memory.used', 'memory_used', 'INT'),
+    ('memory.total', 'memory_total', 'INT'),
+    ('memory', 'memory_pct', 'INT'),
+    ('users', 'users', 'INT'),
+    ('user_processes', 'user_processes', 'TEXT'),
+    ('flag', 'flag', 'VARCHAR(16)'),
+]
+PROCESS_COLUMNS = [
+    ('pid', 'pid', 'INT'),
+    ('username', 'username', 'VARCHAR(64)'),
+    ('command', 'command', 'VARCHAR(255)'),
+    ('gpu_memory_usage', 'gpu_memory_usage', 'INT'),
+    ('cpu_percent', 'cpu_percent', 'FLOAT'),
+    ('cpu_memory_usage', 'cpu_memory_usage', 'BIGINT'),
+]
+NUMERIC_TYPES = ('INT', 'BIGINT', 'FLOAT')
+NULLS = '_null'  # extra key listing the columns that were null
+
+
+def _columns_ddl(columns):
+    return ''.join(',\n    %s %s' % (column, kind)
+                   for _, column, kind in columns)
+
+
+def create_tables(cursor, db_type):
+    """
+    Creates the normalized tables and their indexes if they don't exist.
+    """
+
+    if db_type == 'mysql':
+        key = 'INT AUTO_INCREMENT PRIMARY KEY'
+        name = 'VARCHAR(255)'
+        suffix = ' ENGINE=InnoDB'
+    else:
+        key = 'INTEGER PRIMARY KEY AUTOINCREMENT'
+        name = 'TEXT'
+        suffix = ''
+
+    statements = [
+        'CREATE TABLE IF NOT EXISTS snapshots (\n'
+        '    id %s,\n'
+        '    kind VARCHAR(16) NOT NULL,\n'
+        '    sample_time DOUBLE NOT NULL\n'
+        ')%s' % (key, suffix),
+        'CREATE TABLE IF NOT EXISTS host_samples (\n'
+        '    snapshot_id INT NOT NULL,\n'
+        '    sample_time DOUBLE NOT NULL,\n'
+        '    hostname %s NOT NULL,\n'
+        '    position INT NOT NULL%s,\n'
+        '    extra TEXT\n'
+        ')%s' % (name, _columns_ddl(HOST_COLUMNS), suffix),
+        'CREATE TABLE IF NOT EXISTS gpu_samples (\n'
+        '    snapshot_id INT NOT NULL,\n'
+        '    sample_time DOUBLE NOT NULL,\n'
+        '    hostname %s NOT NULL,\n'
+        '    host_position INT NOT NULL,\n'
+        '    gpu_index INT NOT NULL,\n'
+        '    position INT NOT NULL%s,\n'
+        '    extra TEXT\n'
+        ')%s' % (name, _columns_ddl(GPU_COLUMNS), suffix),
+        'CREATE TABLE IF NOT EXISTS process_samples (\n'
+        '    snapshot_id INT NOT NULL,\n'
+        '    sample_time DOUBLE NOT NULL,\n'
+        '    hostname %s NOT NULL,\n'
+        '    host_position INT NOT NULL,\n'
+        '    gpu_index INT NOT NULL,\n'
+        '    position INT NOT NULL%s,\n'
+        '    extra TEXT\n'
+        ')%s' % (name, _columns_ddl(PROCESS_COLUMNS), suffix),
+    ]
+    indexes = [
+        ('idx_snapshots_kind', 'snapshots', 'kind, id'),
+        ('idx_snapshots_time', 'snapshots', 'sample_time'),
+        ('idx_host_samples_snapshot', 'host_samples', 'snapshot_id'),
+        ('idx_host_samples_host', 'host_samples', 'hostname, sample_time'),
+        ('idx_host_samples_time', 'host_samples', 'sample_time'),
+        ('idx_gpu_samples_snapshot', 'gpu_samples', 'snapshot_id'),
+        ('idx_gpu_samples_host', 'gpu_samples',
+         'hostname, gpu_index, sample_time'),
+        ('idx_gpu_samples_time', 'gpu_samples', 'sample_time'),
+        ('idx_process_samples_snapshot', 'process_samples', 'snapshot_id'),
+        ('idx_process_samples_time', 'process_samples', 'sample_time'),
+        ('idx_process_samples_user', 'process_samples',
+         'username, sample_time'),
+    ]
+    for statement in statements:
+        cursor.execute(statement)
+    for index, table, columns in indexes:
+        if db_type == 'mysql':
+            cursor.execute(
+                'SELECT COUNT(*) FROM information_schema.statistics '
+                'WHERE table_schema = DATABASE() AND table_name = %s '
+                'AND index_name = %s', (table, index))
+            if cursor.fetchone()[0]:
+                continue
+            cursor.execute('CREATE INDEX %s ON %s (%s)' %
+                           (index, table, columns))
+        else:
+            cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' %
+                           (index, table, columns))
+
+
+def _split(item, columns, skip=()):
+    values = []
+    extra = {}
+    nulls = []
+    known = set(skip)
+    for key, _, kind in columns:
+        known.add(key)
+        value = item.get(key)
+        if value is None and key in item:
+            nulls.append(key)
+        elif kind in NUMERIC_TYPES and value is not None and (
+                isinstance(value, bool) or
+                not isinstance(value, (int, float))):
+            extra[key] = value
+            value = None
+        values.append(value)
+    for key, value in item.items():
+        if key not in known:
+            extra[key] = value
+    if nulls:
+        extra[NULLS] = nulls
+    return values, json.dumps(extra, default=str) if extra else None
+
+
+def _insert(cursor, placeholder, table, columns, values):
+    cursor.execute('INSERT INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(columns), ', '.join([placeholder] * len(columns))),
+        values)
+
+
+def _hosts(data):
+    hosts = data if isinstance(data, list) else [data]
+    return [h for h in hosts if h]
+
+
+def insert_snapshot(cursor, db_type, kind, data, sample_time):
+    """
+    Saves a snapshot into the normalized tables.
+
+    Args:
+        kind (str): 'gpustats' (this host) or 'allgpustats' (all hosts)
+        data (dict or list): gpustat of a host, or a list of them
+        sample_time (float): unix timestamp of the snapshot
+
+    Returns:
+        int: id of the snapshot
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    _insert(cursor, placeholder, 'snapshots', ('kind', 'sample_time'),
+            (kind, sample_time))
+    snapshot_id = cursor.lastrowid
+    host_columns = ['snapshot_id', 'sample_time', 'hostname', 'position'] + \
+        [c for _, c, _ in HOST_COLUMNS] + ['extra']
+    gpu_columns = ['snapshot_id', 'sample_time', 'hostname', 'host_position',
+                   'gpu_index', 'position'] + \
+        [c for _, c, _ in GPU_COLUMNS] + ['extra']
+    process_columns = ['snapshot_id', 'sample_time', 'hostname',
+                       'host_position', 'gpu_index', 'position'] + \
+        [c for _, c, _ in PROCESS_COLUMNS] + ['extra']
+    for position, host in enumerate(_hosts(data)):
+        hostname = host.get('hostname', '')
+        values, extra = _split(host, HOST_COLUMNS, skip=('hostname', 'gpus'))
+        if 'gpus' not in host:
+            extra = json.dumps(dict(json.loads(extra or '{}'),
+                                    _no_gpus=True), default=str)
+        _insert(cursor, placeholder, 'host_samples', host_columns,
+                [snapshot_id, sample_time, hostname, position] +
+                values + [extra])
+        for gpu_position, gpu in enumerate(host.get('gpus', [])):
+            gpu_index = gpu.get('index', gpu_position)
+            values, extra = _split(gpu, GPU_COLUMNS,
+                                   skip=('index', 'processes'))
+            processes = gpu.get('processes')
+            if not isinstance(processes, list) or not processes:
+                if 'processes' in gpu:
+                    extra = json.dumps(dict(json.loads(extra or '{}'),
+                                            processes=processes),
+                                       default=str)
+                processes = []
+            _insert(cursor, placeholder, 'gpu_samples', gpu_columns,
+                    [snapshot_id, sample_time, hostname, position,
+                     gpu_index, gpu_position] + values + [extra])
+            for process_position, process in enumerate(processes):
+                values, extra = _split(process, PROCESS_COLUMNS)
+                _insert(cursor, placeholder, 'process_samples',
+                        process_columns,
+                        [snapshot_id, sample_time, hostname, position,
+                         gpu_index, process_position] + values + [extra])
+    return snapshot_id
+
+
+def _build(row, columns, offset):
+    item = {}
+    for i, (key, _, _) in enumerate(columns):
+        value = row[offset + i]
+        if value is not None:
+            item[key] = value
+    extra = row[offset + len(columns)]
+    if extra:
+        item.update(json.loads(extra))
+        for key in item.pop(NULLS, ()):
+            item[key] = None
+    return item
+
+
+def load_snapshot(cursor, db_type, snapshot_id):
+    """
+    Rebuilds the payload of a snapshot from the normalized tables.
+
+    Returns:
+        list: gpustat of every host of the snapshot
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    cursor.execute(
+        'SELECT position, hostname, %s, extra FROM host_samples '
+        'WHERE snapshot_id = %s ORDER BY position' % (
+            ', '.join(c for _, c, _ in HOST_COLUMNS), placeholder),
+        (snapshot_id,))
+    hosts = {}
+    for row in cursor.fetchall():
+        host = {'hostname': row[1]} if row[1] else {}
+        host.update(_build(row, HOST_COLUMNS, 2))
+        if not host.pop('_no_gpus', False):
+            host['gpus'] = []
+        hosts[row[0]] = host
+
+    cursor.execute(
+        'SELECT host_position, gpu_index, %s, extra FROM gpu_samples '
+        'WHERE snapshot_id = %s ORDER BY host_position, position' % (
+            ', '.join(c for _, c, _ in GPU_COLUMNS), placeholder),
+        (snapshot_id,))
+    gpus = {}
+    for row in cursor.fetchall():
+        host = hosts.get(row[0])
+        if host is None or 'gpus' not in host:
+            continue
+        gpu = {'index': row[1]}
+        gpu.update(_build(row, GPU_COLUMNS, 2))
+        host['gpus'].append(gpu)
+        gpus[(row[0], row[1])] = gpu
+
+    cursor.execute(
+        'SELECT host_position, gpu_index, %s, extra FROM process_samples '
+        'WHERE snapshot_id = %s '
+        'ORDER BY host_position, gpu_index, position' % (
+            ', '.join(c for _, c, _ in PROCESS_COLUMNS), placeholder),
+        (snapshot_id,))
+    for row in cursor.fetchall():
+        gpu = gpus.get((row[0], row[1]))
+        if gpu is None:
+            continue
+        if not isinstance(gpu.get('processes'), list):
+            gpu['processes'] = []
+        gpu['processes'].append(_build(row, PROCESS_COLUMNS, 2))
+    return [hosts[position] for position in sorted(hosts)]
+
+
+def load_latest(cursor, db_type, kind):
+    """
+    Rebuilds the latest snapshot of the given kind.
+
+    Returns:
+        list or dict: as it was passed to `insert_snapshot`, or None
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    cursor.execute('SELECT id FROM snapshots WHERE kind = %s '
+                   'ORDER BY id DESC LIMIT 1' % placeholder, (kind,))
+    row = cursor.fetchone()
+    if not row:
+        return None
+    hosts = load_snapshot(cursor, db_type, row[0])
+    if kind == 'gpustats':
+        return hosts[0] if hosts else {}
+    return hosts
+
+
+def delete_before(cursor, db_type, sample_time):
+    """
+    Deletes every normalized row sampled before the given unix timestamp.
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    for table in ('process_samples', 'gpu_samples', 'host_samples',
+                  'snapshots'):
+        cursor.execute('DELETE FROM %s WHERE sample_time < %s' %
+                       (table, placeholder), (sample_time,))
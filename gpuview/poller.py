@@ -0,0 +1,326 @@
+"""
+Concurrent polling of gpuview hosts.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import gzip
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+    from urllib.parse import quote, urlsplit
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
+    from urllib import quote
+    from urlparse import urlsplit
+
+from . import delta
+from . import metrics
+
+
+CONNECT_TIMEOUT = 1.0  # seconds
+READ_TIMEOUT = 2.0  # seconds
+CYCLE_DEADLINE = 2.5  # seconds
+MAX_WORKERS = 32
+MAX_IDLE_CONNECTIONS = 2  # per host
+
+
+def split_url(url):
+    """
+    Splits a registered host url, eg. `X.X.X.X:9988` or
+    `http://X.X.X.X:9988/prefix`, into (scheme, netloc, path).
+    """
+
+    if '://' not in url:
+        url = 'http://' + url
+    parts = urlsplit(url)
+    return parts.scheme, parts.netloc, parts.path.rstrip('/')
+
+
+class HostPoller(object):
+    """
+    Polls the `/gpustat` route of many hosts concurrently.
+
+    Every host gets its own connect and read timeouts and the whole cycle
+    is bounded by a global deadline; hosts that miss it are reported stale
+    and keep their last known stats. A host whose poll is still running
+    after the deadline is not polled again until that poll ends, so slow
+    hosts can't take up every worker. Connections are kept alive and reused
+    across cycles, and responses are requested gzip-compressed. Once a
+    host has reported a version, only the changes since that version are
+    requested.
+
+    With a `PollScheduler`, only the hosts it finds due are polled; the
+    others keep their last stats, stale while their circuit is open.
+    """
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, deadline=CYCLE_DEADLINE,
+                 max_workers=MAX_WORKERS, scheduler=None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+        self.scheduler = scheduler  # PollScheduler, or poll every host
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._last = {}  # url: (gpustat, fetched_at)
+        self._idle = {}  # url: [connection, ...]
+        self._versions = {}  # url: (version, gpustat)
+        self._timeouts = {}  # url: read timeout, set by `poll`
+        self._inflight = {}  # url: future of a poll that missed the deadline
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def close(self):
+        """
+        Stops the polling threads and closes the idle connections.
+        """
+
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _connect(self, url, reuse=True):
+        with self._lock:
+            idle = self._idle.get(url)
+            if idle and reuse:
+                return idle.pop(), True
+        scheme, netloc, _ = split_url(url)
+        connection_class = HTTPSConnection if scheme == 'https' \
+            else HTTPConnection
+        conn = connection_class(netloc, timeout=self.connect_timeout)
+        conn.connect()
+        return conn, False
+
+    def _release(self, url, conn):
+        with self._lock:
+            idle = self._idle.setdefault(url, [])
+            # requests that outlive `close` don't keep their connection
+            if not self._closed and len(idle) < MAX_IDLE_CONNECTIONS:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url, route):
+        with metrics.POLL_DURATION.time(host=url):
+            return self._do_request(url, route)
+
+    def _do_request(self, url, route):
+        _, _, path = split_url(url)
+        reuse = True
+        while True:
+            conn, reused = self._connect(url, reuse)
+            try:
+                conn.sock.settimeout(self._timeouts.get(url,
+                                                        self.read_timeout))
+                conn.request('GET', path + route,
+                             headers={'Accept-Encoding': 'gzip',
+                                      'Connection': 'keep-alive'})
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except Exception:
+                conn.close()
+                if not reused:
+                    raise
+                # the peer may have dropped an idle connection: retry once,
+                # on a new connection
+                reuse = False
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(url, conn)
+        if resp.status != 200:
+            raise IOError('HTTP %s' % resp.status)
+        if resp.getheader('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body, (resp.getheader('ETag') or '').strip('"')
+
+    def fetch(self, url, route='/gpustat'):
+        """
+        Fetches and decodes the json of a route of a host.
+        """
+
+        body, _ = self._request(url, route)
+        return json.loads(body)
+
+    def fetch_gpustat(self, url):
+        """
+        Fetches the gpustat of a host, as a delta against the version
+        fetched last time if the host supports it.
+        """
+
+        return self.fetch_versioned(url, '/gpustat')
+
+    def fetch_versioned(self, url, route):
+        """
+        Fetches a snapshot route of a host, eg. `/gpustat` or
+        `/all_gpustat`, as a delta against the version fetched last time if
+        the host supports it.
+        """
+
+        version, base = self._versions.get(url, (None, None))
+        if version:
+            body, _ = self._request(url, '%s?since=%s' % (route,
+                                                         quote(version)))
+            data = json.loads(body)
+            if 'full' in data:
+                snapshot = data['full']
+            elif 'patch' in data and data.get('base') == version:
+                snapshot = delta.apply(base, data['patch'])
+            else:
+                # a host without delta support ignores `since`
+                self._versions.pop(url, None)
+                return data
+            self._versions[url] = (data['version'], snapshot)
+            return snapshot
+
+        body, etag = self._request(url, route)
+        snapshot = json.loads(body)
+        if etag:
+            self._versions[url] = (etag, snapshot)
+        return snapshot
+
+    def gather(self, urls, fetch):
+        """
+        Calls `fetch(url)` for all urls concurrently, within the deadline.
+
+        Returns:
+            dict: {url: (result, error)}, the error is None on success
+        """
+
+        started = time.time()
+        results = {}
+        futures = {}
+        for url in urls:
+            if url in self._inflight and not self._inflight[url].done():
+                metrics.POLL_ERRORS.inc(host=url)
+                results[url] = (None, 'still polling since an earlier cycle')
+                continue
+            self._inflight.pop(url, None)
+            futures[url] = self._executor.submit(fetch, url)
+        wait(list(futures.values()), timeout=self.deadline)
+
+        for url, future in futures.items():
+            if not future.done():
+                # a poll that didn't start yet is dropped, a running one
+                # keeps its host out of the next cycles until it ends
+                if not future.cancel():
+                    self._inflight[url] = future
+                error = 'timed out after %.1fs' % (time.time() - started)
+            elif future.exception() is not None:
+                exc = future.exception()
+                error = getattr(exc, 'message', str(exc)) or repr(exc)
+            else:
+                results[url] = (future.result(), None)
+                continue
+            metrics.POLL_ERRORS.inc(host=url)
+            results[url] = (None, error)
+        return results
+
+    def poll(self, hosts, intervals=None, timeouts=None):
+        """
+        Polls all hosts once.
+
+        Args:
+            hosts (dict): {url: name, ... } as returned by `load_hosts`
+            intervals (dict): {url: seconds}, hosts polled more recently
+                keep their last stats
+            timeouts (dict): {url: seconds}, read timeouts overriding the
+                poller's
+
+        Returns:
+            tuple: (list of gpustats in host order, list of stale urls).
+                Every gpustat carries the registered `url` it came from.
+                Stale hosts are included with `stale: True` and their last
+                known gpus, if any.
+        """
+
+        now = time.time()
+        intervals = intervals or {}
+        self._timeouts = timeouts or {}
+        # polled within their own interval, allowing for the jitter of the
+        # collector cycle
+        recent = set(url for url in hosts if url in self._last and
+                     now - self._last[url][1] < intervals.get(url, 0) - 0.5)
+        if self.scheduler is not None:
+            due = self.scheduler.due(hosts, now, skip=recent)
+        else:
+            due = [url for url in hosts if url not in recent]
+        results = self.gather(due, self.fetch_gpustat)
+
+        gpustats = []
+        stale = []
+        for url in hosts:
+            if url not in results:
+                # not due: the last stats still stand
+                state = self.scheduler.state(url) \
+                    if self.scheduler is not None else None
+                last, fetched_at = self._last.get(url, (None, None))
+                if state is not None and state.failures:
+                    stale.append(url)
+                    gpustat = dict(last) if last else {'hostname': hosts[url],
+                                                       'url': url, 'gpus': []}
+                    gpustat.update({
+                        'stale': True, 'last_seen': fetched_at,
+                        'error': '%s, retry in %ds' % (
+                            state.error, max(0, state.next_due - time.time()))
+                    })
+                    gpustats.append(gpustat)
+                elif last:
+                    gpustats.append(dict(last, updated_at=fetched_at))
+                continue
+
+            gpustat, error = results[url]
+            if self.scheduler is not None:
+                self.scheduler.record(url, gpustat, error)
+            if error is None:
+                if not gpustat or 'gpus' not in gpustat:
+                    continue
+                # unnamed hosts keep the hostname they report, the url
+                # still ties them to their registry entry
+                gpustat = dict(gpustat, url=url)
+                if hosts[url] != url:
+                    gpustat['hostname'] = hosts[url]
+                self._last[url] = (gpustat, time.time())
+                gpustats.append(gpustat)
+                continue
+
+            print('Error: %s getting gpustat from %s' % (error, url))
+            stale.append(url)
+            last, fetched_at = self._last.get(url, (None, None))
+            gpustat = dict(last) if last else {'hostname': hosts[url],
+                                               'url': url, 'gpus': []}
+            gpustat.update({'stale': True, 'error': error,
+                            'last_seen': fetched_at})
+            gpustats.append(gpustat)
+
+        for url in list(self._last):
+            if url not in hosts:
+                del self._last[url]
+        for url in list(self._versions):
+            if url not in hosts:
+                del self._versions[url]
+        for url in list(self._inflight):
+            if url not in hosts:
+                del self._inflight[url]
+        with self._lock:
+            for url in list(self._idle):
+                if url not in hosts:
+                    for conn in self._idle.pop(url):
+                        conn.close()
+        return gpustats, stale
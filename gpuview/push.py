@@ -0,0 +1,295 @@
+"""
+Push-mode reporting of gpuview nodes.
+
+Instead of being polled, a node can POST its gpustats to an aggregator's
+`/ingest` route on its own schedule. The gpustats reported since the last
+push are sent as one gzip-compressed batch:
+
+    {'hostname': ..., 'snapshots': [{'time': ..., 'gpustat': {...}}, ...]}
+
+and kept for the next push if the aggregator can't be reached. With a
+shared token, the batch is sent with `Authorization: Bearer <token>`.
+
+The aggregator keeps the latest gpustat per host and reports it stale
+once the host stops pushing. Batches no newer than the stored gpustat,
+eg. delayed by a retry, are ignored. The earlier gpustats of a batch,
+buffered by the node while the aggregator was unreachable, are kept as a
+backlog for the history rollups; the live stats and the raw snapshots
+only see the latest one.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import deque
+
+try:
+    from http.client import HTTPConnection, HTTPSConnection
+except ImportError:
+    from httplib import HTTPConnection, HTTPSConnection
+
+from .poller import CONNECT_TIMEOUT, READ_TIMEOUT, split_url
+
+PUSH_INTERVAL = 2.0  # seconds
+MAX_PENDING = 300  # gpustats kept while the aggregator is unreachable
+STALE_TIMEOUT = 10.0  # seconds without a push before a host is stale
+FORGET_AFTER = 86400  # seconds without a push before a host is dropped
+MAX_BACKLOG = 10000  # earlier gpustats of the batches, for the rollups
+COMPRESS_LEVEL = 5
+SPOOL_SUFFIX = '.push'
+
+
+class Pusher(object):
+    """
+    Pushes the gpustats of this node to an aggregator from a thread.
+    """
+
+    def __init__(self, url, interval=PUSH_INTERVAL,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 token=None):
+        self.url = url
+        self.token = token  # shared token of the aggregator, if any
+        self.interval = interval
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._pending = deque(maxlen=MAX_PENDING)  # (time, gpustat)
+        self._lock = threading.Lock()
+        self.pushed = 0
+        self.failed = 0
+        self.last_error = None
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def put(self, gpustat, sample_time=None):
+        with self._lock:
+            self._pending.append((time.time() if sample_time is None
+                                  else sample_time, gpustat))
+
+    def run(self):
+        while True:
+            started = time.time()
+            self.push()
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def push(self):
+        """
+        Sends the pending gpustats as one batch.
+
+        Returns:
+            bool: False if the aggregator couldn't be reached
+        """
+
+        with self._lock:
+            batch = list(self._pending)
+            self._pending.clear()
+        if not batch:
+            return True
+        try:
+            self._post(batch)
+        except Exception as e:
+            self.failed += 1
+            self.last_error = getattr(e, 'message', str(e)) or repr(e)
+            print('Error: %s pushing to %s' % (self.last_error, self.url))
+            with self._lock:
+                # retry with the next batch, newest gpustats win the room
+                self._pending.extendleft(reversed(batch))
+                while len(self._pending) > MAX_PENDING:
+                    self._pending.popleft()
+            return False
+        self.pushed += len(batch)
+        self.last_error = None
+        return True
+
+    def _post(self, batch):
+        scheme, netloc, path = split_url(self.url)
+        body = gzip.compress(json.dumps({
+            'hostname': batch[-1][1].get('hostname'),
+            'snapshots': [{'time': t, 'gpustat': g} for t, g in batch],
+        }, default=str).encode('utf-8'), compresslevel=COMPRESS_LEVEL)
+        connection_class = HTTPSConnection if scheme == 'https' \
+            else HTTPConnection
+        conn = connection_class(netloc, timeout=self.connect_timeout)
+        try:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+            headers = {'Content-Type': 'application/json',
+                       'Content-Encoding': 'gzip'}
+            if self.token:
+                headers['Authorization'] = 'Bearer %s' % self.token
+            conn.request('POST', path + '/ingest', body=body,
+                         headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise IOError('HTTP %s' % resp.status)
+
+
+def decode_batch(body, encoding=None):
+    """
+    Decodes and validates a pushed batch.
+
+    Returns:
+        tuple: (hostname, [(time, gpustat), ...])
+    """
+
+    if encoding == 'gzip':
+        body = gzip.decompress(body)
+    batch = json.loads(body.decode('utf-8'))
+    snapshots = []
+    for snapshot in batch.get('snapshots') or []:
+        gpustat = snapshot.get('gpustat')
+        if isinstance(gpustat, dict) and 'gpus' in gpustat:
+            snapshots.append((float(snapshot.get('time') or 0), gpustat))
+    hostname = batch.get('hostname')
+    if not hostname or not snapshots:
+        raise ValueError('empty batch')
+    return hostname, snapshots
+
+
+class IngestStore(object):
+    """
+    Latest pushed gpustat per host, shared by the request threads.
+
+    Args:
+        timeout (float): seconds without a push before a host is stale
+    """
+
+    def __init__(self, timeout=STALE_TIMEOUT):
+        self.timeout = timeout
+        self._hosts = {}  # hostname: (gpustat, received_at, remote)
+        self._times = {}  # hostname: sample time of the stored gpustat
+        self._backlog = deque(maxlen=MAX_BACKLOG)  # (time, gpustat)
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.snapshots = 0
+        self.ignored = 0  # snapshots no newer than the stored gpustat
+
+    def ingest(self, hostname, snapshots, remote=None, received_at=None):
+        """
+        Stores the latest gpustat of a batch, and queues its earlier
+        gpustats for `backlog`.
+
+        Returns:
+            int: number of snapshots newer than the stored gpustat
+        """
+
+        received_at = time.time() if received_at is None else received_at
+        with self._lock:
+            last = self._times.get(hostname)
+            fresh = sorted((s for s in snapshots
+                            if last is None or s[0] > last),
+                           key=lambda s: s[0])
+            self.batches += 1
+            self.snapshots += len(fresh)
+            self.ignored += len(snapshots) - len(fresh)
+            if not fresh:
+                return 0
+            for sample_time, gpustat in fresh[:-1]:
+                self._backlog.append((sample_time,
+                                      dict(gpustat, hostname=hostname)))
+            sample_time, gpustat = fresh[-1]
+            self._hosts[hostname] = (dict(gpustat, hostname=hostname),
+                                     received_at, remote)
+            self._times[hostname] = sample_time
+        return len(fresh)
+
+    def backlog(self):
+        """
+        Returns and forgets the earlier gpustats of the batches ingested
+        so far.
+
+        Returns:
+            list: [(time, gpustat), ...] in time order
+        """
+
+        with self._lock:
+            backlog = sorted(self._backlog, key=lambda s: s[0])
+            self._backlog.clear()
+        return backlog
+
+    def gpustats(self, now=None):
+        """
+        Returns:
+            list: the latest gpustat of every pushing host, stamped with
+                `updated_at`; hosts silent for longer than the timeout are
+                marked stale
+        """
+
+        now = time.time() if now is None else now
+        gpustats = []
+        with self._lock:
+            for hostname, (gpustat, received_at, remote) in \
+                    list(self._hosts.items()):
+                if now - received_at > FORGET_AFTER:
+                    del self._hosts[hostname]
+                    del self._times[hostname]
+                    continue
+                gpustat = dict(gpustat, updated_at=received_at, pushed=True)
+                if now - received_at > self.timeout:
+                    gpustat.update({'stale': True, 'last_seen': received_at,
+                                    'error': 'no push for %ds' %
+                                    (now - received_at)})
+                gpustats.append(gpustat)
+        return gpustats
+
+    def stats(self):
+        with self._lock:
+            return {'hosts': len(self._hosts), 'batches': self.batches,
+                    'snapshots': self.snapshots, 'ignored': self.ignored,
+                    'backlog': len(self._backlog), 'timeout': self.timeout}
+
+    def spool(self, path, hostname, snapshots, remote=None):
+        """
+        Hands a batch received by a server worker to the collector process
+        through the shared directory.
+        """
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        fd, tmp = tempfile.mkstemp(dir=path, prefix='.ingest')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'hostname': hostname, 'remote': remote,
+                       'received_at': time.time(),
+                       'snapshots': [{'time': t, 'gpustat': g}
+                                     for t, g in snapshots]}, f, default=str)
+        os.rename(tmp, os.path.join(path, tmp.rsplit(os.sep, 1)[-1][1:] +
+                                    SPOOL_SUFFIX))
+
+    def load_spool(self, path):
+        """
+        Ingests the batches spooled by the server workers, oldest first.
+
+        Returns:
+            int: number of batches ingested
+        """
+
+        if not os.path.isdir(path):
+            return 0
+        names = [name for name in os.listdir(path)
+                 if name.endswith(SPOOL_SUFFIX)]
+        spooled = []
+        for name in names:
+            filename = os.path.join(path, name)
+            try:
+                with open(filename) as f:
+                    batch = json.load(f)
+                os.remove(filename)
+            except (IOError, OSError, ValueError):
+                continue
+            spooled.append(batch)
+        for batch in sorted(spooled, key=lambda b: b['received_at']):
+            self.ingest(batch['hostname'],
+                        [(s['time'], s['gpustat'])
+                         for s in batch['snapshots']],
+                        batch.get('remote'), batch['received_at'])
+        return len(spooled)
@@ -0,0 +1,258 @@
+"""
+Filters and projections of the gpustat snapshots.
+
+Machine clients, eg. schedulers looking for free gpus, can ask
+`/all_gpustat` and `/gpustat` for part of a snapshot with query
+parameters:
+
+    host=a,b*           hosts by name, shell patterns allowed
+    label=rack=r1       registered hosts with the label, matched by name
+                        or by the url they were polled from
+    gpu=0,1             gpus by index
+    fields=a,b          gpu fields to return, `index` is always returned
+    free=1              idle gpus of fresh hosts only: no processes, at
+                        most `FREE_MEMORY` MiB used and `FREE_UTILIZATION`
+                        percent busy
+    min_free_memory=N   gpus with at least N MiB of memory free
+    max_utilization=N   gpus at most N percent busy
+    stale=0             leave out the hosts whose stats are stale
+    processes=0         leave out the process lists
+
+`host`, `label` and `gpu` may be repeated. With a gpu filter, hosts left
+without gpus are left out of `/all_gpustat`; `/gpustat` takes the gpu
+filters, `fields` and `processes` only. The filters read the data of
+the published snapshot as it is, and the filtered body is cached on the
+snapshot, so clients polling with the same query share one result per
+cycle.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import fnmatch
+import zlib
+
+FREE_MEMORY = 100  # MiB, the context of an idle process fits
+FREE_UTILIZATION = 5  # percent
+PARAMS = ('host', 'label', 'gpu', 'fields', 'free', 'min_free_memory',
+          'max_utilization', 'stale', 'processes')
+TRUE = ('1', 'true', 'yes', 'on')
+FALSE = ('0', 'false', 'no', 'off')
+
+
+def _split(values):
+    return [v.strip() for value in values for v in value.split(',')
+            if v.strip()]
+
+
+def _flag(args, name, default):
+    value = args.get(name)
+    if value is None or value == '':
+        return default
+    if value.lower() in TRUE:
+        return True
+    if value.lower() in FALSE:
+        return False
+    raise ValueError('%s must be 0 or 1' % name)
+
+
+def _number(args, name):
+    value = args.get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('%s must be a number' % name)
+
+
+class GpuQuery(object):
+    """
+    A filter and projection of gpustat data.
+
+    Args:
+        hosts (list): hostnames or shell patterns
+        labels (dict): {key: value} the registered hosts must have
+        gpus (list): gpu indexes
+        fields (list): gpu fields to keep, None for all
+    """
+
+    def __init__(self, hosts=(), labels=None, gpus=None, fields=None,
+                 free=False, min_free_memory=None, max_utilization=None,
+                 stale=True, processes=True):
+        self.hosts = list(hosts)
+        self.labels = dict(labels or {})
+        self.gpus = set(gpus) if gpus is not None else None
+        self.fields = list(fields) if fields is not None else None
+        if self.fields is not None and 'index' not in self.fields:
+            self.fields.insert(0, 'index')
+        self.free = free
+        self.min_free_memory = min_free_memory
+        self.max_utilization = max_utilization
+        if free:
+            self.max_utilization = FREE_UTILIZATION \
+                if max_utilization is None \
+                else min(max_utilization, FREE_UTILIZATION)
+        self.stale = stale and not free
+        self.processes = processes
+        self.key = repr((sorted(self.hosts), sorted(self.labels.items()),
+                         sorted(self.gpus) if self.gpus is not None
+                         else None, self.fields, free, min_free_memory,
+                         self.max_utilization, self.stale, processes))
+        self.labelled = set()  # names and urls of the labelled hosts
+
+    @classmethod
+    def from_args(cls, args):
+        """
+        Parses the query parameters of a request.
+
+        Returns:
+            GpuQuery: or None if the request has none of them
+
+        Raises:
+            ValueError: if a parameter is invalid
+        """
+
+        if not any(name in args for name in PARAMS):
+            return None
+        labels = {}
+        for value in _split(args.getlist('label')):
+            key, sep, label = value.partition('=')
+            if not sep or not key.strip():
+                raise ValueError('label %r is not key=value' % value)
+            labels[key.strip()] = label.strip()
+        gpus = _split(args.getlist('gpu'))
+        try:
+            gpus = [int(index) for index in gpus] if gpus else None
+        except ValueError:
+            raise ValueError('gpu must be a list of indexes')
+        fields = _split(args.getlist('fields'))
+        return cls(hosts=_split(args.getlist('host')), labels=labels,
+                   gpus=gpus, fields=fields or None,
+                   free=_flag(args, 'free', False),
+                   min_free_memory=_number(args, 'min_free_memory'),
+                   max_utilization=_number(args, 'max_utilization'),
+                   stale=_flag(args, 'stale', True),
+                   processes=_flag(args, 'processes', True))
+
+    def resolve(self, registry):
+        """
+        Looks up the registered hosts with the labels of the query.
+        """
+
+        if self.labels:
+            self.labelled = labelled_hosts(registry.entries(), self.labels)
+            # the same query selects other hosts once the registry changed
+            self.key += ' hosts %s' % registry.version
+
+    @property
+    def filters_gpus(self):
+        return self.gpus is not None or self.free or \
+            self.min_free_memory is not None or \
+            self.max_utilization is not None
+
+    def etag(self, etag):
+        """
+        Returns:
+            str: the etag of this query's view of a snapshot
+        """
+
+        return '%s-q%08x' % (etag, zlib.crc32(self.key.encode('utf-8')))
+
+    def match_host(self, hostinfo):
+        if not self.stale and hostinfo.get('stale'):
+            return False
+        hostname = hostinfo.get('hostname', '')
+        if self.hosts and not any(fnmatch.fnmatchcase(hostname, pattern)
+                                  for pattern in self.hosts):
+            return False
+        # a host registered without a name reports its own hostname
+        return not self.labels or hostname in self.labelled or \
+            hostinfo.get('url') in self.labelled
+
+    def match_gpu(self, position, gpu):
+        if self.gpus is not None and gpu.get('index', position) \
+                not in self.gpus:
+            return False
+        used = gpu.get('memory.used')
+        # outside the safe zone `processes` is left out, `users` still
+        # counts the users running processes
+        if self.free and (used is None or used > FREE_MEMORY or
+                          gpu.get('processes') or gpu.get('users')):
+            return False
+        if self.min_free_memory is not None:
+            total = gpu.get('memory.total')
+            if total is None or used is None or \
+                    total - used < self.min_free_memory:
+                return False
+        if self.max_utilization is not None:
+            utilization = gpu.get('utilization.gpu')
+            if utilization is not None and \
+                    utilization > self.max_utilization:
+                return False
+        return True
+
+    def project_gpu(self, gpu):
+        if self.fields is not None:
+            gpu = dict((name, gpu[name]) for name in self.fields
+                       if name in gpu and
+                       (self.processes or name != 'processes'))
+        elif not self.processes and 'processes' in gpu:
+            gpu = dict(gpu)
+            del gpu['processes']
+        return gpu
+
+    def host(self, hostinfo):
+        """
+        Returns:
+            dict: the host with its gpus filtered and projected
+        """
+
+        if not self.filters_gpus and self.fields is None and \
+                self.processes:
+            return hostinfo
+        gpus = [self.project_gpu(gpu)
+                for position, gpu in enumerate(hostinfo.get('gpus') or [])
+                if self.match_gpu(position, gpu)]
+        return dict(hostinfo, gpus=gpus)
+
+    def gpustats(self, gpustats):
+        """
+        Returns:
+            list: the matching hosts, filtered and projected
+        """
+
+        hosts = []
+        for hostinfo in gpustats or []:
+            if not hostinfo or not self.match_host(hostinfo):
+                continue
+            hostinfo = self.host(hostinfo)
+            if self.filters_gpus and not hostinfo.get('gpus'):
+                continue
+            hosts.append(hostinfo)
+        return hosts
+
+    def all_gpustat(self, payload):
+        """
+        Returns:
+            dict: an `/all_gpustat` payload with the matching hosts only
+        """
+
+        gpustats = self.gpustats(payload.get('gpustats'))
+        return dict(payload, gpustats=gpustats,
+                    stale=[g.get('hostname') for g in gpustats
+                           if g.get('stale')])
+
+
+def labelled_hosts(entries, labels):
+    """
+    Returns:
+        set: names and urls of the registry entries with all the labels
+    """
+
+    hosts = set()
+    for entry in entries:
+        if all(entry['labels'].get(key) == value
+               for key, value in labels.items()):
+            hosts.update((entry['name'], entry['url']))
+    return hosts
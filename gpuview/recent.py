@@ -0,0 +1,318 @@
+"""
+In-memory store of the recent history of gpuview.
+
+Every aggregated snapshot is appended to fixed-size ring buffers, one
+`array` of timestamps and one per metric for each gpu, so the recent
+window costs a predictable amount of memory and is queried without
+touching the database. Processes are kept as one slotted record per
+(host, gpu, pid) with the time they were first and last seen.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import math
+import sys
+import threading
+import time
+from array import array
+
+WINDOW = 3600  # seconds of history kept
+MAX_PROCESSES = 10000
+METRICS = ('utilization.gpu', 'memory.used', 'temperature.gpu', 'power.draw')
+EVICT_INTERVAL = 60  # seconds between evictions of hosts and processes
+NAN = float('nan')
+
+
+class _Series(object):
+    """
+    Ring buffer of the samples of one gpu.
+    """
+
+    __slots__ = ('times', 'values', 'head', 'size')
+
+    def __init__(self, capacity):
+        self.times = array('d', [0.0]) * capacity
+        self.values = tuple(array('f', [NAN]) * capacity for _ in METRICS)
+        self.head = 0
+        self.size = 0
+
+    def append(self, sample_time, values):
+        i = self.head
+        self.times[i] = sample_time
+        for column, value in zip(self.values, values):
+            column[i] = value
+        capacity = len(self.times)
+        self.head = (i + 1) % capacity
+        self.size = min(self.size + 1, capacity)
+
+    def last_time(self):
+        return self.times[self.head - 1] if self.size else 0.0
+
+    def positions(self, start, end):
+        """
+        Yields the positions of the samples in [start, end), oldest first.
+        """
+
+        capacity = len(self.times)
+        first = (self.head - self.size) % capacity
+        for k in range(self.size):
+            i = (first + k) % capacity
+            if start <= self.times[i] < end:
+                yield i
+
+
+class ProcessRecord(object):
+    """
+    A process seen on a gpu in the recent window.
+    """
+
+    __slots__ = ('hostname', 'gpu_index', 'pid', 'username', 'command',
+                 'gpu_memory_usage', 'first_seen', 'last_seen')
+
+    def __init__(self, hostname, gpu_index, pid, username, command,
+                 gpu_memory_usage, sample_time):
+        self.hostname = hostname
+        self.gpu_index = gpu_index
+        self.pid = pid
+        self.username = username
+        self.command = command
+        self.gpu_memory_usage = gpu_memory_usage  # peak, in MB
+        self.first_seen = sample_time
+        self.last_seen = sample_time
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class RecentStore(object):
+    """
+    Thread-safe store of the last `window` seconds of aggregated snapshots.
+
+    Args:
+        window (float): seconds of history kept
+        interval (float): seconds between snapshots, sizes the buffers
+        max_processes (int): process records kept, the least recently
+            seen are dropped first
+    """
+
+    def __init__(self, window=WINDOW, interval=2,
+                 max_processes=MAX_PROCESSES):
+        self.window = window
+        self.interval = interval
+        self.capacity = max(1, int(math.ceil(float(window) / interval)))
+        self.max_processes = max_processes
+        self._series = {}  # (hostname, gpu index): _Series
+        self._processes = {}  # (hostname, gpu index, pid): ProcessRecord
+        self._lock = threading.Lock()
+        self._evicted = 0
+
+    def observe(self, hoststats, sample_time=None):
+        """
+        Appends an aggregated snapshot; stale hosts are skipped.
+        """
+
+        sample_time = time.time() if sample_time is None else sample_time
+        with self._lock:
+            for hostinfo in hoststats or []:
+                if not isinstance(hostinfo, dict) or \
+                        'hostname' not in hostinfo or hostinfo.get('stale'):
+                    continue
+                hostname = hostinfo['hostname']
+                for position, gpu in enumerate(hostinfo.get('gpus', [])):
+                    index = gpu.get('index', position)
+                    series = self._series.get((hostname, index))
+                    if series is None:
+                        series = _Series(self.capacity)
+                        self._series[(hostname, index)] = series
+                    series.append(sample_time, [
+                        NAN if gpu.get(metric) is None else gpu[metric]
+                        for metric in METRICS])
+                    processes = gpu.get('processes')
+                    if isinstance(processes, list):
+                        self._observe_processes(hostname, index, processes,
+                                                sample_time)
+            if sample_time - self._evicted >= EVICT_INTERVAL:
+                self._evict(sample_time - self.window)
+                self._evicted = sample_time
+
+    def _observe_processes(self, hostname, index, processes, sample_time):
+        for p in processes:
+            key = (hostname, index, p.get('pid'))
+            record = self._processes.get(key)
+            memory = p.get('gpu_memory_usage') or 0
+            if record is None:
+                self._processes[key] = ProcessRecord(
+                    hostname, index, p.get('pid'), p.get('username'),
+                    p.get('command'), memory, sample_time)
+                continue
+            record.last_seen = sample_time
+            record.gpu_memory_usage = max(record.gpu_memory_usage, memory)
+
+    def _evict(self, cutoff):
+        for key, series in list(self._series.items()):
+            if series.last_time() < cutoff:
+                del self._series[key]
+        for key, record in list(self._processes.items()):
+            if record.last_seen < cutoff:
+                del self._processes[key]
+        overflow = len(self._processes) - self.max_processes
+        if overflow > 0:
+            oldest = sorted(self._processes.items(),
+                            key=lambda item: item[1].last_seen)[:overflow]
+            for key, _ in oldest:
+                del self._processes[key]
+
+    def oldest(self):
+        """
+        Returns:
+            float: time of the oldest sample held, or None if empty
+        """
+
+        with self._lock:
+            times = [series.times[(series.head - series.size) %
+                                  len(series.times)]
+                     for series in self._series.values() if series.size]
+        return min(times) if times else None
+
+    def covers(self, start):
+        """
+        Returns:
+            bool: True if the store holds the history since `start`
+        """
+
+        oldest = self.oldest()
+        return oldest is not None and oldest <= start + self.interval
+
+    def window_points(self, hostname, gpu_index, metric, start, end=None):
+        """
+        Returns:
+            list: [time, value] of a gpu metric in [start, end)
+        """
+
+        end = time.time() + 1 if end is None else end
+        column = METRICS.index(metric)
+        with self._lock:
+            series = self._series.get((hostname, gpu_index))
+            if series is None:
+                return []
+            values = series.values[column]
+            return [[series.times[i], values[i]]
+                    for i in series.positions(start, end)
+                    if not math.isnan(values[i])]
+
+    def aggregate(self, metric, hostname, start, end, bucket, gpu_index=None):
+        """
+        Aggregates a metric of a gpu, or of all gpus of a host, into buckets,
+        like `rollup.query_history`.
+
+        Returns:
+            list: [bucket start, min, mean, max] per bucket
+        """
+
+        column = METRICS.index(metric)
+        buckets = {}
+        with self._lock:
+            for (host, index), series in self._series.items():
+                if host != hostname or \
+                        (gpu_index is not None and index != gpu_index):
+                    continue
+                values = series.values[column]
+                for i in series.positions(start, end):
+                    value = values[i]
+                    if math.isnan(value):
+                        continue
+                    t = int(series.times[i])
+                    key = t - t % bucket
+                    agg = buckets.get(key)
+                    if agg is None:
+                        buckets[key] = [value, value, value, 1]
+                    else:
+                        agg[0] = min(agg[0], value)
+                        agg[1] += value
+                        agg[2] = max(agg[2], value)
+                        agg[3] += 1
+        return [[key, agg[0], round(agg[1] / agg[3], 2), agg[2]]
+                for key, agg in sorted(buckets.items())]
+
+    def sparklines(self, metric, seconds=600, points=60, now=None):
+        """
+        Downsamples the last `seconds` of a metric of every gpu to `points`
+        bucket means, None where there were no samples.
+
+        Returns:
+            dict: {hostname: {gpu index: [value, ...]}}
+        """
+
+        now = time.time() if now is None else now
+        start = now - seconds
+        step = float(seconds) / points
+        column = METRICS.index(metric)
+        lines = {}
+        with self._lock:
+            for (hostname, index), series in self._series.items():
+                sums = [0.0] * points
+                counts = [0] * points
+                values = series.values[column]
+                for i in series.positions(start, now + 1):
+                    if math.isnan(values[i]):
+                        continue
+                    k = min(points - 1, int((series.times[i] - start) / step))
+                    sums[k] += values[i]
+                    counts[k] += 1
+                lines.setdefault(hostname, {})[index] = [
+                    round(s / c, 1) if c else None
+                    for s, c in zip(sums, counts)]
+        return lines
+
+    def processes(self, hostname=None, since=None):
+        """
+        Returns:
+            list: the processes seen on a host, or on all hosts, since a
+                time, most recently seen first
+        """
+
+        with self._lock:
+            records = [record.to_dict() for record in
+                       self._processes.values()
+                       if (hostname is None or record.hostname == hostname)
+                       and (since is None or record.last_seen >= since)]
+        return sorted(records, key=lambda r: -r['last_seen'])
+
+    def memory_bytes(self):
+        """
+        Returns:
+            int: approximate memory held by the store, in bytes
+        """
+
+        with self._lock:
+            size = sys.getsizeof(self._series) + \
+                sys.getsizeof(self._processes)
+            for series in self._series.values():
+                size += sys.getsizeof(series) + \
+                    sys.getsizeof(series.times) + \
+                    sum(sys.getsizeof(column) for column in series.values)
+            for record in self._processes.values():
+                size += sys.getsizeof(record) + \
+                    sys.getsizeof(record.username) + \
+                    sys.getsizeof(record.command)
+        return size
+
+    def stats(self):
+        """
+        Returns:
+            dict: size and memory footprint of the store
+        """
+
+        with self._lock:
+            gpus = len(self._series)
+            samples = sum(series.size for series in self._series.values())
+            processes = len(self._processes)
+        return {
+            'window': self.window,
+            'capacity': self.capacity,
+            'gpus': gpus,
+            'samples': samples,
+            'processes': processes,
+            'memory_bytes': self.memory_bytes(),
+        }
@@ -0,0 +1,413 @@
+"""
+Registry of the hosts polled by a gpuview aggregator.
+
+The hosts are stored in the `hosts` table of the stats database, with
+their metadata:
+
+    labels      {key: value}, to group and filter hosts
+    interval    minimum seconds between two polls, None for every cycle
+    timeout     read timeout in seconds, None for the poller's default
+
+Every change bumps a version number in the same transaction. The registry
+keeps the hosts in memory and reloads them only when the version changed,
+checked at most once every `check_interval` seconds, so hosts added from
+the CLI or another server process are picked up without a restart. The
+hosts in memory are replaced as a whole, never changed in place, so
+readers can iterate them while hosts are added or removed.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import json
+import os
+import threading
+import time
+
+from .storage import ConnectionPool
+
+KINDS = ('node', 'aggregator')
+FIELDS = ('name', 'kind', 'labels', 'interval', 'timeout')
+CHECK_INTERVAL = 2.0  # seconds
+
+
+def _schema(db_type):
+    if db_type == 'mysql':
+        return [
+            '''
+            CREATE TABLE IF NOT EXISTS hosts (
+                url VARCHAR(255) PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                kind VARCHAR(16) NOT NULL DEFAULT 'node',
+                labels TEXT,
+                poll_interval DOUBLE,
+                timeout DOUBLE,
+                updated_at DOUBLE NOT NULL
+            ) ENGINE=InnoDB
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS hosts_version (
+                id INT PRIMARY KEY,
+                version BIGINT NOT NULL
+            ) ENGINE=InnoDB
+            ''',
+            'INSERT IGNORE INTO hosts_version (id, version) VALUES (1, 0)',
+        ]
+    return [
+        '''
+        CREATE TABLE IF NOT EXISTS hosts (
+            url TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'node',
+            labels TEXT,
+            poll_interval REAL,
+            timeout REAL,
+            updated_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS hosts_version (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+        ''',
+        'INSERT OR IGNORE INTO hosts_version (id, version) VALUES (1, 0)',
+    ]
+
+
+def parse_labels(values):
+    """
+    Parses `key=value` strings, eg. from the command line.
+
+    Returns:
+        dict: {key: value}
+    """
+
+    labels = {}
+    for value in values or []:
+        key, sep, label = value.partition('=')
+        if not sep or not key.strip():
+            raise ValueError('label %r is not key=value' % value)
+        labels[key.strip()] = label.strip()
+    return labels
+
+
+def _validate(fields):
+    if 'kind' in fields and fields['kind'] not in KINDS:
+        raise ValueError('kind must be one of %s' % ', '.join(KINDS))
+    if 'name' in fields and not fields['name']:
+        raise ValueError('name must not be empty')
+    labels = fields.get('labels')
+    if labels is not None and (not isinstance(labels, dict) or not all(
+            isinstance(v, str) for v in labels.values())):
+        raise ValueError('labels must map keys to strings')
+    for key in ('interval', 'timeout'):
+        value = fields.get(key)
+        if value is not None:
+            value = fields[key] = float(value)
+            if value <= 0:
+                raise ValueError('%s must be positive' % key)
+
+
+class HostRegistry(object):
+    """
+    Cached view of the `hosts` table.
+
+    Args:
+        connect (callable): returns a new connection to the stats database
+        db_type (str): 'sqlite' or 'mysql'
+    """
+
+    def __init__(self, connect, db_type='sqlite',
+                 check_interval=CHECK_INTERVAL):
+        self._connect = connect
+        self.db_type = db_type
+        self.check_interval = check_interval
+        self.placeholder = '%s' if db_type == 'mysql' else '?'
+        self._hosts = None  # url: entry
+        self._version = None
+        self._checked = 0
+        self._created = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def sqlite(cls, path, **kwargs):
+        return cls(ConnectionPool.sqlite(path, size=2).connection, 'sqlite',
+                   **kwargs)
+
+    def _transaction(self, work):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            if not self._created:
+                for statement in _schema(self.db_type):
+                    cursor.execute(statement)
+                self._created = True
+            result = work(cursor)
+            conn.commit()
+            return result
+        finally:
+            conn.close()
+
+    def _read_version(self, cursor):
+        cursor.execute('SELECT version FROM hosts_version WHERE id = 1')
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _bump(self, cursor):
+        cursor.execute('UPDATE hosts_version SET version = version + 1 '
+                       'WHERE id = 1')
+        return self._read_version(cursor)
+
+    def _load(self, cursor):
+        cursor.execute('SELECT url, name, kind, labels, poll_interval, '
+                       'timeout FROM hosts')
+        hosts = {}
+        for url, name, kind, labels, interval, timeout in cursor.fetchall():
+            hosts[url] = {'url': url, 'name': name, 'kind': kind,
+                          'labels': json.loads(labels) if labels else {},
+                          'interval': interval, 'timeout': timeout}
+        return hosts
+
+    def refresh(self, force=False):
+        """
+        Reloads the hosts if they changed since they were last loaded.
+        """
+
+        now = time.time()
+        with self._lock:
+            if not force and self._hosts is not None and \
+                    now - self._checked < self.check_interval:
+                return
+
+            def work(cursor):
+                version = self._read_version(cursor)
+                if force or self._hosts is None or version != self._version:
+                    self._hosts = self._load(cursor)
+                    self._version = version
+
+            self._transaction(work)
+            self._checked = now
+
+    @property
+    def version(self):
+        self.refresh()
+        return self._version
+
+    def _current(self):
+        self.refresh()
+        with self._lock:
+            return self._hosts
+
+    def hosts(self, kind='node'):
+        """
+        Args:
+            kind (str): 'node', 'aggregator', or None for both
+
+        Returns:
+            dict: {url: name, ... }
+        """
+
+        return dict((url, host['name'])
+                    for url, host in self._current().items()
+                    if kind is None or host['kind'] == kind)
+
+    def entries(self, kind=None):
+        """
+        Returns:
+            list: the hosts with their metadata, sorted by name
+        """
+
+        return sorted((dict(host, labels=dict(host['labels']))
+                       for host in self._current().values()
+                       if kind is None or host['kind'] == kind),
+                      key=lambda h: (h['kind'], h['name'], h['url']))
+
+    def get(self, url):
+        host = self._current().get(url)
+        return dict(host, labels=dict(host['labels'])) if host else None
+
+    def _settings(self, key):
+        return dict((url, host[key]) for url, host in self._current().items()
+                    if host[key] is not None)
+
+    def intervals(self):
+        """
+        Returns:
+            dict: {url: minimum seconds between polls} of the hosts that
+                set one
+        """
+
+        return self._settings('interval')
+
+    def timeouts(self):
+        """
+        Returns:
+            dict: {url: read timeout} of the hosts that set one
+        """
+
+        return self._settings('timeout')
+
+    def _write(self, cursor, entry):
+        p = self.placeholder
+        values = (entry['name'], entry['kind'],
+                  json.dumps(entry['labels']) if entry['labels'] else None,
+                  entry['interval'], entry['timeout'], time.time())
+        cursor.execute(
+            'UPDATE hosts SET name = {0}, kind = {0}, labels = {0}, '
+            'poll_interval = {0}, timeout = {0}, updated_at = {0} '
+            'WHERE url = {0}'.format(p), values + (entry['url'],))
+        if cursor.rowcount == 0:
+            cursor.execute(
+                'INSERT INTO hosts (name, kind, labels, poll_interval, '
+                'timeout, updated_at, url) VALUES ({0}, {0}, {0}, {0}, {0}, '
+                '{0}, {0})'.format(p), values + (entry['url'],))
+
+    def _apply(self, work):
+        """
+        Runs `work(cursor, hosts)` in a transaction on a copy of the hosts,
+        which replaces them once the transaction is committed.
+        """
+
+        with self._lock:
+            def transaction(cursor):
+                hosts = self._hosts
+                if hosts is None or \
+                        self._read_version(cursor) != self._version:
+                    hosts = self._load(cursor)
+                hosts = dict(hosts)
+                result = work(cursor, hosts)
+                return result, hosts, self._bump(cursor)
+
+            result, self._hosts, self._version = \
+                self._transaction(transaction)
+            self._checked = time.time()
+            return result
+
+    def add(self, url, name=None, kind='node', labels=None, interval=None,
+            timeout=None):
+        """
+        Registers a host, or replaces the registration of its url.
+
+        Returns:
+            dict: the registered host
+        """
+
+        url = url.strip().strip('/')
+        if not url:
+            raise ValueError('url must not be empty')
+        entry = {'url': url, 'name': name or url, 'kind': kind,
+                 'labels': labels or {}, 'interval': interval,
+                 'timeout': timeout}
+        _validate(entry)
+
+        def work(cursor, hosts):
+            self._write(cursor, entry)
+            hosts[url] = entry
+            return dict(entry, labels=dict(entry['labels']))
+
+        return self._apply(work)
+
+    def update(self, url, **fields):
+        """
+        Changes some of the fields of a registered host.
+
+        Returns:
+            dict: the updated host, or None if the url is not registered
+        """
+
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError('unknown fields: %s' % ', '.join(sorted(unknown)))
+        _validate(fields)
+
+        def work(cursor, hosts):
+            if url not in hosts:
+                return None
+            entry = dict(hosts[url], **fields)
+            entry['labels'] = entry['labels'] or {}
+            self._write(cursor, entry)
+            hosts[url] = entry
+            return dict(entry, labels=dict(entry['labels']))
+
+        return self._apply(work)
+
+    def remove(self, url):
+        """
+        Returns:
+            bool: False if the url was not registered
+        """
+
+        def work(cursor, hosts):
+            cursor.execute('DELETE FROM hosts WHERE url = {0}'.format(
+                self.placeholder), (url,))
+            return hosts.pop(url, None) is not None
+
+        return self._apply(work)
+
+    def replace(self, hosts, kind='node'):
+        """
+        Makes `hosts` the registered hosts of a kind, keeping the metadata
+        of the hosts already registered.
+
+        Args:
+            hosts (dict): {url: name, ... }
+        """
+
+        def work(cursor, registered):
+            for url, host in list(registered.items()):
+                if host['kind'] == kind and url not in hosts:
+                    cursor.execute('DELETE FROM hosts WHERE url = {0}'.format(
+                        self.placeholder), (url,))
+                    del registered[url]
+            for url, name in hosts.items():
+                entry = dict(registered.get(url) or {
+                    'url': url, 'labels': {}, 'interval': None,
+                    'timeout': None}, name=name, kind=kind)
+                self._write(cursor, entry)
+                registered[url] = entry
+
+        self._apply(work)
+
+    def import_file(self, path):
+        """
+        Registers the hosts of a tab-separated hosts file of older
+        versions, `name<TAB>url[<TAB>aggregator]` per line, and renames the
+        file so it is imported only once. A file that cannot be renamed,
+        eg. on a read-only install, is left in place; the hosts it already
+        registered are skipped the next time.
+
+        Returns:
+            int: the number of hosts registered
+        """
+
+        if not os.path.exists(path):
+            return 0
+        hosts = []
+        with open(path) as f:
+            for line in f:
+                fields = line.strip().split('\t')
+                if len(fields) < 2:
+                    continue
+                kind = fields[2] if len(fields) > 2 and \
+                    fields[2] in KINDS else 'node'
+                hosts.append((fields[1], fields[0], kind))
+
+        def work(cursor, registered):
+            imported = 0
+            for url, name, kind in hosts:
+                if url not in registered:
+                    entry = {'url': url, 'name': name, 'kind': kind,
+                             'labels': {}, 'interval': None, 'timeout': None}
+                    self._write(cursor, entry)
+                    registered[url] = entry
+                    imported += 1
+            return imported
+
+        imported = self._apply(work)
+        try:
+            os.rename(path, path + '.imported')
+        except OSError as e:
+            print('Warning: could not rename %s after importing it: %s'
+                  % (path, e))
+        return imported
@@ -0,0 +1,423 @@
+"""
+Downsampled history of gpuview.
+
+Raw snapshots are rolled into 1-minute aggregates as they are written,
+the 1-minute tier is rolled into 15-minute and the 15-minute tier into
+hourly aggregates in small batches, and every tier is expired on its own
+retention. Aggregates keep min, sum and max (mean = sum / samples) of
+utilization, used memory and temperature per gpu, and the sum and max of
+the memory of every user per host.
+
+A bucket is rolled up once it is `LAG` seconds old. Rows of a lower tier
+that arrive after their higher-tier bucket was rolled up, eg. when the
+writer queue was backed up, mark that bucket dirty and it is rolled up
+again from the lower tier by the next `roll_up`.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import threading
+import time
+
+
+# (tier, bucket seconds, source tier)
+TIERS = [
+    ('1m', 60, None),
+    ('15m', 900, '1m'),
+    ('1h', 3600, '15m'),
+]
+TIER_SECONDS = dict((tier, seconds) for tier, seconds, _ in TIERS)
+RETENTION_DAYS = {'raw': 3, '1m': 7, '15m': 90, '1h': 730}
+BATCH_BUCKETS = 4  # higher-tier buckets rolled up per transaction
+DELETE_BATCH = 2000  # rows deleted per statement
+LAG = 120  # seconds a lower-tier bucket may still receive samples
+
+METRICS = [
+    ('utilization.gpu', 'util'),
+    ('memory.used', 'mem'),
+    ('temperature.gpu', 'temp'),
+]
+GPU_COLUMNS = ['samples'] + [
+    '%s_%s' % (name, agg) for _, name in METRICS
+    for agg in ('min', 'sum', 'max')] + ['mem_total']
+USER_COLUMNS = ['samples', 'mem_sum', 'mem_max']
+
+
+def _merge_sql(db_type, column):
+    if column == 'mem_total' or column.endswith('_max'):
+        func = 'GREATEST' if db_type == 'mysql' else 'MAX'
+    elif column.endswith('_min'):
+        func = 'LEAST' if db_type == 'mysql' else 'MIN'
+    else:
+        func = None
+    new = 'VALUES(%s)' % column if db_type == 'mysql' \
+        else 'excluded.%s' % column
+    if func is None:
+        return '%s = %s + %s' % (column, column, new)
+    return '%s = %s(%s, %s)' % (column, func, column, new)
+
+
+def upsert(cursor, db_type, table, keys, columns, rows):
+    """
+    Inserts rows, merging them into the existing rows with the same keys:
+    `*_max` and `mem_total` columns keep the maximum, `*_min` columns the
+    minimum, and the other columns are added up.
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    names = keys + columns
+    sql = 'INSERT INTO %s (%s) VALUES (%s) ' % (
+        table, ', '.join(names), ', '.join([placeholder] * len(names)))
+    updates = ', '.join(_merge_sql(db_type, c) for c in columns)
+    if db_type == 'mysql':
+        sql += 'ON DUPLICATE KEY UPDATE ' + updates
+    else:
+        sql += 'ON CONFLICT (%s) DO UPDATE SET %s' % (', '.join(keys),
+                                                      updates)
+    for row in rows:
+        cursor.execute(sql, row)
+
+
+def create_tables(cursor, db_type):
+    """
+    Creates the rollup tables of every tier and the rollup state.
+    """
+
+    name = 'VARCHAR(255)' if db_type == 'mysql' else 'TEXT'
+    suffix = ' ENGINE=InnoDB' if db_type == 'mysql' else ''
+    gpu_columns = ''.join(',\n    %s %s' % (
+        column, 'INT' if column == 'samples' else 'BIGINT')
+        for column in GPU_COLUMNS)
+    user_columns = ''.join(',\n    %s %s' % (
+        column, 'INT' if column == 'samples' else 'BIGINT')
+        for column in USER_COLUMNS)
+    for tier, _, _ in TIERS:
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS gpu_rollup_%s (\n'
+            '    bucket BIGINT NOT NULL,\n'
+            '    hostname %s NOT NULL,\n'
+            '    gpu_index INT NOT NULL%s,\n'
+            '    PRIMARY KEY (hostname, gpu_index, bucket)\n'
+            ')%s' % (tier, name, gpu_columns, suffix))
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS user_rollup_%s (\n'
+            '    bucket BIGINT NOT NULL,\n'
+            '    hostname %s NOT NULL,\n'
+            '    username VARCHAR(64) NOT NULL%s,\n'
+            '    PRIMARY KEY (hostname, username, bucket)\n'
+            ')%s' % (tier, name, user_columns, suffix))
+        for table in ('gpu_rollup_%s' % tier, 'user_rollup_%s' % tier):
+            index = 'idx_%s_bucket' % table
+            if db_type == 'mysql':
+                cursor.execute(
+                    'SELECT COUNT(*) FROM information_schema.statistics '
+                    'WHERE table_schema = DATABASE() AND table_name = %s '
+                    'AND index_name = %s', (table, index))
+                if not cursor.fetchone()[0]:
+                    cursor.execute('CREATE INDEX %s ON %s (bucket)' %
+                                   (index, table))
+            else:
+                cursor.execute('CREATE INDEX IF NOT EXISTS %s ON %s (bucket)'
+                               % (index, table))
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS rollup_state (\n'
+        '    tier VARCHAR(8) PRIMARY KEY,\n'
+        '    watermark BIGINT NOT NULL\n'
+        ')%s' % suffix)
+
+
+class RollupEngine(object):
+    """
+    Accumulates raw snapshots into 1-minute buckets in memory and rolls
+    the tiers up and expires them in the database.
+    """
+
+    def __init__(self, retention_days=None):
+        self.retention_days = dict(RETENTION_DAYS)
+        self.retention_days.update(retention_days or {})
+        self._gpus = {}  # (hostname, index): (bucket, [aggregates])
+        self._users = {}  # (hostname, username): (bucket, [aggregates])
+        self._watermarks = {}  # tier: watermark, as last read or written
+        self._dirty = dict((tier, set()) for tier, _, source in TIERS
+                           if source is not None)
+        self._lock = threading.Lock()
+
+    def observe(self, hoststats, sample_time):
+        """
+        Adds an aggregated snapshot to the current 1-minute buckets.
+
+        Returns:
+            tuple: (gpu rows, user rows) of the buckets that were completed
+        """
+
+        bucket = int(sample_time) - int(sample_time) % 60
+        gpu_rows = []
+        user_rows = []
+        for hostinfo in hoststats or []:
+            if not hostinfo or 'hostname' not in hostinfo or \
+                    hostinfo.get('stale'):
+                continue
+            hostname = hostinfo['hostname']
+            users = {}
+            for position, gpu in enumerate(hostinfo.get('gpus', [])):
+                values = [gpu.get(key) or 0 for key, _ in METRICS]
+                key = (hostname, gpu.get('index', position))
+                last = self._gpus.get(key)
+                if last is not None and last[0] != bucket:
+                    gpu_rows.append([last[0], key[0], key[1]] + last[1])
+                    last = None
+                if last is None:
+                    aggregates = [0]
+                    for value in values:
+                        aggregates += [value, 0, value]
+                    aggregates.append(0)
+                    last = (bucket, aggregates)
+                    self._gpus[key] = last
+                aggregates = last[1]
+                aggregates[0] += 1
+                # a node sampling between reports sends the extremes it saw
+                summary = gpu.get('summary') or {}
+                for i, value in enumerate(values):
+                    extremes = summary.get(METRICS[i][0]) or {}
+                    aggregates[1 + 3 * i] = min(aggregates[1 + 3 * i],
+                                                extremes.get('min', value))
+                    aggregates[2 + 3 * i] += value
+                    aggregates[3 + 3 * i] = max(aggregates[3 + 3 * i],
+                                                extremes.get('max', value))
+                aggregates[-1] = max(aggregates[-1],
+                                     gpu.get('memory.total') or 0)
+                processes = gpu.get('processes')
+                if not isinstance(processes, list):
+                    processes = []
+                for p in processes:
+                    username = p.get('username') or 'Unknown'
+                    users[username] = users.get(username, 0) + \
+                        (p.get('gpu_memory_usage') or 0)
+            for username, memory in users.items():
+                key = (hostname, username)
+                last = self._users.get(key)
+                if last is not None and last[0] != bucket:
+                    user_rows.append([last[0], key[0], key[1]] + last[1])
+                    last = None
+                if last is None:
+                    last = (bucket, [0, 0, 0])
+                    self._users[key] = last
+                aggregates = last[1]
+                aggregates[0] += 1
+                aggregates[1] += memory
+                aggregates[2] = max(aggregates[2], memory)
+
+        for store, rows in ((self._gpus, gpu_rows), (self._users, user_rows)):
+            for key, (last_bucket, aggregates) in list(store.items()):
+                # gpus and users that were not seen in this bucket
+                if last_bucket < bucket - 60:
+                    rows.append([last_bucket, key[0], key[1]] + aggregates)
+                    del store[key]
+        return gpu_rows, user_rows
+
+    def save(self, cursor, db_type, rows):
+        """
+        Merges the completed 1-minute rows returned by `observe`.
+        """
+
+        gpu_rows, user_rows = rows
+        upsert(cursor, db_type, 'gpu_rollup_1m',
+               ['bucket', 'hostname', 'gpu_index'], GPU_COLUMNS, gpu_rows)
+        upsert(cursor, db_type, 'user_rollup_1m',
+               ['bucket', 'hostname', 'username'], USER_COLUMNS, user_rows)
+        self._mark_dirty('1m', set(row[0] for row in gpu_rows + user_rows))
+
+    def _mark_dirty(self, source, buckets):
+        # buckets of `source` that changed behind the watermark of the
+        # tier rolled up from it
+        for tier, seconds, tier_source in TIERS:
+            if tier_source != source:
+                continue
+            with self._lock:
+                watermark = self._watermarks.get(tier)
+                if watermark is not None:
+                    self._dirty[tier].update(
+                        bucket - bucket % seconds for bucket in buckets
+                        if bucket < watermark)
+
+    def roll_up(self, cursor, db_type, tier, now=None):
+        """
+        Rolls at most `BATCH_BUCKETS` dirty buckets again, or else at most
+        `BATCH_BUCKETS` complete buckets of the source tier into `tier` and
+        advances its watermark.
+
+        Returns:
+            bool: True if there may be more buckets to roll up
+        """
+
+        placeholder = '%s' if db_type == 'mysql' else '?'
+        seconds = TIER_SECONDS[tier]
+        source = dict((t, s) for t, _, s in TIERS)[tier]
+        now = time.time() if now is None else now
+        complete = int(now - LAG) - int(now - LAG) % seconds
+
+        with self._lock:
+            dirty = sorted(self._dirty[tier])[:BATCH_BUCKETS]
+        if dirty:
+            for bucket in dirty:
+                self._roll(cursor, db_type, tier, source, bucket,
+                           bucket + seconds)
+            with self._lock:
+                self._dirty[tier].difference_update(dirty)
+            self._mark_dirty(tier, dirty)
+            return True
+
+        cursor.execute('SELECT watermark FROM rollup_state WHERE tier = %s'
+                       % placeholder, (tier,))
+        row = cursor.fetchone()
+        if row:
+            start = row[0]
+        else:
+            cursor.execute('SELECT MIN(bucket) FROM gpu_rollup_%s' % source)
+            first = cursor.fetchone()[0]
+            if first is None:
+                return False
+            start = first - first % seconds
+        with self._lock:
+            self._watermarks[tier] = start
+        end = min(complete, start + BATCH_BUCKETS * seconds)
+        if end <= start:
+            return False
+
+        self._roll(cursor, db_type, tier, source, start, end)
+        if row:
+            cursor.execute('UPDATE rollup_state SET watermark = %s '
+                           'WHERE tier = %s' % (placeholder, placeholder),
+                           (end, tier))
+        else:
+            cursor.execute('INSERT INTO rollup_state (tier, watermark) '
+                           'VALUES (%s, %s)' % (placeholder, placeholder),
+                           (tier, end))
+        with self._lock:
+            self._watermarks[tier] = end
+        return end < complete
+
+    def _roll(self, cursor, db_type, tier, source, start, end):
+        # replaces the buckets of `tier` in [start, end) with the
+        # aggregates of the source tier
+        placeholder = '%s' if db_type == 'mysql' else '?'
+        seconds = TIER_SECONDS[tier]
+        for table in ('gpu_rollup_%s' % tier, 'user_rollup_%s' % tier):
+            cursor.execute('DELETE FROM %s WHERE bucket >= %s AND bucket < %s'
+                           % (table, placeholder, placeholder), (start, end))
+        floor = 'bucket - MOD(bucket, %d)' if db_type == 'mysql' \
+            else 'bucket - bucket %% %d'
+        select = 'SELECT ' + floor + ', hostname, %s, %s FROM %s ' \
+            'WHERE bucket >= %s AND bucket < %s GROUP BY 1, 2, 3'
+        aggregate = []
+        for column in GPU_COLUMNS:
+            if column == 'mem_total' or column.endswith('_max'):
+                aggregate.append('MAX(%s)' % column)
+            elif column.endswith('_min'):
+                aggregate.append('MIN(%s)' % column)
+            else:
+                aggregate.append('SUM(%s)' % column)
+        cursor.execute(select % (seconds, 'gpu_index', ', '.join(aggregate),
+                                 'gpu_rollup_%s' % source, placeholder,
+                                 placeholder), (start, end))
+        upsert(cursor, db_type, 'gpu_rollup_%s' % tier,
+               ['bucket', 'hostname', 'gpu_index'], GPU_COLUMNS,
+               [list(r) for r in cursor.fetchall()])
+        cursor.execute(select % (seconds, 'username',
+                                 'SUM(samples), SUM(mem_sum), MAX(mem_max)',
+                                 'user_rollup_%s' % source, placeholder,
+                                 placeholder), (start, end))
+        upsert(cursor, db_type, 'user_rollup_%s' % tier,
+               ['bucket', 'hostname', 'username'], USER_COLUMNS,
+               [list(r) for r in cursor.fetchall()])
+
+    def expire(self, cursor, db_type, table, column, cutoff):
+        """
+        Deletes at most `DELETE_BATCH` rows of `table` whose `column` is
+        older than `cutoff`.
+
+        Returns:
+            int: number of deleted rows
+        """
+
+        if db_type == 'mysql':
+            cursor.execute('DELETE FROM %s WHERE %s < %%s LIMIT %d' %
+                           (table, column, DELETE_BATCH), (cutoff,))
+        else:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (SELECT rowid '
+                           'FROM %s WHERE %s < ? LIMIT %d)' %
+                           (table, table, column, DELETE_BATCH), (cutoff,))
+        return cursor.rowcount
+
+    def expired_tables(self, now=None):
+        """
+        Returns:
+            list: (table, column, cutoff) of every rollup tier
+        """
+
+        now = time.time() if now is None else now
+        tables = []
+        for tier, _, _ in TIERS:
+            cutoff = int(now - self.retention_days[tier] * 86400)
+            tables.append(('gpu_rollup_%s' % tier, 'bucket', cutoff))
+            tables.append(('user_rollup_%s' % tier, 'bucket', cutoff))
+        return tables
+
+
+HISTORY_METRICS = {'utilization': 'util', 'memory': 'mem',
+                   'temperature': 'temp'}
+MAX_POINTS = 720
+
+
+def choose_tier(start, end, bucket, retention_days, now=None):
+    """
+    Picks the coarsest tier that still covers `start` and is not coarser
+    than the requested bucket, or the finest covering tier if all of them
+    are, and widens the bucket to a multiple of the tier so that the
+    series has at most `MAX_POINTS` points.
+
+    Returns:
+        tuple: (tier, bucket seconds)
+    """
+
+    now = time.time() if now is None else now
+    bucket = max(int(bucket), int(-(-(end - start) // MAX_POINTS)))
+    # tiers that still hold `start`, finest first
+    covering = [(tier, seconds) for tier, seconds, _ in TIERS
+                if now - retention_days[tier] * 86400 <= start] or \
+        [TIERS[-1][:2]]
+    tier, seconds = covering[0]
+    for candidate in reversed(covering):
+        if candidate[1] <= bucket:
+            tier, seconds = candidate
+            break
+    bucket = -(-max(bucket, seconds) // seconds) * seconds
+    return tier, bucket
+
+
+def query_history(cursor, db_type, tier, bucket, metric, hostname,
+                  start, end, gpu_index=None):
+    """
+    Aggregates a metric of a gpu, or of all gpus of a host, into buckets.
+
+    Returns:
+        list: [bucket start, min, mean, max] per bucket
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    name = HISTORY_METRICS[metric]
+    floor = 'bucket - MOD(bucket, %d)' % bucket if db_type == 'mysql' \
+        else 'bucket - bucket %% %d' % bucket
+    where = 'hostname = {0} AND bucket >= {0} AND bucket < {0}'
+    params = [hostname, int(start), int(end)]
+    if gpu_index is not None:
+        where += ' AND gpu_index = {0}'
+        params.append(gpu_index)
+    cursor.execute(
+        'SELECT %s, SUM(samples), MIN(%s_min), SUM(%s_sum), MAX(%s_max) '
+        'FROM gpu_rollup_%s WHERE %s GROUP BY 1 ORDER BY 1' % (
+            floor, name, name, name, tier, where.format(placeholder)),
+        params)
+    return [[int(row[0]), row[2], round(float(row[3]) / row[1], 2), row[4]]
+            for row in cursor.fetchall() if row[1]]
@@ -0,0 +1,360 @@
+"""
+GPU samplers of gpuview.
+
+A sampler returns the stats of this host in the format of
+`GPUStatCollection.jsonify()`, of which `core.my_gpustat` makes the
+reported gpustat:
+
+    {'hostname': ..., 'driver_version': ..., 'query_time': ...,
+     'gpus': [{'index': 0, 'name': ..., 'memory.used': ..., 'processes':
+               [{'pid': ..., 'username': ..., 'command': ...,
+                 'gpu_memory_usage': ...}, ...]}, ...]}
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+MB = 1024 * 1024
+BUFFER_SIZE = 600  # samples kept by a SampleBuffer
+SUMMARY_METRICS = ('utilization.gpu', 'memory.used', 'temperature.gpu')
+
+
+class Sampler(object):
+    """
+    Base class of the samplers.
+    """
+
+    name = None
+
+    def sample(self):
+        """
+        Returns:
+            dict: stats of this host
+        """
+
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class GpustatSampler(Sampler):
+    """
+    Queries everything through `gpustat` on every sample.
+    """
+
+    name = 'gpustat'
+
+    def sample(self):
+        from gpustat import GPUStatCollection
+        return GPUStatCollection.new_query().jsonify()
+
+
+class NvmlSampler(Sampler):
+    """
+    Samples NVML directly, keeping NVML initialized and the device handles
+    and static device info open between samples. Only the fields gpuview
+    reports are queried, and the user and command of a process are looked
+    up once per pid.
+    """
+
+    name = 'nvml'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = None  # [(handle, static info), ...]
+        self._driver_version = None
+        self._processes = {}  # pid: (username, command, full_command)
+
+    def _open(self):
+        import pynvml as N
+
+        N.nvmlInit()
+        self._driver_version = _decode(N.nvmlSystemGetDriverVersion())
+        devices = []
+        for index in range(N.nvmlDeviceGetCount()):
+            handle = N.nvmlDeviceGetHandleByIndex(index)
+            info = {
+                'index': index,
+                'uuid': _decode(N.nvmlDeviceGetUUID(handle)),
+                'name': _decode(N.nvmlDeviceGetName(handle)),
+                'enforced.power.limit': _nvml(
+                    lambda: N.nvmlDeviceGetEnforcedPowerLimit(handle) // 1000)
+            }
+            devices.append((handle, info))
+        self._devices = devices
+
+    def close(self):
+        import pynvml as N
+
+        with self._lock:
+            if self._devices is not None:
+                self._devices = None
+                _nvml(N.nvmlShutdown)
+
+    def _process(self, pid):
+        cached = self._processes.get(pid)
+        if cached is not None:
+            return cached
+        import psutil
+
+        try:
+            process = psutil.Process(pid=pid)
+            username = process.username()
+            cmdline = process.cmdline()
+        except (psutil.Error, OSError):
+            username, cmdline = '?', []
+        if cmdline:
+            cached = (username, os.path.basename(cmdline[0]), cmdline)
+        else:
+            cached = (username, '?', ['?'])
+        self._processes[pid] = cached
+        return cached
+
+    def _gpu(self, N, handle, info, seen):
+        gpu = dict(info)
+        gpu['temperature.gpu'] = _nvml(
+            lambda: N.nvmlDeviceGetTemperature(handle, N.NVML_TEMPERATURE_GPU))
+        gpu['fan.speed'] = _nvml(lambda: N.nvmlDeviceGetFanSpeed(handle))
+        utilization = _nvml(lambda: N.nvmlDeviceGetUtilizationRates(handle))
+        gpu['utilization.gpu'] = utilization.gpu if utilization else None
+        power = _nvml(lambda: N.nvmlDeviceGetPowerUsage(handle))
+        gpu['power.draw'] = power // 1000 if power is not None else None
+        memory = _nvml(lambda: N.nvmlDeviceGetMemoryInfo(handle))
+        gpu['memory.used'] = memory.used // MB if memory else None
+        gpu['memory.total'] = memory.total // MB if memory else None
+
+        nv_processes = (
+            (_nvml(lambda: N.nvmlDeviceGetComputeRunningProcesses(handle))
+             or []) +
+            (_nvml(lambda: N.nvmlDeviceGetGraphicsRunningProcesses(handle))
+             or []))
+        processes = []
+        pids = set()
+        for nv_process in nv_processes:
+            if nv_process.pid in pids:
+                continue
+            pids.add(nv_process.pid)
+            username, command, full_command = self._process(nv_process.pid)
+            processes.append({
+                'pid': nv_process.pid,
+                'username': username,
+                'command': command,
+                'full_command': full_command,
+                'gpu_memory_usage': nv_process.usedGpuMemory // MB
+                if nv_process.usedGpuMemory else None,
+            })
+        seen.update(pids)
+        gpu['processes'] = processes
+        return gpu
+
+    def sample(self):
+        import pynvml as N
+
+        with self._lock:
+            if self._devices is None:
+                self._open()
+            seen = set()
+            try:
+                gpus = [self._gpu(N, handle, info, seen)
+                        for handle, info in self._devices]
+            except N.NVMLError:
+                # eg. a gpu fell off the bus, reopen on the next sample
+                self._devices = None
+                _nvml(N.nvmlShutdown)
+                raise
+            for pid in list(self._processes):
+                if pid not in seen:
+                    del self._processes[pid]
+            return {
+                'hostname': socket.gethostname(),
+                'driver_version': self._driver_version,
+                'query_time': datetime.now(),
+                'gpus': gpus,
+            }
+
+
+class FakeSampler(Sampler):
+    """
+    Generates plausible random stats, for tests and benchmarks on machines
+    without gpus.
+    """
+
+    name = 'fake'
+    USERS = ('alice', 'bob', 'carol', 'dave')
+
+    def __init__(self, gpus=4, processes=2, hostname=None, seed=None,
+                 memory_total=24576):
+        self.gpus = gpus
+        self.processes = processes
+        self.hostname = hostname or socket.gethostname()
+        self.memory_total = memory_total
+        self._random = random.Random(seed)
+
+    def sample(self):
+        rand = self._random
+        gpus = []
+        for index in range(self.gpus):
+            processes = [{
+                'pid': 1000 + index * 100 + i,
+                'username': rand.choice(self.USERS),
+                'command': 'python',
+                'full_command': ['python', 'train.py'],
+                'gpu_memory_usage': rand.randint(100, self.memory_total //
+                                                 (self.processes + 1)),
+            } for i in range(rand.randint(0, self.processes))]
+            used = sum(p['gpu_memory_usage'] for p in processes)
+            gpus.append({
+                'index': index,
+                'uuid': 'GPU-fake-%s-%d' % (self.hostname, index),
+                'name': 'Fake GPU',
+                'temperature.gpu': rand.randint(30, 85),
+                'fan.speed': rand.randint(0, 100),
+                'utilization.gpu': rand.randint(0, 100) if processes else 0,
+                'power.draw': rand.randint(50, 300),
+                'enforced.power.limit': 300,
+                'memory.used': used,
+                'memory.total': self.memory_total,
+                'processes': processes,
+            })
+        return {
+            'hostname': self.hostname,
+            'driver_version': 'fake',
+            'query_time': datetime.now(),
+            'gpus': gpus,
+        }
+
+
+class SampleBuffer(object):
+    """
+    Fixed-size ring of the recent samples of this host, filled faster than
+    gpustats are reported so that short spikes and short-lived processes
+    between two reports are summarized instead of missed.
+    """
+
+    def __init__(self, capacity=BUFFER_SIZE):
+        self._samples = deque(maxlen=capacity)  # (sample_time, sample)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def append(self, sample, sample_time=None):
+        if sample_time is None:
+            sample_time = time.time()
+        with self._lock:
+            self._samples.append((sample_time, sample))
+
+    def since(self, start):
+        """
+        Returns:
+            list: [(sample_time, sample), ...] taken after `start`
+        """
+
+        with self._lock:
+            return [item for item in self._samples if item[0] > start]
+
+
+def summarize(samples):
+    """
+    Summarizes a window of samples per gpu index:
+
+        {index: {'samples': n, 'since': t0, 'until': t1,
+                 'utilization.gpu': {'min': .., 'mean': .., 'max': ..},
+                 'memory.used': {...}, 'temperature.gpu': {...},
+                 'processes': [{'pid', 'username', 'command',
+                                'gpu_memory_usage'}, ...]}}
+
+    The processes are all those seen in the window, with their peak memory.
+
+    Args:
+        samples (list): [(sample_time, sample), ...] in time order
+    """
+
+    summaries = {}
+    for sample_time, sample in samples:
+        for position, gpu in enumerate(sample.get('gpus', [])):
+            index = gpu.get('index', position)
+            summary = summaries.get(index)
+            if summary is None:
+                summary = {'samples': 0, 'since': sample_time,
+                           '_values': dict((m, []) for m in SUMMARY_METRICS),
+                           '_processes': {}}
+                summaries[index] = summary
+            summary['samples'] += 1
+            summary['until'] = sample_time
+            for metric in SUMMARY_METRICS:
+                if gpu.get(metric) is not None:
+                    summary['_values'][metric].append(gpu[metric])
+            processes = gpu.get('processes')
+            if not isinstance(processes, list):
+                continue
+            for p in processes:
+                seen = summary['_processes'].get(p.get('pid'))
+                if seen is None:
+                    summary['_processes'][p.get('pid')] = {
+                        'pid': p.get('pid'),
+                        'username': p.get('username'),
+                        'command': p.get('command'),
+                        'gpu_memory_usage': p.get('gpu_memory_usage'),
+                    }
+                elif (p.get('gpu_memory_usage') or 0) > \
+                        (seen['gpu_memory_usage'] or 0):
+                    seen['gpu_memory_usage'] = p['gpu_memory_usage']
+
+    for summary in summaries.values():
+        for metric, values in summary.pop('_values').items():
+            if values:
+                summary[metric] = {
+                    'min': min(values),
+                    'mean': round(float(sum(values)) / len(values), 1),
+                    'max': max(values),
+                }
+        summary['processes'] = list(summary.pop('_processes').values())
+    return summaries
+
+
+SAMPLERS = dict((cls.name, cls) for cls in
+                (GpustatSampler, NvmlSampler, FakeSampler))
+
+
+def get_sampler(name, **kwargs):
+    """
+    Returns:
+        Sampler: a new sampler of the given name
+    """
+
+    if name not in SAMPLERS:
+        raise ValueError('Unknown sampler: %s' % name)
+    return SAMPLERS[name](**kwargs)
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _nvml(fn):
+    """
+    Calls an NVML function, returning None if it fails, eg. the field is
+    not supported or not permitted, as gpustat does for optional fields.
+    A lost gpu is raised, so that `sample` reopens the devices.
+    """
+
+    import pynvml as N
+
+    try:
+        return fn()
+    except N.NVMLError_GpuIsLost:
+        raise
+    except N.NVMLError:
+        return None
@@ -0,0 +1,194 @@
+"""
+Adaptive polling schedule of gpuview hosts.
+
+Instead of polling every host every cycle, the aggregator asks the
+scheduler which hosts are due:
+
+    * hosts whose gpus change are polled every cycle, idle hosts less and
+      less often, up to `max_idle_interval`
+    * failing hosts are retried with exponential backoff; after
+      `CIRCUIT_THRESHOLD` failures in a row the circuit opens and the host
+      is only probed once every `max_backoff` seconds. The circuit is
+      half-open while a probe is in flight: it closes if the probe
+      answers and opens again if not
+    * a global token bucket caps the polls per second; the most overdue
+      hosts go first and the others wait for the next cycle
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import threading
+import time
+
+MIN_INTERVAL = 2.0  # seconds, the collector cycle
+MAX_IDLE_INTERVAL = 10.0  # seconds
+MAX_BACKOFF = 300.0  # seconds
+CIRCUIT_THRESHOLD = 5  # failures in a row
+CHANGE_DECAY = 0.8  # weight of the past in the change rate
+
+
+def activity(gpustat):
+    """
+    Returns:
+        tuple: what the scheduler compares to tell whether a host changed;
+            small fluctuations of memory are ignored, and temperature and
+            power are left out
+    """
+
+    signature = []
+    for gpu in gpustat.get('gpus') or []:
+        processes = gpu.get('processes')
+        pids = tuple(sorted(p.get('pid') or 0 for p in processes)) \
+            if isinstance(processes, list) else processes
+        signature.append((gpu.get('index'),
+                          (gpu.get('utilization.gpu') or 0) // 10,
+                          (gpu.get('memory.used') or 0) // 256,
+                          pids, gpu.get('user_processes')))
+    return tuple(signature)
+
+
+class HostState(object):
+    """
+    Health and change rate of one polled host.
+    """
+
+    __slots__ = ('next_due', 'interval', 'failures', 'error', 'activity',
+                 'change_rate', 'polls', 'skipped', 'circuit')
+
+    def __init__(self):
+        self.next_due = 0.0
+        self.interval = MIN_INTERVAL
+        self.failures = 0
+        self.error = None
+        self.activity = None
+        self.change_rate = 1.0
+        self.polls = 0
+        self.skipped = 0
+        self.circuit = 'closed'  # 'open', or 'half-open' while probed
+
+    @property
+    def circuit_open(self):
+        return self.circuit != 'closed'
+
+
+class PollScheduler(object):
+    """
+    Decides which hosts to poll each cycle.
+
+    Args:
+        budget (float): polls per second across all hosts, 0 for no limit
+    """
+
+    def __init__(self, min_interval=MIN_INTERVAL,
+                 max_idle_interval=MAX_IDLE_INTERVAL, max_backoff=MAX_BACKOFF,
+                 budget=0):
+        self.min_interval = min_interval
+        self.max_idle_interval = max(min_interval, max_idle_interval)
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self._tokens = float(budget) * min_interval
+        self._refilled = None
+        self._hosts = {}  # url: HostState
+        self._lock = threading.Lock()
+
+    def due(self, urls, now=None, skip=()):
+        """
+        Args:
+            urls: all hosts polled by the collector
+            skip: hosts not to poll this cycle whatever their schedule
+
+        Returns:
+            list: the urls to poll now, most overdue first
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            for url in list(self._hosts):
+                if url not in urls:
+                    del self._hosts[url]
+            states = [(url, self._hosts.setdefault(url, HostState()))
+                      for url in urls]
+            due = sorted((state.next_due, url) for url, state in states
+                         if state.next_due <= now and url not in skip)
+            if self.budget > 0:
+                if self._refilled is not None:
+                    self._tokens = min(
+                        self._tokens + (now - self._refilled) * self.budget,
+                        self.budget * self.min_interval)
+                self._refilled = now
+                granted = int(self._tokens)
+                for _, url in due[granted:]:
+                    self._hosts[url].skipped += 1
+                due = due[:granted]
+                self._tokens -= len(due)
+            for _, url in due:
+                if self._hosts[url].circuit == 'open':
+                    self._hosts[url].circuit = 'half-open'
+            return [url for _, url in due]
+
+    def record(self, url, gpustat=None, error=None, now=None):
+        """
+        Records the outcome of polling a host and schedules its next poll.
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._hosts.setdefault(url, HostState())
+            state.polls += 1
+            if error is not None:
+                state.failures += 1
+                state.error = error
+                if state.circuit != 'closed' or \
+                        state.failures >= CIRCUIT_THRESHOLD:
+                    # the next poll is a probe, once per maximum backoff
+                    state.circuit = 'open'
+                    state.interval = self.max_backoff
+                else:
+                    state.interval = min(self.min_interval *
+                                         2 ** state.failures, self.max_backoff)
+                state.next_due = now + state.interval
+                return
+            state.failures = 0
+            state.error = None
+            state.circuit = 'closed'
+            signature = activity(gpustat or {})
+            changed = signature != state.activity
+            state.activity = signature
+            state.change_rate = CHANGE_DECAY * state.change_rate + \
+                (1 - CHANGE_DECAY) * (1.0 if changed else 0.0)
+            if changed:
+                state.interval = self.min_interval
+            else:
+                state.interval = min(state.interval * 1.5,
+                                     self.max_idle_interval)
+            # allow for the jitter of the collector cycle
+            state.next_due = now + state.interval - self.min_interval / 4
+
+    def state(self, url):
+        """
+        Returns:
+            HostState: of a host, or None if it was never scheduled
+        """
+
+        return self._hosts.get(url)
+
+    def stats(self, now=None):
+        """
+        Returns:
+            dict: {url: health and schedule of the host}
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            return dict((url, {
+                'interval': round(state.interval, 1),
+                'next_poll_in': round(max(0, state.next_due - now), 1),
+                'failures': state.failures,
+                'circuit': state.circuit,
+                'circuit_open': state.circuit_open,
+                'error': state.error,
+                'change_rate': round(state.change_rate, 2),
+                'polls': state.polls,
+                'skipped': state.skipped,
+            }) for url, state in self._hosts.items())
@@ -0,0 +1,131 @@
+"""
+Snapshot sharing between the collector process and the server workers.
+
+In production mode the collectors run once, in their own process, and
+every published snapshot is written to a file in shared memory
+(`/dev/shm`), replaced atomically by a rename. Each worker runs a reader
+thread that republishes new files into its own `SnapshotCache` with the
+collector's token and version, so all workers serve the same etags.
+
+File format: a `<token> <version>\\n` header followed by the json body.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+SHM_DIR = '/dev/shm'
+POLL_INTERVAL = 0.2  # seconds between checks of the shared files
+SUFFIX = '.snapshot'
+
+
+def shared_dir(port, base=None):
+    """
+    Returns:
+        str: the directory shared by the processes serving `port`
+    """
+
+    if base is None:
+        base = SHM_DIR if os.path.isdir(SHM_DIR) else tempfile.gettempdir()
+    return os.path.join(base, 'gpuview-%s' % port)
+
+
+class SnapshotExporter(object):
+    """
+    Writes published snapshots to the shared directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def export(self, key, snapshot):
+        target = os.path.join(self.path, key + SUFFIX)
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix='.' + key)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(snapshot.etag.rsplit('-', 1)[0].encode('utf-8'))
+                f.write(b' %d\n' % snapshot.version)
+                f.write(snapshot.body)
+            os.rename(tmp, target)
+        except Exception:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+
+class SnapshotReader(object):
+    """
+    Republishes the snapshots of the shared directory into a cache.
+
+    Args:
+        path (str): shared directory
+        cache (SnapshotCache): cache of this worker
+        on_publish (callable): on_publish(key, snapshot) after every new
+            snapshot, optional
+    """
+
+    def __init__(self, path, cache, on_publish=None):
+        self.path = path
+        self.cache = cache
+        self.on_publish = on_publish
+        self._seen = {}  # key: (inode, mtime)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+        return self
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print('Error: %s reading shared snapshots' %
+                      getattr(e, 'message', str(e)))
+            time.sleep(POLL_INTERVAL)
+
+    def poll(self):
+        """
+        Republishes the snapshots that changed since the last poll.
+
+        Returns:
+            list: keys of the republished snapshots
+        """
+
+        if not os.path.isdir(self.path):
+            return []
+        published = []
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(SUFFIX):
+                continue
+            key = name[:-len(SUFFIX)]
+            try:
+                with open(os.path.join(self.path, name), 'rb') as f:
+                    stat = os.fstat(f.fileno())
+                    seen = (stat.st_ino, stat.st_mtime_ns)
+                    if self._seen.get(key) == seen:
+                        continue
+                    header = f.readline().decode('utf-8').split()
+                    data = json.loads(f.read().decode('utf-8'))
+            except (IOError, OSError, ValueError):
+                continue  # replaced or removed meanwhile
+            self._seen[key] = seen
+            token, version = header[0], int(header[1])
+            current = self.cache.get(key)
+            if token == self.cache.token and current is not None and \
+                    current.version >= version:
+                continue
+            self.cache.token = token
+            snapshot = self.cache.publish(key, data, version=version)
+            if self.on_publish is not None:
+                self.on_publish(key, snapshot)
+            published.append(key)
+        return published
@@ -0,0 +1,364 @@
+"""
+Pooled database connections of gpuview.
+
+Every read, write and cleanup pass of gpuview borrows a connection from a
+bounded `ConnectionPool` instead of opening a new one:
+
+    size        at most `size` connections are open; a thread asking for
+                one more waits up to `timeout` seconds, then `PoolTimeout`
+                is raised
+    health      a connection idle for more than `check_after` seconds is
+                pinged before it is handed out, and replaced if it broke
+    statements  SQLite keeps the compiled statements of each connection in
+                its statement cache; on MySQL, parametrized statements run
+                on server-side prepared statements cached per connection
+
+SQLite connections are opened with `check_same_thread=False`: the web
+server handles requests on short-lived threads, so connections are
+bounded by the pool rather than held per thread, and the pool hands a
+connection to one thread at a time. A process forked from the one that
+opened the pool, such as a gunicorn worker, starts with an empty pool
+instead of sharing the connections of its parent.
+
+`connection()` returns a wrapper whose `close()` gives the connection
+back, so code written for `connect()` and `close()` works unchanged.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+POOL_SIZE = 8
+ACQUIRE_TIMEOUT = 10.0  # seconds
+CHECK_AFTER = 30.0  # seconds idle before a connection is pinged
+STATEMENT_CACHE = 256  # compiled statements kept per connection
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class _Entry(object):
+    """
+    An open connection with its prepared statements.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.pid = os.getpid()
+        self.used = time.time()
+        self.statements = {}  # sql: (sql, prepared cursor)
+
+
+class PooledCursor(object):
+    """
+    Cursor of a pooled connection.
+
+    On MySQL, statements with parameters run on the prepared cursor of
+    their sql, prepared on the first use and reused afterwards.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = None  # cursor of the last statement
+        self._plain = None
+
+    def execute(self, sql, params=None):
+        entry = self._connection._entry
+        if self._connection.pool.db_type == 'mysql':
+            # results left unread by a previous statement block the next one
+            entry.raw.consume_results()
+            if params:
+                cached = entry.statements.get(sql)
+                if cached is None:
+                    cached = entry.statements[sql] = (
+                        sql, entry.raw.cursor(prepared=True))
+                    self._connection.pool._count('prepared')
+                # a prepared cursor re-prepares unless given the same string
+                self._cursor = cached[1]
+                self._cursor.execute(cached[0], params)
+                return self
+        if self._plain is None:
+            self._plain = entry.raw.cursor()
+        self._cursor = self._plain
+        if params is None:
+            self._cursor.execute(sql)
+        else:
+            self._cursor.execute(sql, params)
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self._cursor.fetchall())
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        if self._plain is not None:
+            try:
+                self._plain.close()
+            except Exception:
+                pass
+            self._plain = None
+
+
+class PooledConnection(object):
+    """
+    A connection borrowed from a pool; `close()` gives it back.
+    """
+
+    def __init__(self, pool, entry):
+        self.pool = pool
+        self._entry = entry
+        self._cursors = []
+
+    def cursor(self):
+        if self._entry is None:
+            raise ValueError('The connection was given back to the pool')
+        cursor = PooledCursor(self)
+        self._cursors.append(cursor)
+        return cursor
+
+    def execute(self, sql, params=None):
+        return self.cursor().execute(sql, params)
+
+    def commit(self):
+        self._entry.raw.commit()
+
+    def rollback(self):
+        self._entry.raw.rollback()
+
+    def close(self):
+        if self._entry is None:
+            return
+        for cursor in self._cursors:
+            cursor.close()
+        self._cursors = []
+        entry, self._entry = self._entry, None
+        self.pool._release(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def __del__(self):
+        # a connection never closed must not leak its pool slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool(object):
+    """
+    A bounded pool of database connections.
+
+    Args:
+        connect (callable): opens a new database connection
+        db_type (str): 'sqlite' or 'mysql'
+        size (int): maximum open connections
+        timeout (float): seconds to wait for a free connection
+        check_after (float): seconds idle before a connection is checked
+    """
+
+    def __init__(self, connect, db_type='sqlite', size=POOL_SIZE,
+                 timeout=ACQUIRE_TIMEOUT, check_after=CHECK_AFTER):
+        if size < 1:
+            raise ValueError('Pool size must be positive: %s' % size)
+        self._connect = connect
+        self.db_type = db_type
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self._closed = False
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()  # the most recently used first
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._lock = threading.Lock()
+        self._counts = dict((name, 0) for name in (
+            'created', 'acquired', 'waits', 'timeouts', 'reconnects',
+            'discarded', 'prepared'))
+        self._open = 0
+        self._in_use = 0
+        self._wait_seconds = 0.0
+
+    @classmethod
+    def sqlite(cls, path, **kwargs):
+        return cls(lambda: sqlite3.connect(
+            path, check_same_thread=False,
+            cached_statements=STATEMENT_CACHE), 'sqlite', **kwargs)
+
+    @classmethod
+    def mysql(cls, config, **kwargs):
+        def connect():
+            import mysql.connector
+            return mysql.connector.connect(**config)
+
+        return cls(connect, 'mysql', **kwargs)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def connection(self):
+        """
+        Borrows a connection, waiting up to `timeout` seconds for one.
+
+        Returns:
+            PooledConnection: to be closed once done
+        """
+
+        if self._pid != os.getpid():
+            # connections of the parent process are left to the parent
+            self._reset()
+        started = time.time()
+        if not self._slots.acquire(False):
+            self._count('waits')
+            if not self._slots.acquire(True, self.timeout):
+                self._count('timeouts')
+                raise PoolTimeout('No database connection free after %ss '
+                                  '(pool size %d)' % (self.timeout,
+                                                      self.size))
+        try:
+            entry = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._counts['acquired'] += 1
+            self._in_use += 1
+            self._wait_seconds += time.time() - started
+        return PooledConnection(self, entry)
+
+    def _checkout(self):
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return self._new()
+            if time.time() - entry.used < self.check_after or \
+                    self._healthy(entry):
+                return entry
+            self._count('reconnects')
+            self._discard(entry)
+
+    def _new(self):
+        entry = _Entry(self._connect())
+        with self._lock:
+            self._counts['created'] += 1
+            self._open += 1
+        return entry
+
+    def _healthy(self, entry):
+        try:
+            if self.db_type == 'mysql':
+                entry.raw.ping(reconnect=False)
+            else:
+                entry.raw.execute('SELECT 1').fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry):
+        for _, cursor in entry.statements.values():
+            try:
+                cursor.close()
+            except Exception:
+                pass
+        try:
+            entry.raw.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._counts['discarded'] += 1
+            self._open -= 1
+
+    def _release(self, entry):
+        if entry.pid != self._pid:
+            return
+        try:
+            # work left uncommitted is dropped, as closing would; on MySQL
+            # this also ends the snapshot of the last read
+            if self.db_type == 'mysql':
+                entry.raw.consume_results()
+            if entry.raw.in_transaction:
+                entry.raw.rollback()
+            broken = False
+        except Exception:
+            broken = True
+        with self._lock:
+            self._in_use -= 1
+            closed = self._closed
+        if broken or closed:
+            self._discard(entry)
+        else:
+            entry.used = time.time()
+            self._idle.put(entry)
+        self._slots.release()
+
+    def close(self):
+        """
+        Closes the idle connections; the borrowed ones are closed when
+        they are given back.
+        """
+
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def stats(self):
+        """
+        Returns:
+            dict: open, in use and idle connections, and counters
+        """
+
+        with self._lock:
+            stats = dict(self._counts)
+            stats.update({
+                'db': self.db_type,
+                'size': self.size,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': self._open - self._in_use,
+                'mean_wait_seconds': (self._wait_seconds /
+                                      self._counts['acquired']
+                                      if self._counts['acquired'] else 0.0),
+            })
+        return stats
@@ -10,15 +10,120 @@ def test_my_gpustat():
     assert isinstance(stat, dict)
 
 
-def test_all_gpustats():
+def test_fake_sampler(monkeypatch):
+    from . import core
+    from .sampler import FakeSampler, get_sampler
+
+    sampler = get_sampler('fake', gpus=3, processes=2, hostname='fake01',
+                          seed=1)
+    assert isinstance(sampler, FakeSampler)
+    monkeypatch.setattr(core, 'SAMPLER', sampler)
+    monkeypatch.setattr(core, 'SAFE_ZONE', True)
+    stat = core.my_gpustat()
+    assert stat['hostname'] == 'fake01'
+    assert [gpu['index'] for gpu in stat['gpus']] == [0, 1, 2]
+    for gpu in stat['gpus']:
+        assert gpu['memory.used'] == sum(p['gpu_memory_usage']
+                                         for p in gpu['processes'])
+        assert 0 <= gpu['memory'] <= 100
+        assert gpu['flag'].startswith('bg-')
+
+    monkeypatch.setattr(core, 'SAFE_ZONE', False)
+    stat = core.my_gpustat()
+    assert all('processes' not in gpu for gpu in stat['gpus'])
+
+    # gpus whose processes can't be read are dropped, whatever their order
+    sampler.sample = lambda: {'hostname': 'fake01', 'gpus': [
+        dict(FakeSampler(gpus=1).sample()['gpus'][0], index=i,
+             processes='Not Supported' if i in (0, 2) else [])
+        for i in range(4)]}
+    stat = core.my_gpustat()
+    assert [gpu['index'] for gpu in stat['gpus']] == [1, 3]
+
+    # fields the sampler couldn't read are reported as unknown
+    sampler.sample = lambda: {'hostname': 'fake01', 'gpus': [
+        dict(FakeSampler(gpus=1).sample()['gpus'][0], **{
+            'memory.used': None, 'temperature.gpu': None})]}
+    stat = core.my_gpustat()
+    assert 'error' not in stat
+    assert stat['gpus'][0]['memory'] is None
+    assert stat['gpus'][0]['flag'] == 'bg-primary'
+
+
+def test_nvml_optional_fields():
+    import pytest
+    from .sampler import _nvml
+    N = pytest.importorskip('pynvml')
+
+    def fail(value):
+        raise N.NVMLError(value)
+
+    assert _nvml(lambda: fail(N.NVML_ERROR_NOT_SUPPORTED)) is None
+    assert _nvml(lambda: fail(N.NVML_ERROR_NO_PERMISSION)) is None
+    assert _nvml(lambda: fail(N.NVML_ERROR_UNKNOWN)) is None
+    with pytest.raises(N.NVMLError_GpuIsLost):
+        _nvml(lambda: fail(N.NVML_ERROR_GPU_IS_LOST))
+
+
+def test_sample_summary(monkeypatch):
+    from . import core
+    from .sampler import FakeSampler
+
+    samples = [
+        {'hostname': 'node', 'gpus': [
+            {'index': 0, 'utilization.gpu': util, 'memory.used': used,
+             'memory.total': 1000, 'temperature.gpu': 40,
+             'processes': processes}]}
+        for util, used, processes in [
+            (10, 100, []),
+            (90, 900, [{'pid': 7, 'username': 'bob', 'command': 'oom',
+                        'gpu_memory_usage': 800}]),
+            (20, 200, [{'pid': 8, 'username': 'alice', 'command': 'python',
+                        'gpu_memory_usage': 100}])]]
+    sampler = FakeSampler()
+    monkeypatch.setattr(core, 'SAMPLER', sampler)
+    monkeypatch.setattr(core, 'SAFE_ZONE', True)
+    monkeypatch.setattr(core, 'LAST_REPORT', 0)
+    monkeypatch.setattr(core, 'SAMPLES', None)
+    core.buffer_samples(2)
+    sampler.sample = lambda: samples.pop(0)
+    for _ in range(3):
+        core.sample()
+    assert len(core.SAMPLES) == 2
+
+    gpu = core.my_gpustat()['gpus'][0]
+    assert gpu['utilization.gpu'] == 20
+    summary = gpu['summary']
+    assert summary['samples'] == 2
+    assert summary['utilization.gpu'] == {'min': 20, 'mean': 55.0,
+                                          'max': 90}
+    assert summary['memory.used']['max'] == 900
+    assert sorted(p['pid'] for p in summary['processes']) == [7, 8]
+
+    # nothing new was buffered: sample directly, without a summary
+    sampler.sample = lambda: FakeSampler(gpus=1).sample()
+    assert 'summary' not in core.my_gpustat()['gpus'][0]
+
+
+def _tmp_registry(tmp_path, monkeypatch):
+    # keep the registry out of the package directory
+    from . import core
+
+    monkeypatch.setattr(core, 'REGISTRY_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(core, 'REGISTRY', None)
+
+
+def test_all_gpustats(tmp_path, monkeypatch):
     from .core import all_gpustats
+    _tmp_registry(tmp_path, monkeypatch)
     stats = all_gpustats()
     assert stats is not None
     assert isinstance(stats, list)
 
 
-def test_hosts_db():
+def test_hosts_db(tmp_path, monkeypatch):
     from .core import load_hosts, add_host, remove_host
+    _tmp_registry(tmp_path, monkeypatch)
 
     dummy_host = 'dummy.host'
     add_host(dummy_host)
@@ -39,3 +144,1354 @@ def test_arg_parser():
     # import pytest
     # with pytest.raises(Exception):
     #    parser.parse_args()
+
+
+def _hoststat(hostname, used, processes):
+    return {'hostname': hostname,
+            'gpus': [{'index': 0, 'memory.used': used,
+                      'processes': processes}]}
+
+
+def test_memgap_tracker():
+    from .memgap import MemGapTracker
+
+    proc = {'username': 'alice', 'command': 'python',
+            'gpu_memory_usage': 5000}
+    tracker = MemGapTracker()
+    assert tracker.observe([_hoststat('h1', 5000, [proc])], 1) == []
+    events = tracker.observe([_hoststat('h1', 5000, [])], 2)
+    assert len(events) == 1
+    assert events[0]['event'] == 'open'
+    assert events[0]['row_id'] == 1 and events[0]['last_row_id'] == 2
+    assert events[0]['processes'][0]['user'] == 'alice'
+    events = tracker.observe([_hoststat('h1', 0, [])], 3)
+    assert [e['event'] for e in events] == ['close']
+
+
+def test_find_process(tmp_path, monkeypatch):
+    from . import app as gpuview_app
+    from .memgap import MemGapTracker
+
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(gpuview_app, 'MEMGAP_TRACKER', MemGapTracker())
+    gpuview_app.init_db()
+    proc = {'username': 'bob', 'command': 'train.py',
+            'gpu_memory_usage': 8000}
+    gpuview_app.save_to_db([_hoststat('h1', 8000, [proc])], 'allgpustats')
+    gpuview_app.save_to_db([_hoststat('h1', 8000, [])], 'allgpustats')
+
+    client = gpuview_app.app.test_client()
+    resp = client.get('/find_process?hostname=h1&gpuid=0').get_json()
+    assert resp['code'] == 0
+    assert resp['data']['processes'][0]['user'] == 'bob'
+    resp = client.get('/find_process?hostname=h2&gpuid=0').get_json()
+    assert resp['code'] == 1
+
+
+def test_normalized_roundtrip():
+    import sqlite3
+    from . import normalized
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    normalized.create_tables(cursor, 'sqlite')
+    snapshot = [
+        {'hostname': 'h1', 'driver_version': '535.0',
+         'gpus': [{'index': 0, 'name': 'A100', 'temperature.gpu': 40,
+                   'utilization.gpu': 90, 'memory.used': 1000,
+                   'memory.total': 40000, 'memory': 3, 'flag': 'bg-success',
+                   'fan.speed': None,
+                   'processes': [{'username': 'alice', 'command': 'python',
+                                  'pid': 42, 'gpu_memory_usage': 1000,
+                                  'full_command': ['python', 'train.py']},
+                                 {'username': 'bob', 'command': 'python',
+                                  'pid': 7, 'gpu_memory_usage': 0}]},
+                  {'index': 1, 'name': 'A100', 'processes': 'N/A'},
+                  {'index': 2, 'name': 'A100', 'memory.used': None,
+                   'temperature.gpu': None, 'processes': []}]},
+        {'hostname': 'h2', 'gpus': [], 'stale': True,
+         'driver_version': None},
+    ]
+    normalized.insert_snapshot(cursor, 'sqlite', 'allgpustats', snapshot, 1.0)
+    normalized.insert_snapshot(cursor, 'sqlite', 'gpustats', snapshot[0], 1.0)
+
+    # null columns and empty process lists survive the round trip
+    latest = normalized.load_latest(cursor, 'sqlite', 'allgpustats')
+    assert latest == snapshot
+    assert latest[0]['gpus'][2]['processes'] == []
+    assert 'fan.speed' in latest[0]['gpus'][0]
+    assert normalized.load_latest(cursor, 'sqlite', 'gpustats') == snapshot[0]
+
+    normalized.delete_before(cursor, 'sqlite', 2.0)
+    assert normalized.load_latest(cursor, 'sqlite', 'allgpustats') is None
+
+
+def _serve(handler):
+    import threading
+    from http.server import ThreadingHTTPServer
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, '127.0.0.1:%d' % server.server_address[1]
+
+
+def test_host_poller():
+    import json
+    import time
+    from http.server import BaseHTTPRequestHandler
+    from .poller import HostPoller
+
+    class FastHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps({'hostname': 'fast', 'gpus': []}).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class SlowHandler(FastHandler):
+        def do_GET(self):
+            time.sleep(1)
+            FastHandler.do_GET(self)
+
+    fast, fast_url = _serve(FastHandler)
+    slow, slow_url = _serve(SlowHandler)
+    try:
+        poller = HostPoller(read_timeout=0.3, deadline=0.5)
+        started = time.time()
+        stats, stale = poller.poll({fast_url: 'node1', slow_url: slow_url})
+        assert time.time() - started < 0.9
+        assert stale == [slow_url]
+        assert stats[0]['hostname'] == 'node1'
+        assert stats[1]['stale'] and stats[1]['gpus'] == []
+
+        # a poll still running past the deadline isn't started again
+        requests = []
+        SlowHandler.do_GET = lambda self: (requests.append(1),
+                                           time.sleep(1),
+                                           FastHandler.do_GET(self))
+        poller = HostPoller(read_timeout=2, deadline=0.2, max_workers=2)
+        for _ in range(2):
+            stats, stale = poller.poll({slow_url: slow_url, fast_url: 'f'})
+            assert stale == [slow_url]
+        assert 'still polling' in stats[0]['error'] and len(requests) == 1
+        time.sleep(1.2)
+        stats, stale = poller.poll({slow_url: slow_url, fast_url: 'f'})
+        assert stale == [slow_url] and len(requests) == 2
+        poller.close()
+    finally:
+        fast.shutdown()
+        slow.shutdown()
+
+
+def test_poller_keep_alive_gzip():
+    import gzip
+    import json
+    from http.server import BaseHTTPRequestHandler
+    from .poller import HostPoller
+
+    peers = set()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            peers.add(self.client_address)
+            assert 'gzip' in self.headers.get('Accept-Encoding', '')
+            body = gzip.compress(json.dumps(
+                {'hostname': 'node', 'gpus': [{'index': 0}]}).encode())
+            self.send_response(200)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve(Handler)
+    try:
+        poller = HostPoller()
+        for _ in range(3):
+            stats, stale = poller.poll({url: url})
+            assert not stale and stats[0]['gpus'] == [{'index': 0}]
+        assert stats[0]['url'] == url
+        assert len(peers) == 1
+
+        # a dropped keep-alive connection is retried once, on a new one
+        for conn in poller._idle[url]:
+            conn.sock.close()
+        stats, stale = poller.poll({url: url})
+        assert not stale and len(peers) == 2
+        poller.close()
+        assert not poller._idle and poller._executor._shutdown
+    finally:
+        server.shutdown()
+
+
+def test_gzip_response(tmp_path, monkeypatch):
+    import gzip
+    import json
+    from . import app as gpuview_app
+
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    gpuview_app.init_db()
+    stat = {'hostname': 'h1', 'gpus': [{'index': i, 'name': 'GPU'}
+                                       for i in range(64)]}
+    gpuview_app.save_to_db(stat, 'gpustats')
+
+    client = gpuview_app.app.test_client()
+    resp = client.get('/gpustat', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(resp.data)) == stat
+    resp = client.get('/gpustat')
+    assert 'Content-Encoding' not in resp.headers
+    assert resp.get_json() == stat
+
+
+def test_snapshot_cache_etag(monkeypatch):
+    import gzip
+    import json
+    from . import app as gpuview_app
+    from .cache import SnapshotCache
+
+    cache = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', cache)
+    payload = gpuview_app.all_gpustat_payload(
+        [{'hostname': 'b', 'gpus': []},
+         {'hostname': 'a', 'gpus': [{'index': i} for i in range(100)]}])
+    cache.publish('all_gpustat', payload)
+
+    client = gpuview_app.app.test_client()
+    resp = client.get('/all_gpustat', headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    body = json.loads(gzip.decompress(resp.data))
+    assert [g['hostname'] for g in body['gpustats']] == ['a', 'b']
+    etag = resp.headers['ETag']
+
+    resp = client.get('/all_gpustat', headers={'If-None-Match': etag})
+    assert resp.status_code == 304
+
+    cache.publish('all_gpustat', payload)
+    resp = client.get('/all_gpustat', headers={'If-None-Match': etag})
+    assert resp.status_code == 200
+    assert resp.get_json() == body
+
+
+def test_stream_all_gpustat(monkeypatch):
+    import json
+    from . import app as gpuview_app
+    from .cache import SnapshotCache
+
+    cache = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', cache)
+    monkeypatch.setattr(gpuview_app, 'MAX_STREAMS', 1)
+    monkeypatch.setattr(gpuview_app, 'STREAMS', {'active': 0, 'rejected': 0})
+    snapshot = cache.publish('all_gpustat', {'gpustats': [], 'now': 'x'})
+
+    client = gpuview_app.app.test_client()
+    resp = client.get('/all_gpustat/stream', buffered=False)
+    assert resp.mimetype == 'text/event-stream'
+    chunks = resp.response
+    assert next(chunks).startswith(b'retry:')
+    event = next(chunks).decode().splitlines()
+    assert event[0] == 'id: %s' % snapshot.etag
+    assert json.loads(event[2][len('data: '):]) == snapshot.data
+
+    # every stream holds a thread: past the limit, browsers poll instead
+    busy = client.get('/all_gpustat/stream', buffered=False)
+    assert busy.status_code == 503
+    assert busy.headers['Retry-After'] == str(gpuview_app.STREAM_RETRY)
+    assert gpuview_app.stream_stats() == {'active': 1, 'rejected': 1,
+                                          'max': 1}
+    resp.close()
+    assert gpuview_app.stream_stats()['active'] == 0
+    resp = client.get('/all_gpustat/stream', buffered=False)
+    assert resp.status_code == 200
+    resp.close()
+    assert gpuview_app.stream_stats()['active'] == 0
+
+    assert cache.wait('all_gpustat', snapshot.version, timeout=0.01) is None
+
+
+def test_delta_roundtrip():
+    import copy
+    from .delta import apply, diff
+
+    old = {'now': 1, 'gpustats': [
+        {'hostname': 'a', 'gpus': [{'index': 0, 'utilization.gpu': 10,
+                                    'processes': []},
+                                   {'index': 1, 'utilization.gpu': 0}]},
+        {'hostname': 'b', 'gpus': []}]}
+    new = copy.deepcopy(old)
+    new['now'] = 2
+    new['gpustats'][0]['gpus'][0]['utilization.gpu'] = 90
+    new['gpustats'][0]['gpus'][0]['processes'] = [{'pid': 1}]
+    new['gpustats'].pop(1)
+    new['gpustats'].append({'hostname': 'c', 'gpus': []})
+
+    patch = diff(old, new)
+    assert 'b' not in str(patch['sub']['gpustats'].get('set', {}))
+    assert '1' not in patch['sub']['gpustats']['sub']['a']['sub']['gpus'].get(
+        'sub', {})
+    assert apply(old, patch) == new
+    assert diff(new, copy.deepcopy(new)) is None
+
+
+def test_all_gpustat_since(monkeypatch):
+    from . import app as gpuview_app
+    from .cache import SnapshotCache
+    from .delta import apply
+
+    cache = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', cache)
+    first = cache.publish('all_gpustat', {'gpustats': [
+        {'hostname': 'a', 'gpus': [{'index': 0, 'memory': 1}]}], 'now': 1})
+    client = gpuview_app.app.test_client()
+
+    full = client.get('/all_gpustat?since=').get_json()
+    assert full == {'version': first.etag, 'full': first.data}
+
+    second = cache.publish('all_gpustat', {'gpustats': [
+        {'hostname': 'a', 'gpus': [{'index': 0, 'memory': 2}]}], 'now': 2})
+    resp = client.get('/all_gpustat?since=' + first.etag).get_json()
+    assert resp['base'] == first.etag and resp['version'] == second.etag
+    assert apply(full['full'], resp['patch']) == second.data
+
+    resp = client.get('/all_gpustat?since=unknown').get_json()
+    assert resp['full'] == second.data
+
+
+def test_snapshot_writer(tmp_path, monkeypatch):
+    from . import app as gpuview_app
+    from .writer import SnapshotWriter
+
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(gpuview_app, 'PERSIST_INTERVAL', 0)
+    monkeypatch.setattr(gpuview_app, 'LAST_PERSISTED', {})
+    gpuview_app.init_db()
+    writer = SnapshotWriter(gpuview_app.get_db_connection,
+                            gpuview_app.insert_snapshot, queue_size=3)
+    monkeypatch.setattr(gpuview_app, 'WRITER', writer)
+
+    for i in range(5):
+        gpuview_app.save_to_db({'hostname': 'h', 'n': i, 'gpus': []},
+                               'gpustats')
+    stats = writer.stats()
+    assert stats['queue_depth'] == 3 and stats['dropped'] == 2
+
+    writer.flush()
+    stats = writer.stats()
+    assert stats['written'] == 3 and stats['flushes'] == 1
+    monkeypatch.setattr(gpuview_app, 'WRITER', None)
+    assert gpuview_app.get_latest_from_db()['n'] == 4
+
+    writer = SnapshotWriter(None, None, queue_size=1, policy='drop_newest')
+    assert writer.put('gpustats', 1) and not writer.put('gpustats', 2)
+    assert writer._queue.get_nowait()[1] == 1
+
+
+def test_rollup_tiers():
+    import sqlite3
+    from . import rollup
+
+    conn = sqlite3.connect(':memory:')
+    cursor = conn.cursor()
+    rollup.create_tables(cursor, 'sqlite')
+    engine = rollup.RollupEngine()
+
+    def snapshot(util, memory):
+        return [{'hostname': 'h1', 'gpus': [{
+            'index': 0, 'utilization.gpu': util, 'memory.used': memory,
+            'memory.total': 100, 'temperature.gpu': 50,
+            'processes': [{'username': 'alice',
+                           'gpu_memory_usage': memory}]}]}]
+
+    start = 3600 * 1000
+    for minute in range(30):
+        for second in (0, 20, 40):
+            rows = engine.observe(snapshot(minute, 10 + second),
+                                  start + minute * 60 + second)
+            engine.save(cursor, 'sqlite', rows)
+    cursor.execute('SELECT COUNT(*), SUM(samples), MIN(util_min), '
+                   'MAX(mem_max) FROM gpu_rollup_1m')
+    assert cursor.fetchone() == (29, 87, 0, 50)
+    cursor.execute('SELECT SUM(mem_sum) FROM user_rollup_1m')
+    assert cursor.fetchone()[0] == 29 * (10 + 30 + 50)
+
+    now = start + 3 * 3600
+    while engine.roll_up(cursor, 'sqlite', '15m', now):
+        pass
+    cursor.execute('SELECT bucket, samples, util_min, util_max '
+                   'FROM gpu_rollup_15m ORDER BY bucket')
+    assert cursor.fetchall() == [(start, 45, 0, 14), (start + 900, 42, 15, 28)]
+    cursor.execute('SELECT SUM(samples) FROM user_rollup_15m')
+    assert cursor.fetchone()[0] == 87
+
+    # a late 1m row behind the watermark rolls its 15m bucket up again
+    engine.save(cursor, 'sqlite', ([[start + 60, 'h1', 1, 1, 99, 99, 99,
+                                     0, 0, 0, 0, 0, 0, 0]], []))
+    assert engine.roll_up(cursor, 'sqlite', '15m', now)
+    assert not engine.roll_up(cursor, 'sqlite', '15m', now)
+    cursor.execute('SELECT gpu_index, samples, util_max FROM gpu_rollup_15m '
+                   'WHERE bucket = ? ORDER BY gpu_index', (start,))
+    assert cursor.fetchall() == [(0, 45, 14), (1, 1, 99)]
+
+    assert engine.expire(cursor, 'sqlite', 'gpu_rollup_1m', 'bucket',
+                         start + 600) == 11
+
+
+def test_history(tmp_path, monkeypatch):
+    import time
+    from . import app as gpuview_app
+    from . import rollup
+
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    gpuview_app.init_db()
+    engine = rollup.RollupEngine()
+    conn = gpuview_app.get_db_connection()
+    now = int(time.time()) - int(time.time()) % 3600
+    for minute in range(-120, 1):
+        rows = engine.observe([{'hostname': 'h1', 'gpus': [
+            {'index': 0, 'utilization.gpu': minute + 120}]}], now + minute * 60)
+        engine.save(conn.cursor(), 'sqlite', rows)
+    conn.commit()
+    conn.close()
+
+    assert rollup.choose_tier(now - 3600, now, 1, engine.retention_days,
+                              now) == ('1m', 60)
+    assert rollup.choose_tier(now - 30 * 86400, now, 60,
+                              engine.retention_days, now) == ('1h', 3600)
+    # the coarsest tier that fits the bucket, not the finest covering one
+    assert rollup.choose_tier(now - 86400, now, 3600, engine.retention_days,
+                              now) == ('1h', 3600)
+    assert rollup.choose_tier(now - 86400, now, 1800, engine.retention_days,
+                              now) == ('15m', 1800)
+
+    client = gpuview_app.app.test_client()
+    resp = client.get('/history', query_string={
+        'host': 'h1', 'gpu': 0, 'start': now - 3600, 'end': now,
+        'bucket': 600}).get_json()
+    assert resp['code'] == 0
+    data = resp['data']
+    assert data['tier'] == '1m' and data['bucket'] == 600
+    assert data['points'][0] == [now - 3600, 60, 64.5, 69]
+    assert len(data['points']) == 6
+    assert client.get('/history').get_json()['code'] == 1
+
+
+def test_recent_store(tmp_path, monkeypatch):
+    import time
+    from . import app as gpuview_app
+    from .recent import RecentStore
+
+    store = RecentStore(window=60, interval=2)
+    assert store.capacity == 30
+    for i in range(40):
+        store.observe([_hoststat('a', 100 + i, [
+            {'pid': 1, 'username': 'bob', 'command': 'python',
+             'gpu_memory_usage': 100 + i}]),
+            dict(_hoststat('b', 1, []), stale=True)], 1000 + 2 * i)
+    points = store.window_points('a', 0, 'memory.used', 0, 2000)
+    assert len(points) == 30
+    assert points[0] == [1020.0, 110.0] and points[-1] == [1078.0, 139.0]
+    assert store.window_points('b', 0, 'memory.used', 0, 2000) == []
+    assert store.aggregate('memory.used', 'a', 1060, 1080, 10) == [
+        [1060, 130.0, 132.0, 134.0], [1070, 135.0, 137.0, 139.0]]
+    line = store.sparklines('memory.used', 20, 2, now=1080)['a'][0]
+    assert line == [132.0, 137.0]
+    processes = store.processes('a')
+    assert len(processes) == 1 and processes[0]['gpu_memory_usage'] == 139
+    assert processes[0]['first_seen'] == 1000
+    stats = store.stats()
+    assert stats['gpus'] == 1 and stats['samples'] == 30
+    assert stats['memory_bytes'] > 30 * (8 + 4 * 4)
+
+    # recent history is served from memory, raw snapshots are thinned
+    # when asked to
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(gpuview_app, 'PERSIST_INTERVAL', 10)
+    monkeypatch.setattr(gpuview_app, 'LAST_PERSISTED', {})
+    monkeypatch.setattr(gpuview_app, 'RECENT', RecentStore())
+    gpuview_app.init_db()
+    now = time.time()
+    for i in range(6):
+        gpustats = [_hoststat('a', 100 * i, [])]
+        gpuview_app.RECENT.observe(gpustats, now - 10 + 2 * i)
+        gpuview_app.save_to_db(gpustats, 'allgpustats')
+    conn = gpuview_app.get_db_connection()
+    assert conn.execute('SELECT COUNT(*) FROM allgpustats').fetchone()[0] == 1
+    conn.close()
+    client = gpuview_app.app.test_client()
+    data = client.get('/history?host=a&metric=memory&start=%d&bucket=1' %
+                      (now - 10)).get_json()['data']
+    assert data['tier'] == 'recent'
+    assert [p[3] for p in data['points']] == [0, 100, 200, 300, 400, 500]
+    data = client.get('/sparklines?points=10&seconds=20').get_json()['data']
+    assert len(data['a']['0']) == 10
+    assert client.get('/status').get_json()['recent']['gpus'] == 1
+
+
+def test_shared_snapshots(tmp_path, monkeypatch):
+    from . import app as gpuview_app
+    from .cache import SnapshotCache
+    from .recent import RecentStore
+    from .shared import SnapshotExporter, SnapshotReader
+
+    collector = SnapshotCache()
+    exporter = SnapshotExporter(str(tmp_path / 'shm'))
+    worker = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', worker)
+    monkeypatch.setattr(gpuview_app, 'RECENT', RecentStore())
+    observed = []
+    reader = SnapshotReader(exporter.path, worker,
+                            lambda key, snapshot: observed.append(key))
+    assert reader.poll() == []
+
+    first = collector.publish('all_gpustat', gpuview_app.all_gpustat_payload(
+        [_hoststat('a', 1, [])]))
+    exporter.export('all_gpustat', first)
+    assert reader.poll() == ['all_gpustat'] and reader.poll() == []
+    second = collector.publish('all_gpustat', gpuview_app.all_gpustat_payload(
+        [_hoststat('a', 2, [])]))
+    exporter.export('all_gpustat', second)
+    assert reader.poll() == ['all_gpustat']
+    assert observed == ['all_gpustat', 'all_gpustat']
+    assert sorted(tmp_path.joinpath('shm').iterdir()) == [
+        tmp_path / 'shm' / 'all_gpustat.snapshot']
+
+    # every worker serves the collector's etags and deltas
+    client = gpuview_app.app.test_client()
+    resp = client.get('/all_gpustat')
+    assert resp.headers['ETag'].strip('"') == second.etag
+    resp = client.get('/all_gpustat?since=%s' % first.etag).get_json()
+    assert resp['base'] == first.etag and resp['version'] == second.etag
+
+    # a snapshot the collector stopped updating is served as stale
+    assert 'Warning' not in client.get('/all_gpustat').headers
+    assert not client.get('/status').get_json()['snapshot']['stale']
+    monkeypatch.setattr(gpuview_app, 'MAX_SNAPSHOT_AGE', -1)
+    assert client.get('/all_gpustat').headers['Warning'] == \
+        '110 - "Response is Stale"'
+    assert client.get('/all_gpustat?host=a').headers['Warning']
+    assert client.get('/status').get_json()['snapshot']['stale']
+
+
+def test_aggregator_subtrees(tmp_path, monkeypatch):
+    import json
+    from http.server import BaseHTTPRequestHandler
+    from . import core
+    from .hierarchy import SubtreePoller, dedup, stamp
+    from .poller import HostPoller
+    from .registry import HostRegistry
+
+    payloads = {}
+
+    class AggregatorHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(payloads[self.server.server_address[1]])
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body.encode())
+
+        def log_message(self, *args):
+            pass
+
+    rack1, url1 = _serve(AggregatorHandler)
+    rack2, url2 = _serve(AggregatorHandler)
+    node = dict(_hoststat('n1', 1, []), updated_at=100)
+    payloads[rack1.server_address[1]] = {
+        'aggregator': 'rack1', 'gpustats': [
+            node, dict(_hoststat('shared', 1, []), updated_at=100),
+            # came from the top level through rack1: a loop
+            dict(_hoststat('top-node', 1, []), updated_at=100,
+                 via=[{'aggregator': 'top', 'url': 'x', 'fetched_at': 1}])]}
+    payloads[rack2.server_address[1]] = {
+        'aggregator': 'rack2', 'gpustats': [
+            dict(_hoststat('shared', 2, []), updated_at=200)]}
+
+    subtrees = SubtreePoller(HostPoller(), aggregator_id='top')
+    entries, stale = subtrees.submit({url1: 'rack1', url2: 'rack2'}).result()
+    assert stale == []
+    assert sorted(e['hostname'] for e in entries) == ['n1', 'shared',
+                                                      'shared']
+    n1 = [e for e in entries if e['hostname'] == 'n1'][0]
+    assert n1['updated_at'] == 100
+    assert [v['aggregator'] for v in n1['via']] == ['rack1']
+    assert subtrees.stats()[url1]['loops'] == ['top-node']
+
+    hosts = dedup(stamp([_hoststat('top-node', 1, [])], 300) + entries)
+    assert [h['hostname'] for h in hosts] == ['top-node', 'n1', 'shared']
+    assert hosts[2]['gpus'][0]['memory.used'] == 2  # the freshest copy
+
+    rack1.shutdown()
+    rack1.server_close()
+    entries, stale = subtrees.poll({url1: 'rack1'})
+    assert stale == [url1]
+    assert all(e['stale'] for e in entries) and len(entries) == 2
+    assert subtrees.stats()[url1]['error'] and url2 not in subtrees.stats()
+    rack2.shutdown()
+
+    monkeypatch.setattr(core, 'REGISTRY',
+                        HostRegistry.sqlite(str(tmp_path / 'hosts.db')))
+    core.add_host('node:9988')
+    core.add_host('rack:9988', 'rack', kind='aggregator')
+    assert core.load_hosts() == {'node:9988': 'node:9988'}
+    assert core.load_hosts('aggregator') == {'rack:9988': 'rack'}
+    core.remove_host('rack:9988')
+    assert core.load_hosts(None) == {'node:9988': 'node:9988'}
+
+
+def test_push_ingest(tmp_path, monkeypatch):
+    import gzip
+    from http.server import BaseHTTPRequestHandler
+    from . import app as gpuview_app
+    from .push import IngestStore, Pusher
+
+    received = []
+
+    class IngestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            received.append((self.path, self.headers['Content-Encoding'],
+                             body, self.headers['Authorization']))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    # unreachable aggregator: the gpustats wait for the next push
+    pusher = Pusher('127.0.0.1:1', connect_timeout=0.2)
+    pusher.put(_hoststat('node', 1, []), 10)
+    assert not pusher.push() and pusher.failed == 1
+    server, url = _serve(IngestHandler)
+    pusher.url = url
+    pusher.token = 'secret'
+    pusher.put(_hoststat('node', 2, []), 12)
+    assert pusher.push() and pusher.pushed == 2
+    server.shutdown()
+    path, encoding, body, authorization = received[0]
+    assert path == '/ingest' and encoding == 'gzip'
+    assert authorization == 'Bearer secret'
+
+    store = IngestStore(timeout=5)
+    monkeypatch.setattr(gpuview_app, 'INGEST', store)
+    client = gpuview_app.app.test_client()
+    # without a token, only local pushes are accepted
+    assert client.post('/ingest', data=body, headers={
+        'Content-Encoding': 'gzip'}, environ_base={
+        'REMOTE_ADDR': '10.0.0.9'}).status_code == 403
+    monkeypatch.setattr(gpuview_app, 'API_TOKEN', 'secret')
+    assert client.post('/ingest', data=body, headers={
+        'Content-Encoding': 'gzip'}).status_code == 403
+    assert client.post('/ingest', data=body, headers={
+        'Content-Encoding': 'gzip',
+        'Authorization': 'Bearer wrong'}).status_code == 403
+    resp = client.post('/ingest', data=body, headers={
+        'Content-Encoding': 'gzip', 'Authorization': authorization,
+    }, environ_base={'REMOTE_ADDR': '10.0.0.9'}).get_json()
+    assert resp == {'code': 0, 'accepted': 2}
+    monkeypatch.setattr(gpuview_app, 'API_TOKEN', None)
+    assert client.post('/ingest', data=b'{}').status_code == 400
+    assert store.stats()['snapshots'] == 2
+
+    # the earlier gpustat of the batch goes to the rollups, not the live
+    # stats; a delayed older batch doesn't overwrite newer stats
+    backlog = store.backlog()
+    assert [(t, g['gpus'][0]['memory.used']) for t, g in backlog] == \
+        [(10, 1)]
+    assert store.backlog() == []
+    assert store.ingest('node', [(11, _hoststat('node', 3, []))]) == 0
+    assert store.stats()['ignored'] == 1
+
+    import sqlite3
+    from . import rollup
+    monkeypatch.setattr(gpuview_app, 'ROLLUPS', rollup.RollupEngine())
+    cursor = sqlite3.connect(':memory:').cursor()
+    rollup.create_tables(cursor, 'sqlite')
+    gpuview_app.insert_snapshot(cursor, 'backlog', [
+        (60, _hoststat('node', 1, [])), (130, _hoststat('node', 2, []))], 200)
+    cursor.execute('SELECT bucket, hostname, mem_max FROM gpu_rollup_1m')
+    assert cursor.fetchall() == [(60, 'node', 1)]
+
+    now = store._hosts['node'][1]
+    gpustats = store.gpustats(now + 1)
+    assert gpustats[0]['gpus'][0]['memory.used'] == 2
+    assert not gpustats[0].get('stale')
+    assert store.gpustats(now + 6)[0]['stale']
+
+    # batches received by server workers reach the collector
+    monkeypatch.setattr(gpuview_app, 'INGEST_SPOOL', str(tmp_path / 'spool'))
+    client.post('/ingest', data=gzip.compress(
+        b'{"hostname": "other", "snapshots": [{"time": 1, "gpustat": '
+        b'{"hostname": "other", "gpus": []}}]}'),
+        headers={'Content-Encoding': 'gzip'})
+    assert store.load_spool(str(tmp_path / 'spool')) == 1
+    assert list(tmp_path.joinpath('spool').iterdir()) == []
+    assert sorted(g['hostname'] for g in store.gpustats()) == ['node',
+                                                               'other']
+
+    monkeypatch.setattr(gpuview_app, 'EXCLUDE_SELF', True)
+    assert 'gpus' not in client.get('/gpustat').get_json()
+
+
+def test_poll_scheduler():
+    from .scheduler import CIRCUIT_THRESHOLD, PollScheduler
+
+    idle = _hoststat('idle', 0, [])
+    scheduler = PollScheduler(min_interval=2, max_idle_interval=10,
+                              max_backoff=60)
+    hosts = ['busy', 'idle', 'down']
+    assert scheduler.due(hosts, 0) == sorted(hosts)
+
+    # idle hosts slow down, busy ones stay at every cycle
+    polls = {'busy': 0, 'idle': 0, 'down': 0}
+    for cycle in range(60):
+        now = cycle * 2
+        for url in scheduler.due(hosts, now):
+            polls[url] += 1
+            if url == 'down':
+                scheduler.record(url, error='refused', now=now)
+            elif url == 'busy':
+                scheduler.record(url, _hoststat('busy', cycle * 1000, []),
+                                 now=now)
+            else:
+                scheduler.record(url, idle, now=now)
+    assert polls['busy'] == 60
+    assert 10 < polls['idle'] < 20
+    assert polls['down'] == CIRCUIT_THRESHOLD
+    stats = scheduler.stats(120)
+    assert stats['down']['circuit_open'] and stats['down']['error']
+    assert stats['idle']['interval'] == 10
+    assert stats['busy']['change_rate'] > 0.9
+
+    assert stats['down']['circuit'] == 'open'
+
+    # an open circuit lets one probe through per maximum backoff, and
+    # opens again if the probe fails
+    assert scheduler.due(['down'], 119) == []
+    assert scheduler.due(['down'], 120) == ['down']
+    assert scheduler.stats(120)['down']['circuit'] == 'half-open'
+    scheduler.record('down', error='refused', now=120)
+    assert scheduler.stats(120)['down']['circuit'] == 'open'
+    assert scheduler.due(['down'], 179) == []
+    assert scheduler.due(['down'], 180) == ['down']
+
+    # the circuit closes on the first successful probe
+    scheduler.record('down', idle, now=180)
+    stats = scheduler.stats(180)['down']
+    assert stats['circuit'] == 'closed' and not stats['circuit_open']
+
+    # the budget lets the most overdue hosts through first
+    scheduler = PollScheduler(min_interval=2, budget=1)
+    urls = ['h%d' % i for i in range(5)]
+    for now, expected in [(0, ['h0', 'h1']), (2, ['h2', 'h3']), (4, ['h4'])]:
+        due = scheduler.due(urls, now)
+        assert due[:len(expected)] == expected
+        for url in due:
+            scheduler.record(url, _hoststat(url, now, []), now=now)
+    assert scheduler.stats(4)['h4']['skipped'] == 2
+
+
+def test_host_poller_schedule():
+    from http.server import BaseHTTPRequestHandler
+    from .poller import HostPoller
+    from .scheduler import PollScheduler
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            body = b'{"hostname": "n", "gpus": []}'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve(Handler)
+    down = '127.0.0.1:1'
+    poller = HostPoller(connect_timeout=0.2,
+                        scheduler=PollScheduler(max_idle_interval=60))
+    hosts = {url: 'n', down: 'down'}
+    gpustats, stale = poller.poll(hosts)
+    assert stale == [down] and len(requests) == 1
+    # nothing is due right away: last stats are reused, failures stay stale
+    gpustats, stale = poller.poll(hosts)
+    assert len(requests) == 1 and stale == [down]
+    assert gpustats[0]['hostname'] == 'n' and 'updated_at' in gpustats[0]
+    assert 'retry in' in gpustats[1]['error']
+    server.shutdown()
+
+
+def test_metrics(monkeypatch):
+    import os
+    from . import app as gpuview_app
+    from . import metrics
+    from .cache import SnapshotCache
+
+    histogram = metrics.Histogram('test_duration_seconds', 'Test',
+                                  ['host'], buckets=(0.1, 1))
+    metrics.METRICS.remove(histogram)
+    histogram.observe(0.05, host='a')
+    histogram.observe(0.5, host='a')
+    text = histogram.render()
+    assert 'test_duration_seconds_bucket{host="a",le="0.1"} 1\n' in text
+    assert 'test_duration_seconds_bucket{host="a",le="+Inf"} 2\n' in text
+    assert 'test_duration_seconds_count{host="a"} 2\n' in text
+
+    cache = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', cache)
+    cache.publish('all_gpustat', gpuview_app.all_gpustat_payload([
+        {'hostname': 'h1', 'updated_at': 100, 'gpus': [{
+            'index': 0, 'name': 'GPU', 'utilization.gpu': 50,
+            'memory.used': 300, 'memory.total': 1000,
+            'processes': [{'username': 'u', 'gpu_memory_usage': 300}]}]},
+        {'hostname': 'h2', 'stale': True, 'gpus': [
+            {'index': 0, 'processes': 2}]}]))
+    client = gpuview_app.app.test_client()
+    client.get('/status')
+    resp = client.get('/metrics')
+    assert resp.mimetype == 'text/plain'
+    text = resp.get_data(as_text=True)
+    assert 'gpuview_gpu_utilization_percent{host="h1",gpu="0",' \
+        'name="GPU"} 50\n' in text
+    assert 'gpuview_user_memory_mebibytes{host="h1",user="u"} 300\n' in text
+    assert 'gpuview_host_up{host="h2"} 0\n' in text
+    assert 'gpuview_snapshot_bytes{key="all_gpustat"}' in text
+    assert 'gpuview_request_duration_seconds_count{route="/status",' \
+        'method="GET",status="200"}' in text
+
+    # in production mode, the server metrics of a worker are its own series
+    monkeypatch.setattr(gpuview_app, 'WRITER', None)
+    cache.publish('status', {'writer': None})
+    cache.publish('metrics', '# collector\n')
+    text = client.get('/metrics').get_data(as_text=True)
+    worker = 'worker="%d"' % os.getpid()
+    assert '# collector\n' in text
+    assert 'gpuview_request_duration_seconds_count{route="/status",' \
+        'method="GET",status="200",%s}' % worker in text
+    assert 'gpuview_sse_streams{%s}' % worker in text
+
+
+def test_collect_all_gpustat(tmp_path, monkeypatch):
+    import json
+    from http.server import BaseHTTPRequestHandler
+    from . import app as gpuview_app
+    from . import core
+    from .cache import SnapshotCache
+    from .poller import HostPoller
+    from .recent import RecentStore
+    from .registry import HostRegistry
+    from .sampler import FakeSampler
+
+    sampler = FakeSampler(gpus=2, hostname='node', seed=1)
+
+    class NodeHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(sampler.sample(), default=str).encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve(NodeHandler)
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(core, 'REGISTRY',
+                        HostRegistry(gpuview_app.get_db_connection))
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', SnapshotCache())
+    monkeypatch.setattr(gpuview_app, 'POLLER', HostPoller())
+    monkeypatch.setattr(gpuview_app, 'RECENT', RecentStore())
+    monkeypatch.setattr(gpuview_app, 'LAST_PERSISTED', {})
+    gpuview_app.init_db()
+    core.add_host(url, 'node')
+    core.add_host('127.0.0.1:1', 'down')
+    gpuview_app.publish_snapshot('gpustat', {'hostname': 'me', 'gpus': []})
+
+    assert gpuview_app.collect_all_gpustat() == (2, 1, 0, 0)
+    payload = gpuview_app.SNAPSHOT_CACHE.get('all_gpustat').data
+    assert [g['hostname'] for g in payload['gpustats']] == ['down', 'me',
+                                                            'node']
+    assert payload['stale'] == ['down']
+    assert sorted(g['hostname'] for g in
+                  gpuview_app.get_all_latest_from_db()) == ['down', 'me',
+                                                            'node']
+    server.shutdown()
+
+    # a failed round is logged and the collector keeps going
+    class Stop(BaseException):
+        pass
+
+    rounds = []
+
+    def collect():
+        rounds.append(1)
+        raise IOError('pool timed out')
+
+    def sleep(seconds):
+        if len(rounds) == 2:
+            raise Stop()
+
+    monkeypatch.setattr(gpuview_app, 'collect_all_gpustat', collect)
+    monkeypatch.setattr(gpuview_app.time, 'sleep', sleep)
+    try:
+        gpuview_app.background_allgpustat_fetch()
+    except Stop:
+        pass
+    assert len(rounds) == 2
+
+
+def test_host_registry(tmp_path, monkeypatch):
+    import os
+    import pytest
+    from . import app as gpuview_app
+    from . import core
+    from .registry import HostRegistry
+
+    path = str(tmp_path / 'stat.db')
+    registry = HostRegistry.sqlite(path)
+    other = HostRegistry.sqlite(path, check_interval=0)
+    registry.add('a:9988', 'a', labels={'rack': '1'}, interval=10)
+    registry.add('b:9988/', 'b', kind='aggregator', timeout=5)
+    assert registry.hosts() == {'a:9988': 'a'}
+    assert registry.intervals() == {'a:9988': 10.0}
+    assert registry.timeouts() == {'b:9988': 5.0}
+    with pytest.raises(ValueError):
+        registry.add('c:9988', kind='gpu')
+
+    # changes made elsewhere are picked up once the version changed
+    assert other.hosts(None) == {'a:9988': 'a', 'b:9988': 'b'}
+    version = other.version
+    registry.update('a:9988', labels={'rack': '2'})
+    assert other.get('a:9988')['labels'] == {'rack': '2'}
+    assert other.version == version + 1
+    assert registry.remove('b:9988') and not registry.remove('b:9988')
+    assert other.hosts(None) == {'a:9988': 'a'}
+
+    legacy = tmp_path / 'gpuhosts.db'
+    legacy.write_text('old\told:9988\nagg\tagg:9988\taggregator\n')
+    assert registry.import_file(str(legacy)) == 2
+    assert not legacy.exists()
+    assert registry.hosts('aggregator') == {'agg:9988': 'agg'}
+
+    # a file that cannot be renamed is kept, and only new hosts count
+    def read_only(src, dst):
+        raise OSError('read-only file system')
+
+    legacy.write_text('old\told:9988\nnew\tnew:9988\n')
+    monkeypatch.setattr(os, 'rename', read_only)
+    assert registry.import_file(str(legacy)) == 1
+    assert legacy.exists()
+    monkeypatch.undo()
+
+    # readers keep the hosts they got while hosts are added and removed
+    hosts = registry._current()
+    registry.add('d:9988', 'd')
+    registry.remove('new:9988')
+    assert 'd:9988' not in hosts and 'new:9988' in hosts
+    assert registry.remove('d:9988')
+
+    monkeypatch.setattr(core, 'REGISTRY', registry)
+    client = gpuview_app.app.test_client()
+    resp = client.post('/hosts', json={'url': 'n:9988', 'name': 'n',
+                                       'labels': {'rack': '2'}})
+    assert resp.status_code == 201
+    assert client.post('/hosts', json={'url': 'x', 'interval': -1}) \
+        .status_code == 400
+    hosts = client.get('/hosts?label=rack=2').get_json()['hosts']
+    assert [h['url'] for h in hosts] == ['a:9988', 'n:9988']
+    resp = client.patch('/hosts/n:9988', json={'timeout': 3}).get_json()
+    assert resp['host']['timeout'] == 3.0
+    assert client.delete('/hosts/n:9988').get_json() == {'code': 0}
+    assert client.get('/hosts/n:9988').status_code == 404
+
+    # changes need the shared token, or come from this host without one
+    remote = {'REMOTE_ADDR': '10.0.0.9'}
+    assert client.post('/hosts', json={'url': 'evil:80'},
+                       environ_base=remote).status_code == 403
+    assert client.patch('/hosts/a:9988', json={'name': 'b'},
+                        environ_base=remote).status_code == 403
+    assert client.delete('/hosts/a:9988',
+                         environ_base=remote).status_code == 403
+    assert client.get('/hosts', environ_base=remote).status_code == 200
+    monkeypatch.setattr(gpuview_app, 'API_TOKEN', 'secret')
+    assert client.delete('/hosts/a:9988').status_code == 403
+    assert client.post('/hosts', json={'url': 'm:9988'}, environ_base=remote,
+                       headers={'Authorization': 'Bearer secret'}) \
+        .status_code == 201
+    assert registry.get('a:9988') is not None
+
+
+def test_host_poller_intervals():
+    import time
+    from http.server import BaseHTTPRequestHandler
+    from .poller import HostPoller
+
+    requests = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            body = b'{"hostname": "n", "gpus": []}'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server, url = _serve(Handler)
+    poller = HostPoller()
+    gpustats, _ = poller.poll({url: 'n'}, intervals={url: 60})
+    gpustats, _ = poller.poll({url: 'n'}, intervals={url: 60})
+    assert len(requests) == 1
+    assert gpustats[0]['updated_at'] <= time.time()
+    poller.poll({url: 'n'}, timeouts={url: 0.5})
+    assert len(requests) == 2
+    server.shutdown()
+
+
+def test_usage_tracker(tmp_path, monkeypatch):
+    import sqlite3
+    from . import app as gpuview_app
+    from . import usage
+    from .cache import SnapshotCache
+
+    def proc(user, memory):
+        return {'pid': 1, 'username': user, 'gpu_memory_usage': memory}
+
+    shared = _hoststat('a', 3072, [proc('u1', 1024), proc('u2', 2048)])
+    idle = _hoststat('b', 0, [])
+    tracker = usage.UsageTracker()
+    assert tracker.observe([shared, idle], 0)
+    view = tracker.view()
+    assert [(u['user'], u['memory'], u['gpus']) for u in view['users']] == \
+        [('u2', 2048, 0.5), ('u1', 1024, 0.5)]
+    assert [g['name'] for g in view['gpus']] == ['a [0]']
+
+    # the same gpus: nothing to recompute; then u1 owns the gpu alone
+    assert not tracker.observe([dict(shared), idle], 30)
+    alone = _hoststat('a', 1024, [proc('u1', 1024)])
+    assert tracker.observe([alone], 60)
+    assert [u['user'] for u in tracker.view()['users']] == ['u1']
+    tracker.observe([alone], 90)
+    # a pause of an hour is not accrued
+    tracker.observe([alone], 90 + 3600)
+
+    conn = sqlite3.connect(str(tmp_path / 'usage.db'))
+    cursor = conn.cursor()
+    usage.create_tables(cursor, 'sqlite')
+    tracker.save(cursor, 'sqlite', force=True)
+    assert tracker.pending() == []
+    tracker.observe([alone], 90 + 3600 + 36)
+    rows = usage.query_ledger(cursor, 'sqlite', 0, 86400,
+                              pending=tracker.pending())
+    assert [r['user'] for r in rows] == ['u1', 'u2']
+    # half a gpu for 60s, then the gpu for 30s, then for 36s more
+    assert abs(rows[0]['gpu_hours'] - (30 + 30 + 36) / 3600.0) < 1e-4
+    assert abs(rows[1]['mem_gib_hours'] - 2 * 60 / 3600.0) < 1e-4
+    rows = usage.query_ledger(cursor, 'sqlite', 0, 86400, user='u2',
+                              group=('user', 'host'))
+    assert [(r['user'], r['host']) for r in rows] == [('u2', 'a')]
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(gpuview_app, 'USAGE', tracker)
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', SnapshotCache())
+    client = gpuview_app.app.test_client()
+    assert client.get('/usage').get_json()['users'][0]['user'] == 'u1'
+    assert client.get('/usage/ledger?group=gpu').get_json()['code'] == 1
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'usage.db'))
+    rows = client.get('/usage/ledger?start=0&end=86400&group=user,day') \
+        .get_json()['data']
+    assert [(r['user'], r['day']) for r in rows] == [('u1', 0), ('u2', 0)]
+
+    # a production worker adds the usage the collector has not saved yet
+    monkeypatch.setattr(gpuview_app, 'USAGE', usage.UsageTracker())
+    monkeypatch.setattr(gpuview_app, 'WRITER', None)
+    gpuview_app.SNAPSHOT_CACHE.publish('usage_pending',
+                                       [[0, 'u3', 'c', 1.0, 0.5]])
+    rows = client.get('/usage/ledger?start=0&end=86400').get_json()['data']
+    assert [(r['user'], r['gpu_hours']) for r in rows][0] == ('u3', 1.0)
+
+
+def test_cli(tmp_path):
+    import os
+    import subprocess
+    import sys
+    from .registry import HostRegistry
+    from .utils import arg_parser
+
+    args = arg_parser().parse_args(['run', '--db', 'mysql', '--db-url',
+                                    'mysql://u:p@h/db', '--storage',
+                                    'normalized'])
+    assert (args.db, args.db_url, args.storage) == ('mysql',
+                                                   'mysql://u:p@h/db',
+                                                   'normalized')
+    assert arg_parser().parse_args(['hosts']).db == 'sqlite'
+
+    # host commands don't load the server stack
+    path = str(tmp_path / 'stat.db')
+    probe = ('import sys; from gpuview.cli import main; main(sys.argv[1:]); '
+             'print(sorted(m for m in ("flask", "mysql", "gpustat") '
+             'if m in sys.modules))')
+    out = subprocess.check_output(
+        [sys.executable, '-c', probe, 'add', '--url', 'n:9988', '--label',
+         'rack=r1', '--db-path', path], universal_newlines=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert out.splitlines()[-1] == '[]'
+    assert HostRegistry.sqlite(path).get('n:9988')['labels'] == \
+        {'rack': 'r1'}
+
+
+def test_connection_pool(tmp_path, monkeypatch):
+    import pytest
+    from . import app as gpuview_app
+    from .storage import ConnectionPool, PoolTimeout
+
+    pool = ConnectionPool.sqlite(str(tmp_path / 'pool.db'), size=2,
+                                 timeout=0.05, check_after=0)
+    conn = pool.connection()
+    conn.cursor().execute('CREATE TABLE t (x INTEGER)')
+    conn.commit()
+    raw = conn._entry.raw
+    conn.close()
+
+    # connections are reused, at most `size` are open at once
+    first, second = pool.connection(), pool.connection()
+    assert raw in (first._entry.raw, second._entry.raw)
+    with pytest.raises(PoolTimeout):
+        pool.connection()
+    # uncommitted work is rolled back when a connection is given back
+    first.cursor().execute('INSERT INTO t VALUES (?)', (1,))
+    first.close()
+    second.close()
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+
+    # broken connections are discarded when given back, or replaced
+    # after the health check when they broke while idle
+    conn = pool.connection()
+    conn._entry.raw.close()
+    conn.close()
+    raw.close()
+    with pool.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone() == (0,)
+    stats = pool.stats()
+    assert (stats['size'], stats['open'], stats['in_use']) == (2, 1, 0)
+    assert (stats['timeouts'], stats['reconnects'], stats['discarded']) == \
+        (1, 1, 2)
+
+    # the app borrows from one pool per database
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(gpuview_app, 'LAST_PERSISTED', {})
+    monkeypatch.setattr(gpuview_app, 'WRITER', None)
+    gpuview_app.init_db()
+    gpuview_app.save_to_db([], 'allgpustats')
+    assert gpuview_app.get_all_latest_from_db() == []
+    assert gpuview_app.db_pool() is gpuview_app.POOL
+    stats = gpuview_app.collector_status()['storage']
+    assert stats['open'] == 1 and stats['acquired'] >= 3
+
+
+def test_gpustat_query(tmp_path, monkeypatch):
+    from . import app as gpuview_app
+    from . import core
+    from .cache import SnapshotCache
+    from .registry import HostRegistry
+
+    def gpu(index, used, utilization, processes):
+        return {'index': index, 'memory.used': used, 'memory.total': 1000,
+                'utilization.gpu': utilization, 'processes': processes}
+
+    busy = [{'username': 'u', 'gpu_memory_usage': 500}]
+    cache = SnapshotCache()
+    monkeypatch.setattr(gpuview_app, 'SNAPSHOT_CACHE', cache)
+    registry = HostRegistry.sqlite(str(tmp_path / 'stat.db'))
+    monkeypatch.setattr(core, 'REGISTRY', registry)
+    registry.add('a:9988', 'node-a', labels={'rack': 'r1'})
+    # registered without a name: the poller keeps the node's own hostname
+    registry.add('http://10.0.0.5:9988', labels={'rack': 'r1'})
+    snapshot = cache.publish('all_gpustat', gpuview_app.all_gpustat_payload([
+        {'hostname': 'node-a', 'gpus': [gpu(0, 0, 0, []),
+                                        gpu(1, 600, 90, busy)]},
+        {'hostname': 'worker-5', 'url': 'http://10.0.0.5:9988',
+         'gpus': [gpu(0, 900, 100, busy)]},
+        {'hostname': 'node-b', 'gpus': [gpu(0, 5, 1, [])]},
+        {'hostname': 'node-c', 'stale': True, 'gpus': [gpu(0, 0, 0, [])]},
+    ]))
+    cache.publish('gpustat', {'hostname': 'node-a', 'gpus': [
+        gpu(0, 0, 0, []), gpu(1, 600, 90, busy)]})
+    client = gpuview_app.app.test_client()
+
+    def hosts(path):
+        data = client.get(path).get_json()
+        return dict((h['hostname'], [g['index'] for g in h['gpus']])
+                    for h in data['gpustats'])
+
+    assert hosts('/all_gpustat?host=node-a,node-b') == \
+        {'node-a': [0, 1], 'node-b': [0]}
+    assert hosts('/all_gpustat?host=node-*&stale=0') == \
+        {'node-a': [0, 1], 'node-b': [0]}
+    assert hosts('/all_gpustat?label=rack=r1&gpu=1') == {'node-a': [1]}
+    assert hosts('/all_gpustat?label=rack=r1') == {'node-a': [0, 1],
+                                                   'worker-5': [0]}
+    # free gpus of fresh hosts only; hosts without any are left out
+    assert hosts('/all_gpustat?free=1') == {'node-a': [0], 'node-b': [0]}
+    assert hosts('/all_gpustat?min_free_memory=500&max_utilization=50') \
+        == {'node-a': [0], 'node-b': [0], 'node-c': [0]}
+
+    resp = client.get('/all_gpustat?fields=memory.used&processes=0')
+    data = resp.get_json()
+    assert data['gpustats'][0]['gpus'] == [
+        {'index': 0, 'memory.used': 0}, {'index': 1, 'memory.used': 600}]
+    assert data['stale'] == ['node-c']
+    # the view has its own etag and is built once per snapshot
+    assert resp.headers['ETag'] != '"%s"' % snapshot.etag
+    assert client.get('/all_gpustat?fields=memory.used&processes=0',
+                      headers={'If-None-Match': resp.headers['ETag']}
+                      ).status_code == 304
+    assert len(snapshot._views) == 7
+
+    data = client.get('/gpustat?processes=0&gpu=1').get_json()
+    assert data == {'hostname': 'node-a', 'gpus': [
+        {'index': 1, 'memory.used': 600, 'memory.total': 1000,
+         'utilization.gpu': 90}]}
+    resp = client.get('/all_gpustat?gpu=x')
+    assert resp.status_code == 400 and resp.get_json()['code'] == 1
+
+
+def _unsafe_gpustat(monkeypatch):
+    # a gpustat as reported outside the safe zone: gpu 0 runs a small
+    # process, gpu 1 runs nothing
+    from . import core
+    from .sampler import FakeSampler
+
+    def gpu(index, processes):
+        return {'index': index, 'memory.used': 5, 'memory.total': 1000,
+                'utilization.gpu': 0, 'temperature.gpu': 30,
+                'processes': processes}
+
+    sampler = FakeSampler()
+    sampler.sample = lambda: {'hostname': 'node', 'gpus': [
+        gpu(0, [{'pid': 1, 'username': 'u', 'command': 'python',
+                 'gpu_memory_usage': 5}]), gpu(1, [])]}
+    monkeypatch.setattr(core, 'SAMPLER', sampler)
+    monkeypatch.setattr(core, 'SAFE_ZONE', False)
+    stat = core.my_gpustat()
+    assert all('processes' not in g for g in stat['gpus'])
+    return stat
+
+
+def test_free_gpus_outside_safe_zone(monkeypatch):
+    from .query import GpuQuery
+
+    stat = _unsafe_gpustat(monkeypatch)
+    query = GpuQuery(free=True)
+    assert [query.match_gpu(i, g) for i, g in enumerate(stat['gpus'])] == \
+        [False, True]
+
+
+def test_archive_outside_safe_zone(monkeypatch):
+    from . import archive
+
+    stat = _unsafe_gpustat(monkeypatch)
+    rows = archive.sample_rows([stat], 60, 1)['node']
+    assert [row[-1] for _, row in rows] == [1, 0]
+
+
+def test_archive(tmp_path, monkeypatch, capsys):
+    import os
+    import time
+    from . import app as gpuview_app
+    from . import archive
+    from .cli import main
+
+    monkeypatch.setattr(gpuview_app, 'HOSTS_DB', str(tmp_path / 'stat.db'))
+    store = archive.Archive(str(tmp_path / 'archive'))
+    monkeypatch.setattr(gpuview_app, 'ARCHIVE', store)
+    gpuview_app.init_db()
+
+    def hoststats(utilization):
+        return [{'hostname': 'node/a', 'gpus': [
+            {'index': 0, 'utilization.gpu': utilization, 'memory.used': 10,
+             'memory.total': 100, 'processes': [{'pid': 1}]},
+            {'index': 1, 'utilization.gpu': None}]},
+            {'hostname': 'b', 'stale': True, 'gpus': [{'index': 0}]}]
+
+    day = 86400
+    old = (int(time.time()) // day - 5) * day + 3600
+    conn = gpuview_app.get_db_connection()
+    cursor = conn.cursor()
+    for i in range(3):
+        gpuview_app.insert_raw_snapshot(cursor, 'allgpustats',
+                                        hoststats(10 * i), old + 60 * i)
+    gpuview_app.insert_raw_snapshot(cursor, 'allgpustats', hoststats(99),
+                                    time.time())
+    conn.commit()
+
+    # expiring snapshots are exported once, then deleted
+    tables = gpuview_app.expired_tables()
+    assert gpuview_app.archive_expiring(conn, cursor, tables)
+    assert gpuview_app.archive_expiring(conn, cursor, tables)
+    assert store.stats()['snapshots'] == 3 and store.stats()['rows'] == 6
+    # an export whose watermark was lost appends nothing twice
+    cursor.execute("UPDATE rollup_state SET watermark = 0 WHERE tier = ?",
+                   (archive.WATERMARK,))
+    assert gpuview_app.archive_expiring(conn, cursor, tables)
+    assert store.stats()['rows'] == 6 and store.stats()['skipped'] == 6
+    gpuview_app.ROLLUPS.expire(cursor, 'sqlite', 'allgpustats', 'created_at',
+                               dict((t, c) for t, _, c in tables)
+                               ['allgpustats'])
+    conn.commit()
+    conn.close()
+
+    rows, truncated = store.query(old, old + day, host='node/a', gpu=0)
+    assert [(r[0], r[1], r[3], r[-1]) for r in rows] == [
+        (old, 'node/a', 0, 1), (old + 60, 'node/a', 10, 1),
+        (old + 120, 'node/a', 20, 1)] and not truncated
+    assert store.query(old + 60, old + 120)[0][0][2:4] == [0, 10]
+    assert store.query(old, old + day, host='b')[0] == []
+
+    # a block cut short by a crash is skipped, and dropped on the next append
+    segment = os.path.join(store.root, time.strftime(
+        '%Y-%m-%d', time.gmtime(old)), archive._filename('node/a'))
+    with open(segment, 'ab') as f:
+        f.write(b'BLK2\x05')
+    assert len(store.query(old, old + day)[0]) == 6
+    store.append(archive.sample_rows(hoststats(30), old + 180, 4))
+    assert len(store.query(old, old + day)[0]) == 8
+
+    # hostnames made alike for the file name keep their own segments
+    store.append(archive.sample_rows([{'hostname': 'node_a', 'gpus': [
+        {'index': 0, 'utilization.gpu': 50}]}], old + 240, 5))
+    assert os.path.basename(segment) != archive._filename('node_a')
+    rows, _ = store.query(old, old + day, host='node_a')
+    assert [(r[1], r[3]) for r in rows] == [('node_a', 50)]
+    assert len(store.query(old, old + day, host='node/a')[0]) == 8
+
+    client = gpuview_app.app.test_client()
+    data = client.get('/archive?start=%d&end=%d&gpu=1&limit=2' % (
+        old, old + day)).get_json()['data']
+    assert data['columns'][:4] == ['time', 'host', 'gpu', 'utilization']
+    assert len(data['rows']) == 2 and data['truncated']
+    assert data['rows'][0][3] is None
+
+    main(['archive', '--archive-dir', store.root, '--start',
+          time.strftime('%Y-%m-%d', time.gmtime(old)), '--gpu', '0'])
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].startswith('time,host,gpu,utilization')
+    assert len(lines) == 6 and lines[-2].split(',')[3] == '30'
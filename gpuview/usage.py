@@ -0,0 +1,250 @@
+"""
+Per-user usage of the gpus aggregated by gpuview.
+
+Once per collector cycle, `UsageTracker` updates:
+
+    users   memory, processes and gpus of every user across all hosts,
+            the ranking shown by the dashboard
+    gpus    used memory of every gpu holding more than `MIN_MEMORY` MiB
+
+Hosts whose gpus did not change since the last cycle keep their previous
+contribution, so a cycle only walks the processes of the hosts that were
+polled again. The tracker also accrues a ledger of gpu-hours and
+gpu-memory-hours per user and host, saved per day in `usage_ledger`. A
+gpu shared by several users counts as a share of a gpu for each of them.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import threading
+import time
+
+from .rollup import upsert
+
+MIN_MEMORY = 10  # MiB, gpus using less are left out of the gpu view
+MAX_GAP = 60  # seconds, longer pauses between cycles are not accrued
+SAVE_INTERVAL = 60  # seconds between ledger writes
+LEDGER_COLUMNS = ['gpu_hours', 'mem_gib_hours']
+
+
+def create_tables(cursor, db_type):
+    name = 'VARCHAR(255)' if db_type == 'mysql' else 'TEXT'
+    number = 'DOUBLE' if db_type == 'mysql' else 'REAL'
+    suffix = ' ENGINE=InnoDB' if db_type == 'mysql' else ''
+    cursor.execute(
+        'CREATE TABLE IF NOT EXISTS usage_ledger (\n'
+        '    day BIGINT NOT NULL,\n'
+        '    username VARCHAR(64) NOT NULL,\n'
+        '    hostname %s NOT NULL,\n'
+        '    gpu_hours %s NOT NULL,\n'
+        '    mem_gib_hours %s NOT NULL,\n'
+        '    PRIMARY KEY (day, username, hostname)\n'
+        ')%s' % (name, number, number, suffix))
+
+
+def _contribution(hostinfo):
+    """
+    Returns:
+        tuple: ({user: [memory, processes, gpus]}, [gpu view entries]) of
+            one host
+    """
+
+    hostname = hostinfo['hostname']
+    users = {}
+    gpus = []
+    for position, gpu in enumerate(hostinfo.get('gpus') or []):
+        index = gpu.get('index', position)
+        used = gpu.get('memory.used') or 0
+        if used > MIN_MEMORY:
+            gpus.append({'name': '%s [%s]' % (hostname, index),
+                         'host': hostname, 'index': index, 'memory': used})
+        processes = gpu.get('processes')
+        if not isinstance(processes, list):
+            # processes are hidden outside the safe zone
+            continue
+        owners = {}
+        for p in processes:
+            user = p.get('username') or 'Unknown'
+            owner = owners.setdefault(user, [0, 0])
+            owner[0] += p.get('gpu_memory_usage') or 0
+            owner[1] += 1
+        for user, (memory, count) in owners.items():
+            totals = users.setdefault(user, [0, 0, 0.0])
+            totals[0] += memory
+            totals[1] += count
+            totals[2] += 1.0 / len(owners)
+    return users, gpus
+
+
+class UsageTracker(object):
+    """
+    Maintains the usage views and the gpu-hour ledger.
+    """
+
+    def __init__(self):
+        self._hosts = {}  # hostname: (gpus list, stale, users, gpu entries)
+        self._users = {}  # user: [memory, processes, gpus, hosts]
+        self._pending = {}  # (day, user, hostname): [gpu hours, GiB hours]
+        self._last = None  # time of the last cycle
+        self._saved = None
+        self._lock = threading.Lock()
+
+    def observe(self, hoststats, now=None):
+        """
+        Updates the views and accrues the time since the last cycle.
+
+        Returns:
+            bool: whether the views changed
+        """
+
+        now = time.time() if now is None else now
+        changed = False
+        with self._lock:
+            # the time since the last cycle is accrued to the usage it saw
+            if self._last is not None and 0 < now - self._last <= MAX_GAP:
+                hours = (now - self._last) / 3600.0
+                day = int(now) - int(now) % 86400
+                for hostname, (_, stale, users, _) in self._hosts.items():
+                    if stale:
+                        continue
+                    for user, (memory, _, gpus) in users.items():
+                        pending = self._pending.setdefault(
+                            (day, user, hostname), [0.0, 0.0])
+                        pending[0] += gpus * hours
+                        pending[1] += memory / 1024.0 * hours
+
+            seen = set()
+            for hostinfo in hoststats or []:
+                if not hostinfo or 'hostname' not in hostinfo:
+                    continue
+                hostname = hostinfo['hostname']
+                seen.add(hostname)
+                gpus = hostinfo.get('gpus')
+                stale = bool(hostinfo.get('stale'))
+                last = self._hosts.get(hostname)
+                # unchanged hosts share the gpus of their last stats
+                if last is not None and last[0] is gpus and last[1] == stale:
+                    continue
+                users, entries = _contribution(hostinfo)
+                if last is not None:
+                    self._account(last[2], -1)
+                self._account(users, 1)
+                self._hosts[hostname] = (gpus, stale, users, entries)
+                changed = True
+            for hostname in list(self._hosts):
+                if hostname not in seen:
+                    self._account(self._hosts.pop(hostname)[2], -1)
+                    changed = True
+
+            self._last = now
+        return changed
+
+    def _account(self, users, sign):
+        for user, (memory, processes, gpus) in users.items():
+            totals = self._users.setdefault(user, [0, 0, 0.0, 0])
+            totals[0] += sign * memory
+            totals[1] += sign * processes
+            totals[2] += sign * gpus
+            totals[3] += sign
+            if totals[3] <= 0:
+                del self._users[user]
+
+    def view(self):
+        """
+        Returns:
+            dict: {'users': [...] by decreasing memory, 'gpus': [...] in
+                host order}; memory in MiB
+        """
+
+        with self._lock:
+            users = sorted(({'user': user, 'memory': memory,
+                             'processes': processes,
+                             'gpus': round(gpus, 2), 'hosts': hosts}
+                            for user, (memory, processes, gpus, hosts)
+                            in self._users.items()),
+                           key=lambda u: (-u['memory'], u['user']))
+            gpus = []
+            for hostname in sorted(self._hosts):
+                gpus.extend(self._hosts[hostname][3])
+        return {'users': users, 'gpus': gpus}
+
+    def pending(self):
+        """
+        Returns:
+            list: [(day, user, hostname, gpu hours, GiB hours), ...] accrued
+                but not saved yet
+        """
+
+        with self._lock:
+            return [key + tuple(values)
+                    for key, values in self._pending.items()]
+
+    def save(self, cursor, db_type, now=None, force=False):
+        """
+        Adds the accrued usage to the ledger, at most once per
+        `SAVE_INTERVAL`.
+
+        Returns:
+            bool: whether the pending usage was moved to the ledger
+        """
+
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._saved is None:
+                self._saved = now
+            if not force and now - self._saved < SAVE_INTERVAL:
+                return False
+            rows = [list(key) + values
+                    for key, values in self._pending.items()]
+            self._pending = {}
+            self._saved = now
+        upsert(cursor, db_type, 'usage_ledger',
+               ['day', 'username', 'hostname'], LEDGER_COLUMNS, rows)
+        return True
+
+
+def query_ledger(cursor, db_type, start, end, user=None, hostname=None,
+                 group=('user',), pending=()):
+    """
+    Sums the ledger over the days from `start` to `end`.
+
+    Args:
+        group (tuple): of 'user', 'host' and 'day'
+        pending (list): rows of `UsageTracker.pending` not saved yet
+
+    Returns:
+        list: [{'user'?, 'host'?, 'day'?, 'gpu_hours', 'mem_gib_hours'}]
+            by decreasing gpu hours
+    """
+
+    placeholder = '%s' if db_type == 'mysql' else '?'
+    first = int(start) - int(start) % 86400
+    where = 'day >= {0} AND day <= {0}'
+    params = [first, int(end)]
+    if user is not None:
+        where += ' AND username = {0}'
+        params.append(user)
+    if hostname is not None:
+        where += ' AND hostname = {0}'
+        params.append(hostname)
+    cursor.execute(
+        'SELECT day, username, hostname, gpu_hours, mem_gib_hours '
+        'FROM usage_ledger WHERE %s' % where.format(placeholder), params)
+
+    columns = {'day': 0, 'user': 1, 'host': 2}
+    totals = {}
+    for row in list(cursor.fetchall()) + list(pending):
+        day, username, host = row[:3]
+        if not first <= day <= end or user not in (None, username) or \
+                hostname not in (None, host):
+            continue
+        key = tuple(row[columns[name]] for name in group)
+        total = totals.setdefault(key, [0.0, 0.0])
+        total[0] += row[3]
+        total[1] += row[4]
+    return sorted((dict(list(zip(group, key)) + [
+        ('gpu_hours', round(gpu_hours, 4)),
+        ('mem_gib_hours', round(mem_gib_hours, 4))])
+        for key, (gpu_hours, mem_gib_hours) in totals.items()),
+        key=lambda r: -r['gpu_hours'])
@@ -0,0 +1,176 @@
+"""
+Batched snapshot writer of gpuview.
+
+Both collectors put their snapshots on one bounded queue; a single thread
+drains it over one reused connection and commits them in batches.
+
+@author Jysir
+@url https://github.com/jysir99/gpuview-flask
+"""
+
+import threading
+import time
+
+from . import metrics
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+QUEUE_SIZE = 1000
+FLUSH_INTERVAL = 5.0  # seconds
+FLUSH_SIZE = 50
+POLICIES = ('drop_oldest', 'drop_newest', 'block')
+BLOCK_TIMEOUT = 1.0  # seconds a collector waits with the 'block' policy
+
+
+class SnapshotWriter(object):
+    """
+    Persists snapshots in batches from a dedicated thread.
+
+    Args:
+        connect (callable): returns a new database connection
+        write (callable): write(cursor, dbname, data, sample_time) inserts
+            one snapshot
+        policy (str): what to do when the queue is full because the disk
+            is slow: 'drop_oldest', 'drop_newest', or 'block' the
+            collector for up to a second and then drop the snapshot
+    """
+
+    def __init__(self, connect, write, queue_size=QUEUE_SIZE,
+                 flush_interval=FLUSH_INTERVAL, flush_size=FLUSH_SIZE,
+                 policy='drop_oldest'):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: %s' % policy)
+        self.connect = connect
+        self.write = write
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.policy = policy
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()  # one flush at a time
+        self._conn = None
+        self._thread = None
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def put(self, dbname, data):
+        """
+        Queues a snapshot to be saved into the `dbname` table.
+
+        Returns:
+            bool: False if a snapshot had to be dropped
+        """
+
+        item = (dbname, data, time.time())
+        if self.policy == 'block':
+            try:
+                self._queue.put(item, timeout=BLOCK_TIMEOUT)
+                return True
+            except queue.Full:
+                self.dropped += 1
+                return False
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.policy == 'drop_newest':
+            return False
+        try:
+            self._queue.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            pass
+        return False
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.flush_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def flush(self):
+        """
+        Synchronously writes everything queued so far.
+        """
+
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        started = time.time()
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = self.connect()
+                cursor = self._conn.cursor()
+                for dbname, data, sample_time in batch:
+                    self.write(cursor, dbname, data, sample_time)
+                self._conn.commit()
+                self.written += len(batch)
+            except Exception as e:
+                self.failed += len(batch)
+                print('Error: %s writing %d snapshots' %
+                      (getattr(e, 'message', str(e)), len(batch)))
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None  # reconnect on the next batch
+        elapsed = time.time() - started
+        metrics.DB_WRITE_DURATION.observe(elapsed)
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        self.total_flush_seconds += elapsed
+
+    def stats(self):
+        """
+        Returns:
+            dict: queue depth, counters and flush latency of the writer
+        """
+
+        return {
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'policy': self.policy,
+            'written': self.written,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'flushes': self.flushes,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'mean_flush_seconds': (self.total_flush_seconds / self.flushes
+                                   if self.flushes else 0.0),
+        }
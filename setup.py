@@ -29,12 +29,12 @@ setuptools.setup(
     ],
     packages=['gpuview'],
     install_requires=['gpustat>=0.5.0', 'flask', 'flask_caching', 'mysql-connector-python'],
-    extras_require={'test': ['pytest']},
+    extras_require={'test': ['pytest'], 'production': ['gunicorn']},
     setup_requires=['pytest-runner'],
     tests_require=['pytest'],
     entry_points={
         'console_scripts': [
-            'gpuview=gpuview.app:main',
+            'gpuview=gpuview.cli:main',
         ],
     },
     include_package_data=True,